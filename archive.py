@@ -0,0 +1,213 @@
+"""
+Archives - several files streamed as one tar or zip, generated on the fly
+The archive is produced chunk by chunk while it is sent, so nothing is staged
+on disk and memory use does not grow with the size of the files. Tar archives
+can be gzip compressed as a whole; zip archives deflate each member, except
+those of file types that are already compressed.
+"""
+
+import fnmatch
+import os
+import tarfile
+import zipfile
+from config import FILES_DIRECTORY, ARCHIVE_CHUNK_SIZE
+from uploads import is_valid_filename
+import compression
+import logs
+
+log = logs.get_logger('archive')
+
+# Archive formats accepted in requests
+FORMATS = ('tar', 'zip')
+
+
+class ArchiveError(Exception):
+    """Raised when an archive request is malformed"""
+
+
+def parse_request(request):
+    """
+    Validate an archive request and find the files it selects
+    
+    Args:
+        request: Decoded request fields: 'names' (list of file names) or 'pattern'
+            (glob matched against the file names), optional 'format' and 'compress'
+    
+    Returns:
+        Tuple of (format, compress, list of (name, path, os.stat_result), list of missing names)
+    """
+    archive_format = request.get('format', 'tar')
+    if archive_format not in FORMATS:
+        raise ArchiveError(f"Unknown archive format: {archive_format!r}")
+    compress = bool(request.get('compress', False))
+    
+    names, pattern = request.get('names'), request.get('pattern')
+    if names is None and pattern is None:
+        raise ArchiveError("An archive request needs 'names' or 'pattern'")
+    if names is not None and (not isinstance(names, list) or not all(map(is_valid_filename, names))):
+        raise ArchiveError("'names' must be a list of file names")
+    if pattern is not None and not isinstance(pattern, str):
+        raise ArchiveError("'pattern' must be a string")
+    
+    files, missing = select_files(names, pattern)
+    return archive_format, compress, files, missing
+
+
+def select_files(names=None, pattern=None, directory=FILES_DIRECTORY):
+    """
+    Find the files an archive is made of
+    
+    Args:
+        names: File names, archived in the given order (duplicates are dropped)
+        pattern: Glob matched against the names of all files in `directory`, archived in name order
+        directory: Directory the files are in
+    
+    Returns:
+        Tuple of (list of (name, path, os.stat_result), list of names that do not exist)
+    """
+    if names is None:
+        with os.scandir(directory) as it:
+            names = sorted(entry.name for entry in it
+                           if is_valid_filename(entry.name) and fnmatch.fnmatchcase(entry.name, pattern))
+    
+    files, missing = [], []
+    for name in dict.fromkeys(names):
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            missing.append(name)
+            continue
+        if os.path.isfile(path):
+            files.append((name, path, st))
+        else:
+            missing.append(name)
+    return files, missing
+
+
+def archive_name(archive_format, compress):
+    """
+    Return a file name for an archive
+    
+    Args:
+        archive_format: One of FORMATS
+        compress: Whether the archive is compressed
+    """
+    if archive_format == 'tar' and compress:
+        return 'files.tar.gz'
+    return f"files.{archive_format}"
+
+
+def stream_archive(files, archive_format='tar', compress=False):
+    """
+    Generate an archive of some files
+    
+    Args:
+        files: List of (name, path, os.stat_result) from select_files()
+        archive_format: One of FORMATS
+        compress: gzip a tar archive / deflate the members of a zip archive
+    
+    Yields:
+        Tuples of (archive bytes, is_last); only the final tuple has is_last set
+    """
+    if archive_format == 'zip':
+        chunks = _stream_zip(files, compress)
+    else:
+        chunks = _stream_tar(files, compress)
+    
+    # Hold one chunk back so the last one can be flagged
+    previous = None
+    for data in chunks:
+        if not data:
+            continue
+        if previous is not None:
+            yield previous, False
+        previous = data
+    yield previous or b'', True
+
+
+def _stream_tar(files, compress):
+    """Yield a (optionally gzip compressed) tar archive of `files`"""
+    compressor = compression.CODECS['gzip'].compressor() if compress else None
+    
+    def output(data):
+        return compressor.compress(data) if compressor else data
+    
+    for name, path, st in files:
+        try:
+            source = open(path, 'rb')
+        except OSError as e:
+            log.warning(f"Skipping {name}: {str(e)}")
+            continue
+        
+        with source:
+            info = tarfile.TarInfo(name)
+            info.size = st.st_size
+            info.mtime = int(st.st_mtime)
+            info.mode = 0o644
+            yield output(info.tobuf(tarfile.PAX_FORMAT))
+            
+            remaining = st.st_size
+            while remaining:
+                chunk = source.read(min(ARCHIVE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    # The file shrank while it was archived; pad it so the archive stays readable
+                    chunk = bytes(min(ARCHIVE_CHUNK_SIZE, remaining))
+                remaining -= len(chunk)
+                yield output(chunk)
+            
+            padding = -st.st_size % tarfile.BLOCKSIZE
+            if padding:
+                yield output(bytes(padding))
+    
+    # End-of-archive marker: two empty blocks
+    yield output(bytes(2 * tarfile.BLOCKSIZE))
+    if compressor:
+        yield compressor.flush()
+
+
+class _Sink:
+    """Write-only stream that collects what zipfile writes so it can be yielded"""
+    
+    def __init__(self):
+        """Start with nothing written"""
+        self.chunks = []
+    
+    def write(self, data):
+        """Collect written bytes"""
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        """Nothing is buffered below drain(), so there is nothing to flush"""
+    
+    def drain(self):
+        """Return and forget everything written since the last call"""
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _stream_zip(files, compress):
+    """Yield a zip archive of `files`, deflating the members if `compress` is set"""
+    sink = _Sink()
+    # zipfile writes data descriptors instead of seeking back when the stream is not seekable
+    with zipfile.ZipFile(sink, 'w') as archive:
+        for name, path, st in files:
+            try:
+                source = open(path, 'rb')
+            except OSError as e:
+                log.warning(f"Skipping {name}: {str(e)}")
+                continue
+            
+            with source:
+                info = zipfile.ZipInfo.from_file(path, arcname=name)
+                if compress and compression.choose_encoding(name, st.st_size, ['gzip'], source):
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                with archive.open(info, 'w') as member:
+                    for chunk in iter(lambda: source.read(ARCHIVE_CHUNK_SIZE), b''):
+                        member.write(chunk)
+                        yield sink.drain()
+            yield sink.drain()
+    # Central directory
+    yield sink.drain()
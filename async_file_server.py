@@ -0,0 +1,838 @@
+"""
+Asynchronous File Server - asyncio based TCP Server
+Serves the same protocols as file_server.py (framed and legacy), but handles
+every client as a coroutine on a single event loop instead of an OS thread,
+so idle and slow connections cost a few kilobytes each rather than a thread.
+Clients that stall are cut off by the same HANDSHAKE_TIMEOUT, IDLE_TIMEOUT
+and TRANSFER_TIMEOUT as in the threaded server.
+"""
+
+import asyncio
+import os
+import stat
+import sys
+import time
+import zlib
+from config import (SERVER_HOST, SERVER_PORT, BUFFER_SIZE, FILES_DIRECTORY, USE_SENDFILE,
+                    LISTEN_BACKLOG, VERIFY_CHECKSUMS, KEEPALIVE_TIMEOUT, HANDSHAKE_TIMEOUT, IDLE_TIMEOUT,
+                    TRANSFER_TIMEOUT)
+from rate_limiter import bandwidth_manager
+from checksums import checksum_cache
+from file_cache import file_cache, shared_mappings, CachedFile, version_tag
+from file_server import (resolve_file_path, select_range, open_upload, finish_upload, content_hash, stats_report,
+                         connections_total, open_connections, requests_total, request_seconds, errors_total,
+                         connections_reaped, REAP_REASONS)
+from content_store import content_store
+import archive
+import compression
+import logs
+import metrics
+import protocol
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+log = logs.get_logger('server')
+
+# Largest slice of in-memory file data written before waiting for the client to take it
+MEMORY_SLICE = 1024 * 1024
+
+
+class ClientStalled(Exception):
+    """A client missed one of the timeouts; `reason` is the connections_reaped label"""
+    
+    def __init__(self, reason, message):
+        """
+        Initialize the exception
+        
+        Args:
+            reason: 'handshake', 'idle' or 'deadline'
+            message: Human readable description
+        """
+        Exception.__init__(self, message)
+        self.reason = reason
+
+
+class AsyncFileServer:
+    """Event-loop server that handles each client connection as a coroutine"""
+    
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, backlog=LISTEN_BACKLOG, sock=None,
+                 reuse_port=False, cluster_stats=None):
+        """
+        Initialize the asyncio file server
+        
+        Args:
+            host: Server host address
+            port: Server port number
+            backlog: Listen backlog for the server socket
+            sock: Already listening socket to accept from (shared by pre-forked processes)
+            reuse_port: Bind with SO_REUSEPORT so other processes can listen on the same port
+            cluster_stats: Callable returning the OP_STATS answer for every process of a
+                pre-forked server (None, or a None result, reports this process only)
+        """
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.sock = sock
+        self.reuse_port = reuse_port
+        self.loop = None
+        self.stop_event = None
+        self.running = False
+        self.connection_count = 0
+        self.active_connections = 0
+        self.peak_connections = 0
+        self.cluster_stats = cluster_stats
+        
+    def start(self):
+        """Start the file server and run the event loop until stopped"""
+        
+        # Create server files directory if it doesn't exist
+        if not os.path.exists(FILES_DIRECTORY):
+            os.makedirs(FILES_DIRECTORY)
+            log.info(f"Created directory: {FILES_DIRECTORY}")
+        
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            log.info("Shutting down server...")
+        except Exception as e:
+            log.error(f"Error starting server: {str(e)}")
+            sys.exit(1)
+        finally:
+            self.running = False
+            log.info("Server stopped")
+    
+    async def serve(self):
+        """Listen for clients until stop() is called"""
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        raise_open_file_limit()
+        
+        if self.sock is not None:
+            server = await asyncio.start_server(self.handle_client, sock=self.sock, backlog=self.backlog)
+        else:
+            server = await asyncio.start_server(self.handle_client, self.host, self.port, backlog=self.backlog,
+                                                reuse_address=True, reuse_port=self.reuse_port or None)
+        self.running = True
+        log.info(f"File Server started on {self.host}:{self.port} (asyncio engine)")
+        log.info(f"Serving files from: {os.path.abspath(FILES_DIRECTORY)}")
+        log.info(f"Buffer size: {BUFFER_SIZE} bytes")
+        log.info(f"Bandwidth: {bandwidth_manager.describe()}")
+        log.info(f"Zero-copy sendfile: {'on' if USE_SENDFILE else 'off'}")
+        log.info(f"Hot file cache: {file_cache.describe()}")
+        log.info(f"Memory-mapped files: {shared_mappings.describe()}")
+        log.info("Waiting for client connections...")
+        
+        async with server:
+            await self.stop_event.wait()
+    
+    def stop(self):
+        """Stop the file server (safe to call from any thread)"""
+        if self.loop and self.stop_event:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+    
+    def get_stats(self):
+        """Return a snapshot of the server counters"""
+        return {
+            'mode': 'asyncio',
+            'connections': self.connection_count,
+            'active_connections': self.active_connections,
+            'peak_connections': self.peak_connections,
+            **{f"reaped_{reason}": metrics.registry.total(connections_reaped, (reason,)) for reason in REAP_REASONS},
+            **file_cache.get_stats(),
+            **shared_mappings.get_stats(),
+            **compression.variant_cache.get_stats(),
+            **content_store.get_stats()
+        }
+    
+    def stats_report(self):
+        """Return the OP_STATS answer: this server's counters and metrics, or the whole pre-forked server's"""
+        report = self.cluster_stats() if self.cluster_stats else None
+        return report or stats_report(self.get_stats())
+    
+    async def handle_client(self, reader, writer):
+        """
+        Handle a single client connection in either protocol dialect
+        
+        Args:
+            reader: StreamReader for the client connection
+            writer: StreamWriter for the client connection
+        """
+        client_address = writer.get_extra_info('peername')
+        self.connection_count += 1
+        self.active_connections += 1
+        self.peak_connections = max(self.peak_connections, self.active_connections)
+        open_connections.inc()
+        name = f"Conn-{self.connection_count}"
+        conn_log = logs.tagged('connection', name)
+        
+        log.debug(f"New connection from {client_address}")
+        
+        try:
+            # Receive the request: a protocol frame, or a bare filename from legacy clients
+            try:
+                request_data = await asyncio.wait_for(read_first_request(reader), HANDSHAKE_TIMEOUT or None)
+            except asyncio.TimeoutError:
+                raise ClientStalled('handshake', f"no request within {HANDSHAKE_TIMEOUT} seconds") from None
+            
+            if protocol.is_framed(request_data):
+                connections_total.inc('framed')
+                await self.serve_framed(reader, writer, request_data, client_address, conn_log)
+                return
+            
+            filename = request_data.decode('utf-8', errors='replace').strip()
+            if not filename:
+                log.warning(f"No filename received from {client_address}")
+                return
+            connections_total.inc('legacy')
+            started = time.monotonic()
+            try:
+                await within_deadline(self.serve_legacy(reader, writer, filename, client_address, conn_log))
+            finally:
+                requests_total.inc('legacy')
+                request_seconds.observe(time.monotonic() - started, 'legacy')
+            
+        except asyncio.CancelledError:
+            # The loop is shutting down; end the handler quietly
+            conn_log.debug("Transfer cancelled by server shutdown")
+            
+        except ClientStalled as e:
+            connections_reaped.inc(e.reason)
+            conn_log.warning(f"Closing connection from {client_address}: {str(e)}")
+            
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            conn_log.warning(f"Connection lost: {str(e)}")
+            errors_total.inc('connection', 'connection_lost')
+            
+        except Exception as e:
+            # Legacy sessions only: serve_framed answers its own errors in frames
+            error_message = f"ERROR: {str(e)}"
+            try:
+                writer.write(error_message.encode('utf-8'))
+                await drain(writer)
+            except Exception:
+                pass
+            conn_log.error(f"Error: {str(e)}")
+            errors_total.inc('connection', 'error')
+            
+        finally:
+            self.active_connections -= 1
+            open_connections.dec()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+            conn_log.debug(f"Connection closed with {client_address}")
+    
+    async def serve_legacy(self, reader, writer, filename, client_address, conn_log):
+        """
+        Serve a FILESIZE/READY/EOF request - mirrors FileServerThread.run
+        
+        Args:
+            reader: StreamReader for the client connection
+            writer: StreamWriter for the client connection
+            filename: Name of the file requested by the client
+            client_address: Client address tuple
+            conn_log: Logger tagged with the connection's label
+        """
+        conn_log.debug(f"Requested file: {filename}")
+        file_path = os.path.join(FILES_DIRECTORY, filename)
+        
+        # Open the file (from memory if it is in the hot file cache)
+        try:
+            file, st = await self.loop.run_in_executor(None, file_cache.open, file_path)
+        except OSError:
+            error_message = f"ERROR: File '{filename}' not found on server"
+            writer.write(error_message.encode('utf-8'))
+            await drain(writer)
+            conn_log.info(f"File not found: {filename}")
+            errors_total.inc('legacy', 'not_found')
+            return
+        
+        with file:
+            # Send file size first and wait for acknowledgment
+            file_size = st.st_size
+            writer.write(f"FILESIZE:{file_size}".encode('utf-8'))
+            await drain(writer)
+            
+            ack = (await idle_wait(reader.read(1024))).decode('utf-8')
+            if ack != "READY":
+                conn_log.warning("Client not ready")
+                return
+            
+            conn_log.debug(f"Starting file transfer ({file_size} bytes)")
+            
+            # Send the file in chunks; drain() suspends this coroutine, not a thread,
+            # while the client's receive window is full
+            with bandwidth_manager.open_transfer(client_address, filename) as transfer, \
+                    logs.TransferLog(conn_log, 'Sent', filename, file_size, client_address) as progress:
+                await self.send_file_body(writer, file, file_size, transfer, progress)
+        
+        # Send completion signal
+        writer.write(b"EOF")
+        await drain(writer)
+    
+    async def serve_framed(self, reader, writer, request_data, client_address, conn_log):
+        """
+        Serve framed protocol requests until the client disconnects - mirrors FramedSessionThread.run
+        
+        Args:
+            reader: StreamReader for the client connection
+            writer: StreamWriter for the client connection
+            request_data: Bytes already read (start of the first frame)
+            client_address: Client address tuple
+            conn_log: Logger tagged with the connection's label
+        """
+        frames = protocol.StreamFrameReader(reader, request_data)
+        try:
+            while True:
+                # Wait for the next (possibly already pipelined) request
+                try:
+                    message = await asyncio.wait_for(frames.read_message(allow_eof=True),
+                                                     KEEPALIVE_TIMEOUT or None)
+                except asyncio.TimeoutError:
+                    conn_log.debug("Closing idle session")
+                    break
+                if message is None:
+                    break
+                
+                header, request = message
+                await within_deadline(self.handle_request(frames, writer, header, request, client_address, conn_log))
+            
+        except protocol.ProtocolError as e:
+            conn_log.warning(f"Bad request: {str(e)}")
+            await send_error(writer, protocol.OP_ERROR, protocol.STATUS_BAD_REQUEST, str(e))
+            
+        except (ClientStalled, ConnectionError, asyncio.IncompleteReadError):
+            # Handled by handle_client; nothing more can be sent
+            raise
+            
+        except Exception as e:
+            # Answer in frames: a raw "ERROR:" line would corrupt the client's frame stream
+            conn_log.error(f"Error: {str(e)}")
+            try:
+                await send_error(writer, protocol.OP_ERROR, protocol.STATUS_ERROR, str(e))
+            except Exception:
+                pass
+    
+    async def handle_request(self, frames, writer, header, request, client_address, conn_log):
+        """
+        Dispatch one request frame to its handler - mirrors FramedSessionThread.handle_request
+        
+        Args:
+            frames: protocol.StreamFrameReader for the client connection
+            writer: StreamWriter for the client connection
+            header: protocol.Header of the request
+            request: Decoded request fields
+            client_address: Client address tuple
+            conn_log: Logger tagged with the connection's label
+        """
+        operation = protocol.OPERATION_NAMES.get(header.opcode, 'unknown')
+        started = time.monotonic()
+        try:
+            if header.opcode == protocol.OP_GET:
+                await self.handle_get(writer, request, client_address, conn_log)
+            elif header.opcode == protocol.OP_PUT:
+                await self.handle_put(frames, writer, request, conn_log)
+            elif header.opcode == protocol.OP_ARCHIVE:
+                await self.handle_archive(writer, request, client_address, conn_log)
+            elif header.opcode == protocol.OP_PING:
+                writer.write(protocol.pack_message(
+                    protocol.OP_PING, {'version': protocol.PROTOCOL_VERSION}))
+                await drain(writer)
+            elif header.opcode == protocol.OP_STATS:
+                # Summing the shards (or asking the pre-fork supervisor) may block; keep it off the event loop
+                report = await self.loop.run_in_executor(None, self.stats_report)
+                writer.write(protocol.pack_message(protocol.OP_STATS, report))
+                await drain(writer)
+            else:
+                await send_error(writer, header.opcode, protocol.STATUS_UNSUPPORTED,
+                                 f"Unsupported operation: {header.opcode}")
+        finally:
+            requests_total.inc(operation)
+            request_seconds.observe(time.monotonic() - started, operation)
+    
+    async def handle_get(self, writer, request, client_address, conn_log):
+        """
+        Answer a GET request: a response header, then the requested bytes as one OP_DATA frame
+        (or as several, if they are sent compressed)
+        
+        Args:
+            writer: StreamWriter for the client connection
+            request: Decoded request fields ('name', optional range fields - see select_range,
+                optional 'accept_encoding' - see compression.choose_encoding, optional 'if_none_match')
+            client_address: Client address tuple
+            conn_log: Logger tagged with the connection's label
+        """
+        filename = request.get('name')
+        conn_log.debug(f"Requested file: {filename}")
+        
+        file_path = resolve_file_path(filename)
+        if file_path is None:
+            await send_error(writer, protocol.OP_GET, protocol.STATUS_BAD_REQUEST,
+                             f"Invalid file name: {filename!r}")
+            return
+        
+        try:
+            # A cache miss reads the file; keep it off the event loop
+            file, st = await self.loop.run_in_executor(None, file_cache.open, file_path)
+        except OSError:
+            await send_error(writer, protocol.OP_GET, protocol.STATUS_NOT_FOUND,
+                             f"File '{filename}' not found on server")
+            conn_log.info(f"File not found: {filename}")
+            return
+        
+        with file:
+            if 'if_none_match' in request:
+                # Hashing reads the file; keep it off the event loop
+                digest = await self.loop.run_in_executor(None, content_hash, request, file_path, file, st)
+            else:
+                digest = content_hash(request, file_path, file, st)
+            if digest and digest == request.get('if_none_match'):
+                writer.write(protocol.pack_message(
+                    protocol.OP_GET, {'name': filename, 'size': st.st_size, 'sha256': digest},
+                    protocol.STATUS_NOT_MODIFIED))
+                await drain(writer)
+                conn_log.info(f"Client copy of {filename} is current")
+                return
+            
+            if 'prefix_crc32' in request:
+                # Verifying a resumed download's prefix reads the file; keep it off the event loop
+                selection = await self.loop.run_in_executor(None, select_range, request, file_path, file, st)
+            else:
+                selection = select_range(request, file_path, file, st)
+            status, offset, length = selection
+            if status != protocol.STATUS_OK:
+                await send_error(writer, protocol.OP_GET, status,
+                                 f"Invalid range requested for '{filename}'", size=st.st_size)
+                return
+            
+            response = {'name': filename, 'size': st.st_size, 'offset': offset, 'length': length,
+                        'version': version_tag(st)}
+            if digest:
+                response['sha256'] = digest
+            encoding = None
+            if request.get('accept_encoding'):
+                # Sampling the file reads it; keep it off the event loop
+                encoding = await self.loop.run_in_executor(None, compression.choose_encoding, filename, length,
+                                                           request.get('accept_encoding'), file, offset)
+            variant = None
+            if encoding and compression.variant_cache.cacheable(st, offset, length):
+                # A cache miss compresses the whole file; keep it off the event loop
+                variant = await self.loop.run_in_executor(None, compression.variant_cache.get,
+                                                          file_path, st, file, encoding)
+                if variant is None:
+                    # Compressed, the file would be no smaller
+                    encoding = None
+            
+            checksum = None
+            if VERIFY_CHECKSUMS and not encoding:
+                # Hashing reads the file; keep it off the event loop
+                checksum = await self.loop.run_in_executor(None, checksum_cache.crc32_range,
+                                                           file_path, st, file, offset, length)
+            
+            with bandwidth_manager.open_transfer(client_address, filename) as transfer, \
+                    logs.TransferLog(conn_log, 'Sent', filename, None if encoding else length,
+                                     client_address) as progress:
+                if encoding:
+                    conn_log.debug(f"Starting {encoding} compressed transfer "
+                                   f"(bytes {offset}-{offset + length} of {st.st_size})")
+                    await self.send_compressed(writer, file, response, encoding, transfer, progress, variant)
+                else:
+                    writer.write(protocol.pack_message(protocol.OP_GET, response))
+                    writer.write(protocol.pack_header(protocol.OP_DATA, length=length, checksum=checksum,
+                                                      flags=protocol.FLAG_END))
+                    
+                    if offset or length != st.st_size:
+                        conn_log.debug(f"Starting ranged transfer (bytes {offset}-{offset + length} of {st.st_size})")
+                    else:
+                        conn_log.debug(f"Starting file transfer ({length} bytes)")
+                    await self.send_file_body(writer, file, length, transfer, progress, offset)
+    
+    async def send_compressed(self, writer, file, response, encoding, transfer, progress, variant=None):
+        """
+        Send the response header and the selected range compressed with `encoding` - mirrors
+        FramedSessionThread.send_compressed
+        
+        Args:
+            writer: StreamWriter for the client connection
+            file: Open binary file object
+            response: Response header fields ('offset' and 'length' select the range)
+            encoding: Codec name (see compression.py)
+            transfer: rate_limiter.Transfer pacing this download
+            progress: logs.TransferLog counting the bytes sent
+            variant: (compressed bytes, CRC32) from the variant cache, or None to compress the range
+            
+        Returns:
+            Number of compressed bytes sent
+        """
+        response = dict(response, encoding=encoding)
+        offset, length = response['offset'], response['length']
+        
+        if variant:
+            data, crc = variant
+            writer.write(protocol.pack_message(protocol.OP_GET, response))
+            writer.write(protocol.pack_header(protocol.OP_DATA, length=len(data),
+                                              checksum=crc if VERIFY_CHECKSUMS else None,
+                                              flags=protocol.FLAG_END))
+            return await self.send_from_memory(writer, data, len(data), transfer, progress)
+        
+        writer.write(protocol.pack_message(protocol.OP_GET, response))
+        return await self.send_frames(writer, compression.compress_range(file, offset, length, encoding),
+                                      transfer, progress)
+    
+    async def handle_archive(self, writer, request, client_address, conn_log):
+        """
+        Answer an ARCHIVE request - mirrors FramedSessionThread.handle_archive
+        
+        Args:
+            writer: StreamWriter for the client connection
+            request: Decoded request fields (see archive.parse_request)
+            client_address: Client address tuple
+            conn_log: Logger tagged with the connection's label
+        """
+        try:
+            # Listing and stat()ing the files touches the disk; keep it off the event loop
+            archive_format, compress, files, missing = await self.loop.run_in_executor(
+                None, archive.parse_request, request)
+        except archive.ArchiveError as e:
+            await send_error(writer, protocol.OP_ARCHIVE, protocol.STATUS_BAD_REQUEST, str(e))
+            return
+        except OSError as e:
+            await send_error(writer, protocol.OP_ARCHIVE, protocol.STATUS_ERROR, str(e))
+            return
+        if missing or not files:
+            await send_error(writer, protocol.OP_ARCHIVE, protocol.STATUS_NOT_FOUND,
+                             f"Files not found on server: {', '.join(missing)}" if missing else "No files match")
+            return
+        
+        filename = archive.archive_name(archive_format, compress)
+        total = sum(st.st_size for _, _, st in files)
+        conn_log.debug(f"Streaming {filename} of {len(files)} files ({total} bytes)")
+        
+        with bandwidth_manager.open_transfer(client_address, filename) as transfer, \
+                logs.TransferLog(conn_log, 'Sent', filename, None, client_address) as progress:
+            writer.write(protocol.pack_message(protocol.OP_ARCHIVE, {
+                'format': archive_format, 'compress': compress,
+                'files': [file_name for file_name, _, _ in files], 'size': total}))
+            await self.send_frames(writer, archive.stream_archive(files, archive_format, compress),
+                                   transfer, progress)
+    
+    async def send_frames(self, writer, frames, transfer, progress):
+        """
+        Send a body whose length is not known up front as a series of OP_DATA frames
+        
+        Args:
+            writer: StreamWriter for the client connection
+            frames: Iterator of (bytes, is_last) tuples; the last one is flagged FLAG_END
+            transfer: rate_limiter.Transfer pacing this download
+            progress: logs.TransferLog counting the bytes sent
+            
+        Returns:
+            Number of bytes sent
+        """
+        bytes_sent = 0
+        is_last = False
+        while not is_last:
+            # Each step reads (and compresses) file data; keep it off the event loop
+            data, is_last = await self.loop.run_in_executor(None, next, frames)
+            writer.write(protocol.pack_header(protocol.OP_DATA, length=len(data),
+                                              checksum=zlib.crc32(data) if VERIFY_CHECKSUMS else None,
+                                              flags=protocol.FLAG_END if is_last else 0))
+            bytes_sent += await self.send_from_memory(writer, data, len(data), transfer, progress)
+        return bytes_sent
+    
+    async def handle_put(self, frames, writer, request, conn_log):
+        """
+        Answer a PUT request: store the OP_DATA frames that follow it as a file - mirrors
+        FramedSessionThread.handle_put
+        
+        Args:
+            frames: protocol.StreamFrameReader for the client connection
+            writer: StreamWriter for the client connection
+            request: Decoded request fields ('name', optional 'size')
+            conn_log: Logger tagged with the connection's label
+        """
+        filename = request.get('name')
+        conn_log.debug(f"Receiving upload: {filename}")
+        
+        upload, error = open_upload(request)
+        progress = logs.TransferLog(conn_log, 'Received', filename, request.get('size'))
+        try:
+            checksum_ok = True
+            while True:
+                header = await idle_wait(frames.read_header())
+                if header.opcode != protocol.OP_DATA:
+                    raise protocol.ProtocolError(f"Expected data frame, got opcode {header.opcode}")
+                
+                remaining, crc = header.length, 0
+                while remaining:
+                    chunk = await idle_wait(frames.read_some(min(65536, remaining)))
+                    if not chunk:
+                        raise ConnectionError("Connection closed during upload")
+                    crc = zlib.crc32(chunk, crc)
+                    remaining -= len(chunk)
+                    progress.update(len(chunk))
+                    if upload:
+                        upload.write(chunk)
+                
+                if header.flags & protocol.FLAG_CHECKSUM and crc != header.checksum:
+                    checksum_ok = False
+                if header.flags & protocol.FLAG_END:
+                    break
+        except BaseException:
+            if upload:
+                upload.abort()
+            progress.finish('failed')
+            raise
+        
+        # Committing fsyncs the file; keep it off the event loop
+        status, fields = await self.loop.run_in_executor(None, finish_upload, upload, error, request, checksum_ok)
+        writer.write(protocol.pack_message(protocol.OP_PUT, fields, status))
+        await drain(writer)
+        progress.finish('stored' if status == protocol.STATUS_OK else 'rejected')
+    
+    async def send_file_body(self, writer, file, length, transfer, progress, offset=0):
+        """
+        Send part of an open file, picking the fastest path that applies
+        
+        Args:
+            writer: StreamWriter for the client connection
+            file: Open binary file object
+            length: Number of bytes to send
+            transfer: rate_limiter.Transfer pacing this download
+            progress: logs.TransferLog counting the bytes sent
+            offset: Position in the file of the first byte to send
+            
+        Returns:
+            Number of bytes sent
+        """
+        if isinstance(file, CachedFile):
+            return await self.send_from_memory(writer, file.data, length, transfer, progress, offset)
+        st = os.fstat(file.fileno())
+        if shared_mappings.should_map(st):
+            with shared_mappings.map(file, st) as data:
+                return await self.send_from_memory(writer, data, length, transfer, progress, offset)
+        if USE_SENDFILE and stat.S_ISREG(st.st_mode):
+            return await self.send_zero_copy(writer, file, length, transfer, progress, offset)
+        return await self.send_buffered(writer, file, length, transfer, progress, offset)
+    
+    async def send_from_memory(self, writer, data, length, transfer, progress, offset=0):
+        """
+        Send file contents held in memory (a cached copy or a shared mapping) as slices, without copying
+        
+        Args:
+            writer: StreamWriter for the client connection
+            data: File contents (bytes or mmap)
+            length: Number of bytes to send
+            transfer: rate_limiter.Transfer pacing this download
+            progress: logs.TransferLog counting the bytes sent
+            offset: Position in the file of the first byte to send
+            
+        Returns:
+            Number of bytes sent
+        """
+        view = memoryview(data)[offset:offset + length]
+        if not transfer.limited:
+            # Written in slices: drain() after one write of everything would have to
+            # wait for all of it, which a slow but live client could not do within IDLE_TIMEOUT
+            for start in range(0, len(view), MEMORY_SLICE):
+                writer.write(view[start:start + MEMORY_SLICE])
+                await drain(writer)
+            progress.update(len(view))
+            return len(view)
+        
+        bytes_sent = 0
+        while bytes_sent < len(view):
+            chunk = view[bytes_sent:bytes_sent + transfer.chunk_size()]
+            await pace(transfer, len(chunk))
+            writer.write(chunk)
+            await drain(writer)
+            bytes_sent += len(chunk)
+            progress.update(len(chunk))
+        return bytes_sent
+    
+    async def send_zero_copy(self, writer, file, length, transfer, progress, offset=0):
+        """
+        Send a regular file with loop.sendfile (os.sendfile where the loop supports it)
+        
+        Args:
+            writer: StreamWriter for the client connection
+            file: Open binary file object
+            length: Number of bytes to send
+            transfer: rate_limiter.Transfer pacing this download
+            progress: logs.TransferLog counting the bytes sent
+            offset: Position in the file of the first byte to send
+            
+        Returns:
+            Number of bytes sent
+        """
+        await drain(writer)
+        if not length:
+            return 0
+        
+        if not transfer.limited:
+            bytes_sent = await self.loop.sendfile(writer.transport, file, offset, length)
+            progress.update(bytes_sent)
+            return bytes_sent
+        
+        bytes_sent = 0
+        while bytes_sent < length:
+            count = min(transfer.chunk_size(), length - bytes_sent)
+            await pace(transfer, count)
+            sent = await self.loop.sendfile(writer.transport, file, offset + bytes_sent, count)
+            if not sent:
+                break
+            bytes_sent += sent
+            progress.update(sent)
+        return bytes_sent
+    
+    async def send_buffered(self, writer, file, length, transfer, progress, offset=0):
+        """
+        Send a file by reading it in BUFFER_SIZE chunks
+        
+        Args:
+            writer: StreamWriter for the client connection
+            file: Open binary file object
+            length: Number of bytes to send (the size reported for the file)
+            transfer: rate_limiter.Transfer pacing this download
+            progress: logs.TransferLog counting the bytes sent
+            offset: Position in the file of the first byte to send
+            
+        Returns:
+            Number of bytes sent
+        """
+        if offset:
+            file.seek(offset)
+        
+        bytes_sent = 0
+        while bytes_sent < length:
+            chunk = file.read(min(BUFFER_SIZE, length - bytes_sent))
+            if not chunk:
+                break
+            
+            await pace(transfer, len(chunk))
+            writer.write(chunk)
+            await drain(writer)
+            bytes_sent += len(chunk)
+            progress.update(len(chunk))
+        return bytes_sent
+
+
+async def send_error(writer, opcode, status, message, **fields):
+    """
+    Send an error response frame
+    
+    Args:
+        writer: StreamWriter for the client connection
+        opcode: Opcode of the request being answered (OP_ERROR if unknown)
+        status: STATUS_* code
+        message: Human readable description
+        **fields: Extra response fields
+    """
+    errors_total.inc(protocol.OPERATION_NAMES.get(opcode, 'unknown'), protocol.STATUS_NAMES.get(status, 'unknown'))
+    fields['message'] = message
+    writer.write(protocol.pack_message(opcode, fields, status))
+    await drain(writer)
+
+
+async def read_first_request(reader):
+    """
+    Read from a new connection until its first request is complete (see protocol.request_complete)
+    
+    Args:
+        reader: StreamReader for the client connection
+        
+    Returns:
+        Bytes received, or b'' if the client closed the connection first
+    """
+    data = bytearray()
+    while not protocol.request_complete(data):
+        chunk = await reader.read(65536)
+        if not chunk:
+            return b''
+        data += chunk
+    return bytes(data)
+
+
+async def drain(writer):
+    """
+    Wait until the client has taken enough of the buffered data, giving up after IDLE_TIMEOUT seconds
+    
+    Args:
+        writer: StreamWriter for the client connection
+    """
+    transport = writer.transport
+    if not IDLE_TIMEOUT or transport.get_write_buffer_size() <= transport.get_write_buffer_limits()[1]:
+        # Below the high-water mark drain() does not wait for the client
+        await writer.drain()
+        return
+    await idle_wait(writer.drain())
+
+
+async def idle_wait(awaitable):
+    """
+    Await a read from or a drain to the client, giving up after IDLE_TIMEOUT seconds
+    
+    Args:
+        awaitable: Coroutine that waits for the client
+        
+    Returns:
+        The coroutine's result
+    """
+    try:
+        return await asyncio.wait_for(awaitable, IDLE_TIMEOUT or None)
+    except asyncio.TimeoutError:
+        raise ClientStalled('idle', f"no data moved for {IDLE_TIMEOUT} seconds") from None
+
+
+async def within_deadline(awaitable):
+    """
+    Await a whole request, cancelling it if it takes longer than TRANSFER_TIMEOUT seconds
+    
+    Args:
+        awaitable: Coroutine serving the request
+    """
+    try:
+        return await asyncio.wait_for(awaitable, TRANSFER_TIMEOUT or None)
+    except asyncio.TimeoutError:
+        raise ClientStalled('deadline', f"request still running after {TRANSFER_TIMEOUT} seconds") from None
+
+
+async def pace(transfer, amount):
+    """
+    Suspend the calling coroutine until `amount` bytes may be sent
+    
+    Args:
+        transfer: rate_limiter.Transfer pacing the download
+        amount: Number of bytes about to be sent
+    """
+    delay = transfer.reserve(amount)
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+def raise_open_file_limit():
+    """Raise the soft open-file limit to the hard limit so many sockets can stay open"""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            log.info(f"Raised open file limit from {soft} to {hard}")
+    except (ValueError, OSError) as e:
+        log.warning(f"Could not raise open file limit: {str(e)}")
+
+
+def main():
+    """Main function to start the asyncio server"""
+    server = AsyncFileServer()
+    server.start()
+
+
+if __name__ == "__main__":
+    main()
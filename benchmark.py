@@ -0,0 +1,697 @@
+"""
+Benchmark - load generator for the file server, the client and the web interface
+Starts the file server (and, when the mix includes 'web' requests, the web
+interface) as child processes on the configured ports, creates test files of
+the requested sizes, then drives a mix of operations from many concurrent
+client threads for a fixed time. It reports throughput, latency and
+time-to-first-byte percentiles per operation together with the CPU time and
+memory of every process involved, as a table and optionally as JSON, so runs
+can be compared across versions and configurations:
+
+    python3 benchmark.py --engine asyncio --connections 64 --json base.json
+    python3 benchmark.py --engine asyncio --connections 64 --compare base.json
+
+Operations:
+    get     Framed download (FileSession.request_file), body discarded
+    put     Framed upload (FileSession.send_file) of one of the test files
+    legacy  FILESIZE/READY/EOF download through FileClient
+    web     HTTP download through the web interface's /api/stream relay
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from config import (SERVER_HOST, SERVER_PORT, WEB_HOST, WEB_PORT, FILES_DIRECTORY, BUFFER_SIZE,
+                    USE_SENDFILE, SERVER_ENGINE, SERVER_MODE, WORKER_POOL_SIZE, FILE_CACHE_SIZE,
+                    MMAP_MODE, VERIFY_CHECKSUMS, GLOBAL_BANDWIDTH_LIMIT)
+from file_client import FileClient, FileSession
+import compression
+import logs
+import protocol
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Operations a mix can contain
+OPERATIONS = ('get', 'put', 'legacy', 'web')
+
+# Test files are created in FILES_DIRECTORY with this prefix (and removed afterwards)
+FILE_PREFIX = 'bench-'
+
+# Version of the JSON result layout
+RESULT_VERSION = 1
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    """Parse a size such as '4096', '64K' or '8M' into bytes"""
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def parse_weights(text, parse_key=str):
+    """
+    Parse a weighted list such as 'get:8,put:2' (a missing weight counts as 1)
+    
+    Returns:
+        List of (key, weight) tuples
+    """
+    weights = []
+    for item in text.split(','):
+        key, _, weight = item.strip().partition(':')
+        weights.append((parse_key(key), float(weight or 1)))
+    if not weights or any(weight < 0 for _, weight in weights) or not sum(weight for _, weight in weights):
+        raise argparse.ArgumentTypeError(f"Invalid weights: {text!r}")
+    return weights
+
+
+def percentiles(values):
+    """
+    Summarize a list of durations (seconds)
+    
+    Returns:
+        Dictionary of mean, p50, p90, p99 and max in milliseconds, or None for no values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    
+    def rank(p):
+        return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+    
+    return {
+        'mean': round(sum(values) / len(values) * 1000, 3),
+        'p50': round(rank(50) * 1000, 3),
+        'p90': round(rank(90) * 1000, 3),
+        'p99': round(rank(99) * 1000, 3),
+        'max': round(values[-1] * 1000, 3)
+    }
+
+
+def process_tree_usage(pid, children=True):
+    """
+    Return the CPU time and resident memory of a process and (optionally) its descendants
+    
+    Uses psutil when it is installed, /proc otherwise (Linux).
+    
+    Args:
+        pid: Root process
+        children: Include the root's descendants
+    
+    Returns:
+        Dictionary of pid -> (CPU seconds, RSS bytes); empty if it cannot be measured
+    """
+    if psutil is not None:
+        try:
+            root = psutil.Process(pid)
+            usage = {}
+            for process in [root] + (root.children(recursive=True) if children else []):
+                try:
+                    times = process.cpu_times()
+                    usage[process.pid] = (times.user + times.system, process.memory_info().rss)
+                except psutil.Error:
+                    pass
+            return usage
+        except psutil.Error:
+            return {}
+    
+    if not os.path.isdir('/proc'):
+        return {}
+    ticks, page_size = os.sysconf('SC_CLK_TCK'), os.sysconf('SC_PAGE_SIZE')
+    stats = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rpartition(')')[2].split()
+        except OSError:
+            continue
+        # Fields after the command name start at 'state' (field 3 in proc(5))
+        stats[int(entry)] = (int(fields[1]), (int(fields[11]) + int(fields[12])) / ticks,
+                             int(fields[21]) * page_size)
+    
+    usage, pending = {}, [pid]
+    while pending:
+        current = pending.pop()
+        if current in stats and current not in usage:
+            usage[current] = stats[current][1:]
+            if children:
+                    pending.extend(child for child, (ppid, _, _) in stats.items() if ppid == current)
+    return usage
+
+
+class ResourceMonitor(threading.Thread):
+    """Samples the CPU time and memory of a process tree while the benchmark runs"""
+    
+    def __init__(self, pid, children=True, interval=0.25):
+        """
+        Initialize the monitor
+        
+        Args:
+            pid: Root process to measure
+            children: Include the root's descendants (e.g. pre-forked server processes)
+            interval: Seconds between samples
+        """
+        threading.Thread.__init__(self, name=f"Monitor-{pid}", daemon=True)
+        self.pid = pid
+        self.children = children
+        self.interval = interval
+        self.start_cpu = {}
+        self.last_cpu = {}
+        self.rss_samples = []
+        self.started = None
+        self.stopped = None
+        self.done = threading.Event()
+    
+    def sample(self):
+        """Record one sample"""
+        usage = process_tree_usage(self.pid, self.children)
+        for pid, (cpu, _) in usage.items():
+            # Processes started during the run (e.g. restarted workers) count from zero
+            self.start_cpu.setdefault(pid, cpu if self.started is None else 0.0)
+            self.last_cpu[pid] = cpu
+        if usage:
+            self.rss_samples.append(sum(rss for _, rss in usage.values()))
+    
+    def run(self):
+        """Sample until stop() is called"""
+        while not self.done.wait(self.interval):
+            self.sample()
+    
+    def begin(self):
+        """Take the baseline sample and start sampling"""
+        self.sample()
+        self.started = time.monotonic()
+        self.start()
+    
+    def stop(self):
+        """Take the final sample and stop sampling"""
+        self.done.set()
+        self.join()
+        self.sample()
+        self.stopped = time.monotonic()
+    
+    def result(self):
+        """Return CPU seconds, CPU utilisation and RSS of the tree, or None if nothing was measured"""
+        if not self.rss_samples:
+            return None
+        cpu = sum(self.last_cpu[pid] - self.start_cpu[pid] for pid in self.last_cpu)
+        elapsed = (self.stopped or time.monotonic()) - self.started
+        return {
+            'processes': len(self.last_cpu),
+            'cpu_seconds': round(cpu, 3),
+            'cpu_percent': round(cpu / elapsed * 100, 1) if elapsed > 0 else None,
+            'rss_peak_bytes': max(self.rss_samples),
+            'rss_mean_bytes': int(sum(self.rss_samples) / len(self.rss_samples))
+        }
+
+
+class Worker(threading.Thread):
+    """One simulated client: runs operations back to back until the deadline"""
+    
+    def __init__(self, index, bench):
+        """
+        Initialize the worker
+        
+        Args:
+            index: Worker number
+            bench: Benchmark being run
+        """
+        threading.Thread.__init__(self, name=f"Bench-{index}", daemon=True)
+        self.index = index
+        self.bench = bench
+        self.random = random.Random(bench.args.seed * 1000 + index)
+        self.session = None
+        self.records = []
+    
+    def run(self):
+        """Pick and time operations until the benchmark's deadline"""
+        bench = self.bench
+        operations, weights = zip(*bench.args.mix)
+        files, file_weights = zip(*bench.files)
+        while time.monotonic() < bench.deadline:
+            operation = self.random.choices(operations, weights)[0]
+            name, size = self.random.choices(files, file_weights)[0]
+            started = time.monotonic()
+            try:
+                count, ttfb = getattr(self, f"op_{operation}")(name, size)
+                error = None
+            except Exception as e:
+                count, ttfb, error = 0, None, f"{type(e).__name__}: {str(e)}"[:200]
+                self.close_session()
+            if started >= bench.measure_from:
+                self.records.append((operation, time.monotonic() - started, ttfb, count, error))
+        self.close_session()
+    
+    def get_session(self):
+        """Return the worker's framed session, connecting if there is none"""
+        if self.session is None:
+            self.session = FileSession(self.bench.host, self.bench.port)
+        return self.session
+    
+    def release_session(self):
+        """Keep the session for the next request, or close it without keep-alive"""
+        if not self.bench.args.keepalive:
+            self.close_session()
+    
+    def close_session(self):
+        """Close the worker's framed session, if any"""
+        if self.session is not None:
+            try:
+                self.session.close()
+            except OSError:
+                pass
+            self.session = None
+    
+    def op_get(self, name, size):
+        """Framed download; returns (bytes received, time to first byte)"""
+        started = time.monotonic()
+        session = self.get_session()
+        accept_encoding = compression.supported_encodings() if self.bench.args.compress else None
+        session.request_file(name, accept_encoding=accept_encoding)
+        header, response = session.read_response()
+        if header.status != protocol.STATUS_OK:
+            raise protocol.ProtocolError(response.get('message', f"status {header.status}"))
+        count, ttfb = 0, None
+        for chunk in session.iter_body(response.get('length', response['size']), response.get('encoding')):
+            if ttfb is None:
+                ttfb = time.monotonic() - started
+            count += len(chunk)
+        self.release_session()
+        return count, ttfb
+    
+    def op_put(self, name, size):
+        """Framed upload of a test file; returns (bytes sent, None)"""
+        session = self.get_session()
+        with open(os.path.join(self.bench.files_directory, name), 'rb') as file:
+            session.send_file(f"{FILE_PREFIX}upload-{self.index}.bin", file, size, VERIFY_CHECKSUMS)
+        header, response = session.read_response()
+        if header.status != protocol.STATUS_OK:
+            raise protocol.ProtocolError(response.get('message', f"status {header.status}"))
+        self.release_session()
+        return size, None
+    
+    def op_legacy(self, name, size):
+        """Legacy protocol download through FileClient; returns (bytes received, None)"""
+        client = FileClient(self.bench.host, self.bench.port, protocol_mode='legacy')
+        result = client.download_file(name, os.path.join(self.bench.scratch, f"{self.index}-{name}"))
+        if result['status'] != 'success':
+            raise RuntimeError(result['message'])
+        return result['size'], None
+    
+    def op_web(self, name, size):
+        """HTTP download through the web interface; returns (bytes received, time to first byte)"""
+        started = time.monotonic()
+        connection = http.client.HTTPConnection(WEB_HOST, WEB_PORT, timeout=60)
+        try:
+            connection.request('GET', f"/api/stream/{urllib.parse.quote(name)}")
+            response = connection.getresponse()
+            if response.status != 200:
+                raise RuntimeError(f"HTTP {response.status}")
+            count, ttfb = 0, None
+            while True:
+                chunk = response.read1(65536)
+                if not chunk:
+                    break
+                if ttfb is None:
+                    ttfb = time.monotonic() - started
+                count += len(chunk)
+            return count, ttfb
+        finally:
+            connection.close()
+
+
+class Benchmark:
+    """Sets up the servers and test files, runs the workers and summarizes their records"""
+    
+    def __init__(self, args):
+        """
+        Initialize the benchmark
+        
+        Args:
+            args: Parsed command line arguments
+        """
+        self.args = args
+        self.host = SERVER_HOST
+        self.port = SERVER_PORT
+        self.files_directory = FILES_DIRECTORY
+        self.files = []
+        self.created = []
+        self.processes = []
+        self.monitors = {}
+        self.scratch = None
+        self.deadline = None
+        self.measure_from = None
+    
+    def run(self):
+        """
+        Run the benchmark
+        
+        Returns:
+            Result dictionary (see RESULT_VERSION)
+        """
+        self.scratch = tempfile.mkdtemp(prefix='bench-')
+        try:
+            self.create_files()
+            self.start_servers()
+            return self.measure()
+        finally:
+            self.stop_servers()
+            self.remove_files()
+            shutil.rmtree(self.scratch, ignore_errors=True)
+    
+    def create_files(self):
+        """Create one test file per size class (random bytes, so compression gains nothing)"""
+        os.makedirs(self.files_directory, exist_ok=True)
+        for size, weight in self.args.sizes:
+            name = f"{FILE_PREFIX}{size}.bin"
+            path = os.path.join(self.files_directory, name)
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                with open(path, 'wb') as f:
+                    remaining = size
+                    while remaining:
+                        block = os.urandom(min(remaining, 1024 * 1024))
+                        f.write(block)
+                        remaining -= len(block)
+                self.created.append(path)
+            self.files.append(((name, size), weight))
+    
+    def remove_files(self):
+        """Remove the test files and uploads"""
+        if self.args.keep_files:
+            return
+        paths = set(self.created)
+        paths.update(os.path.join(self.files_directory, name) for name in os.listdir(self.files_directory)
+                     if name.startswith(f"{FILE_PREFIX}upload-"))
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    def start_servers(self):
+        """Start the file server (and web interface) unless benchmarking already running ones"""
+        needs_web = any(operation == 'web' for operation, _ in self.args.mix)
+        if self.args.external:
+            return
+        
+        if port_open(self.host, self.port):
+            raise RuntimeError(f"Something is already listening on {self.host}:{self.port}; "
+                               f"stop it or pass --external to benchmark it")
+        command = [sys.executable, 'file_server.py', '--engine', self.args.engine, '--mode', self.args.mode,
+                   '--processes', str(self.args.processes)]
+        self.spawn('server', command, self.host, self.port)
+        
+        if needs_web:
+            if port_open(WEB_HOST, WEB_PORT):
+                raise RuntimeError(f"Something is already listening on {WEB_HOST}:{WEB_PORT}")
+            command = [sys.executable, '-m', 'flask', '--app', 'web_interface', 'run', '--host', WEB_HOST,
+                       '--port', str(WEB_PORT), '--no-reload', '--no-debugger', '--with-threads']
+            self.spawn('web', command, WEB_HOST, WEB_PORT)
+    
+    def spawn(self, role, command, host, port):
+        """Start a server process and wait until it accepts connections"""
+        output = open(self.args.server_log, 'ab') if self.args.server_log else subprocess.DEVNULL
+        process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stdout=output, stderr=subprocess.STDOUT)
+        self.processes.append(process)
+        deadline = time.monotonic() + 15
+        while not port_open(host, port):
+            if process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f"The {role} process did not start (see --server-log)")
+            time.sleep(0.1)
+        self.monitors[role] = ResourceMonitor(process.pid)
+    
+    def stop_servers(self):
+        """Stop the processes started by start_servers()"""
+        for process in self.processes:
+            if process.poll() is None:
+                # Like Ctrl+C: the pre-fork supervisor then stops its workers too
+                process.send_signal(signal.SIGINT if os.name == 'posix' else signal.SIGTERM)
+        for process in self.processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    
+    def measure(self):
+        """Run the workers and collect the results"""
+        args = self.args
+        workers = [Worker(i + 1, self) for i in range(args.connections)]
+        # The servers are children of this process; measure the client on its own
+        self.monitors['client'] = ResourceMonitor(os.getpid(), children=False)
+        
+        now = time.monotonic()
+        self.measure_from = now + args.warmup
+        self.deadline = self.measure_from + args.duration
+        for monitor in self.monitors.values():
+            monitor.begin()
+        for worker in workers:
+            worker.start()
+        # Restart the measurements once the warm-up is over
+        time.sleep(max(0.0, self.measure_from - time.monotonic()))
+        for role, monitor in list(self.monitors.items()):
+            monitor.stop()
+            self.monitors[role] = ResourceMonitor(monitor.pid, monitor.children)
+            self.monitors[role].begin()
+        for worker in workers:
+            worker.join()
+        elapsed = time.monotonic() - self.measure_from
+        for monitor in self.monitors.values():
+            monitor.stop()
+        
+        records = [record for worker in workers for record in worker.records]
+        return self.summarize(records, elapsed)
+    
+    def summarize(self, records, elapsed):
+        """Build the result dictionary from the workers' records"""
+        args = self.args
+        operations = {}
+        for operation in sorted({record[0] for record in records}):
+            selected = [record for record in records if record[0] == operation]
+            ok = [record for record in selected if record[4] is None]
+            count = sum(record[3] for record in ok)
+            errors = {}
+            for record in selected:
+                if record[4] is not None:
+                    errors[record[4]] = errors.get(record[4], 0) + 1
+            operations[operation] = {
+                'requests': len(selected),
+                'errors': len(selected) - len(ok),
+                'error_samples': dict(sorted(errors.items(), key=lambda item: -item[1])[:5]),
+                'bytes': count,
+                'requests_per_second': round(len(ok) / elapsed, 2),
+                'throughput_bytes_per_second': round(count / elapsed, 1),
+                'latency_ms': percentiles([record[1] for record in ok]),
+                'ttfb_ms': percentiles([record[2] for record in ok if record[2] is not None])
+            }
+        
+        ok = [record for record in records if record[4] is None]
+        return {
+            'version': RESULT_VERSION,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'scenario': {
+                'engine': args.engine,
+                'mode': args.mode,
+                'processes': args.processes,
+                'external': args.external,
+                'connections': args.connections,
+                'duration': args.duration,
+                'warmup': args.warmup,
+                'keepalive': args.keepalive,
+                'compress': args.compress,
+                'mix': dict(args.mix),
+                'sizes': {str(size): weight for size, weight in args.sizes},
+                'seed': args.seed
+            },
+            'config': {
+                'BUFFER_SIZE': BUFFER_SIZE,
+                'USE_SENDFILE': USE_SENDFILE,
+                'SERVER_ENGINE': SERVER_ENGINE,
+                'SERVER_MODE': SERVER_MODE,
+                'WORKER_POOL_SIZE': WORKER_POOL_SIZE,
+                'FILE_CACHE_SIZE': FILE_CACHE_SIZE,
+                'MMAP_MODE': MMAP_MODE,
+                'VERIFY_CHECKSUMS': VERIFY_CHECKSUMS,
+                'GLOBAL_BANDWIDTH_LIMIT': GLOBAL_BANDWIDTH_LIMIT
+            },
+            'elapsed': round(elapsed, 3),
+            'operations': operations,
+            'total': {
+                'requests': len(records),
+                'errors': len(records) - len(ok),
+                'bytes': sum(record[3] for record in ok),
+                'requests_per_second': round(len(ok) / elapsed, 2),
+                'throughput_bytes_per_second': round(sum(record[3] for record in ok) / elapsed, 1)
+            },
+            'resources': {role: monitor.result() for role, monitor in self.monitors.items()}
+        }
+
+
+def port_open(host, port):
+    """Check whether something accepts TCP connections on host:port"""
+    try:
+        with socket.create_connection((host, port), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+
+def git_commit():
+    """Return the current git commit of the working tree, or None outside a checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def format_bytes(count):
+    """Format a byte count in human-readable form"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if count < 1024:
+            return f"{count:.1f} {unit}"
+        count /= 1024
+    return f"{count:.1f} TB"
+
+
+def print_report(result):
+    """Print a result as a table"""
+    scenario = result['scenario']
+    print(f"Benchmark of {result['commit'] or 'working tree'}: {scenario['engine']} engine, "
+          f"{scenario['processes']} process(es), {scenario['connections']} connections, "
+          f"{'keep-alive' if scenario['keepalive'] else 'new connection per request'}, "
+          f"{result['elapsed']:.1f}s measured")
+    print(f"{'op':<8}{'req/s':>10}{'throughput':>14}{'errors':>8}"
+          f"{'p50 ms':>10}{'p99 ms':>10}{'ttfb p50':>10}{'ttfb p99':>10}")
+    for operation, stats in result['operations'].items():
+        latency, ttfb = stats['latency_ms'] or {}, stats['ttfb_ms'] or {}
+        print(f"{operation:<8}{stats['requests_per_second']:>10.1f}"
+              f"{format_bytes(stats['throughput_bytes_per_second']) + '/s':>14}{stats['errors']:>8}"
+              f"{latency.get('p50', '-'):>10}{latency.get('p99', '-'):>10}"
+              f"{ttfb.get('p50', '-'):>10}{ttfb.get('p99', '-'):>10}")
+        for error, count in stats['error_samples'].items():
+            print(f"    {count} x {error}")
+    for role, usage in result['resources'].items():
+        if usage:
+            print(f"{role:<8}cpu {usage['cpu_seconds']:.2f}s ({usage['cpu_percent']}%), "
+                  f"rss peak {format_bytes(usage['rss_peak_bytes'])}, {usage['processes']} process(es)")
+
+
+def compare(result, baseline, threshold):
+    """
+    Print how a result differs from a baseline and find regressions
+    
+    Args:
+        result: Result of this run
+        baseline: Result loaded from an earlier run's JSON
+        threshold: Relative change (e.g. 0.1 for 10%) that counts as a regression
+    
+    Returns:
+        List of regression descriptions
+    """
+    regressions = []
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'} ({baseline.get('timestamp')}):")
+    differences = [key for key, value in result['scenario'].items()
+                   if baseline.get('scenario', {}).get(key) != value]
+    if differences:
+        print(f"  (the runs used different settings: {', '.join(differences)})")
+    for operation, stats in result['operations'].items():
+        before = baseline.get('operations', {}).get(operation)
+        if not before:
+            continue
+        checks = [('throughput', before['throughput_bytes_per_second'], stats['throughput_bytes_per_second'], -1)]
+        for key in ('latency_ms', 'ttfb_ms'):
+            if before.get(key) and stats.get(key):
+                checks.append((f"{key[:-3]} p99", before[key]['p99'], stats[key]['p99'], 1))
+        for label, old, new, worse in checks:
+            change = (new - old) / old if old else 0.0
+            regressed = change * worse > threshold
+            print(f"  {operation:<8}{label:<14}{old:>14.1f} -> {new:<14.1f}{change * 100:+7.1f}%"
+                  f"{'  REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append(f"{operation} {label} {change * 100:+.1f}%")
+    return regressions
+
+
+def main():
+    """Parse arguments, run the benchmark and report the results"""
+    parser = argparse.ArgumentParser(description="File server benchmark")
+    parser.add_argument('--engine', choices=['threaded', 'asyncio'], default=SERVER_ENGINE)
+    parser.add_argument('--mode', choices=['thread', 'pool'], default=SERVER_MODE)
+    parser.add_argument('--processes', type=int, default=1, help="server processes (see file_server.py)")
+    parser.add_argument('--external', action='store_true',
+                        help="benchmark servers that are already running on the configured ports")
+    parser.add_argument('--connections', type=int, default=16, help="concurrent client threads")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds measured")
+    parser.add_argument('--warmup', type=float, default=2.0, help="seconds run before measuring")
+    parser.add_argument('--mix', type=lambda text: parse_weights(text), default='get',
+                        help="weighted operations, e.g. get:8,put:1,web:1 (of: " + ', '.join(OPERATIONS) + ")")
+    parser.add_argument('--sizes', type=lambda text: parse_weights(text, parse_size), default='4K:6,256K:3,8M:1',
+                        help="weighted file sizes, e.g. 4K:6,256K:3,8M:1")
+    parser.add_argument('--no-keepalive', dest='keepalive', action='store_false',
+                        help="open a new connection for every framed request")
+    parser.add_argument('--compress', action='store_true', help="let the server compress framed downloads")
+    parser.add_argument('--seed', type=int, default=1, help="seed for the operation and file choices")
+    parser.add_argument('--json', metavar='PATH', help="write the result as JSON ('-' for stdout)")
+    parser.add_argument('--compare', metavar='PATH', help="compare with the JSON result of an earlier run")
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help="percent change reported as a regression by --compare")
+    parser.add_argument('--server-log', metavar='PATH', help="append the servers' output to this file")
+    parser.add_argument('--keep-files', action='store_true', help="leave the test files in place")
+    args = parser.parse_args()
+    
+    for operation, _ in args.mix:
+        if operation not in OPERATIONS:
+            parser.error(f"Unknown operation {operation!r} in --mix")
+    
+    # Per-transfer summaries from the client library would flood the report
+    logging.getLogger(logs.ROOT_LOGGER).setLevel(logging.WARNING)
+    
+    try:
+        result = Benchmark(args).run()
+    except RuntimeError as e:
+        print(f"Benchmark failed: {str(e)}")
+        sys.exit(2)
+    
+    if args.json == '-':
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(result, f, indent=2)
+            print(f"Results written to {args.json}")
+    
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.threshold / 100)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.threshold}%")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+File Checksums - cached whole-file CRC32 values for the framed protocol
+Checksums are keyed by path and revalidated against the file's size and
+modification time, so each version of a file is only read once to hash it.
+Hashing a whole file also records the running CRC32 every CHECKPOINT_INTERVAL
+bytes, so the CRC32 of any prefix of it (what a resumed download is checked
+against) costs at most one interval's read instead of the whole prefix.
+"""
+
+import array
+import threading
+import zlib
+
+# Bytes hashed per read while computing a checksum
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Bytes between the running CRC32 values kept for prefix checksums (a multiple of HASH_CHUNK_SIZE)
+CHECKPOINT_INTERVAL = 16 * HASH_CHUNK_SIZE
+
+
+class ChecksumCache:
+    """Thread-safe cache of whole-file CRC32 checksums"""
+    
+    def __init__(self, max_entries=4096):
+        """
+        Initialize the cache
+        
+        Args:
+            max_entries: Number of files to remember before the cache is cleared
+        """
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+    
+    def crc32(self, path, st, file=None):
+        """
+        Return the CRC32 of a file, computing it if the file changed
+        
+        Args:
+            path: Path of the file
+            st: os.stat_result for the file
+            file: Optional open binary file to hash instead of reopening `path`
+        
+        Returns:
+            CRC32 as an unsigned integer
+        """
+        version = (st.st_size, st.st_mtime_ns, st.st_ino)
+        with self.lock:
+            cached = self.entries.get(path)
+        if cached and cached[0] == version:
+            return cached[1]
+        
+        if file is not None:
+            crc, checkpoints = crc32_with_checkpoints(file)
+        else:
+            with open(path, 'rb') as file:
+                crc, checkpoints = crc32_with_checkpoints(file)
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                self.entries.clear()
+            self.entries[path] = (version, crc, checkpoints)
+        return crc
+    
+    def prefix_crc32(self, path, st, file, length):
+        """
+        Return the CRC32 of the first `length` bytes of a file
+        
+        Once the whole file has been hashed, only the bytes after the last
+        checkpoint before `length` are read; until then the prefix is hashed
+        on demand.
+        
+        Args:
+            path: Path of the file
+            st: os.stat_result for the file
+            file: Open binary file to read from
+            length: Number of bytes in the prefix
+        
+        Returns:
+            CRC32 as an unsigned integer
+        """
+        version = (st.st_size, st.st_mtime_ns, st.st_ino)
+        with self.lock:
+            cached = self.entries.get(path)
+        if not cached or cached[0] != version:
+            return crc32_of_range(file, 0, length)
+        
+        index = min(length // CHECKPOINT_INTERVAL, len(cached[2]) - 1)
+        start = index * CHECKPOINT_INTERVAL
+        return crc32_of_range(file, start, length - start, cached[2][index])
+    
+    def crc32_range(self, path, st, file, offset, length):
+        """
+        Return the CRC32 of `length` bytes of a file starting at `offset`
+        
+        Whole-file ranges come from the cache; partial ranges are hashed on demand.
+        
+        Args:
+            path: Path of the file
+            st: os.stat_result for the file
+            file: Open binary file to read the range from
+            offset: First byte of the range
+            length: Number of bytes in the range
+        
+        Returns:
+            CRC32 as an unsigned integer
+        """
+        if offset == 0 and length == st.st_size:
+            return self.crc32(path, st, file)
+        return crc32_of_range(file, offset, length)
+
+
+def crc32_of(file):
+    """
+    Compute the CRC32 of an open binary file from its start, then rewind it
+    
+    Args:
+        file: Open binary file object
+    """
+    crc = 0
+    file.seek(0)
+    for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+        crc = zlib.crc32(chunk, crc)
+    file.seek(0)
+    return crc
+
+
+def crc32_with_checkpoints(file):
+    """
+    Compute the CRC32 of an open binary file from its start, then rewind it
+    
+    Args:
+        file: Open binary file object
+    
+    Returns:
+        Tuple of (CRC32, array of the running CRC32 at every multiple of CHECKPOINT_INTERVAL)
+    """
+    crc = 0
+    position = 0
+    checkpoints = array.array('L', [0])
+    file.seek(0)
+    for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+        crc = zlib.crc32(chunk, crc)
+        position += len(chunk)
+        if not position % CHECKPOINT_INTERVAL:
+            checkpoints.append(crc)
+    file.seek(0)
+    return crc, checkpoints
+
+
+def crc32_of_range(file, offset, length, crc=0):
+    """
+    Compute the CRC32 of `length` bytes of an open binary file from `offset`, then rewind it
+    
+    Args:
+        file: Open binary file object
+        offset: First byte to hash
+        length: Number of bytes to hash (fewer if the file ends first)
+        crc: Running CRC32 of the bytes before `offset`, to continue from
+    """
+    file.seek(offset)
+    while length > 0:
+        chunk = file.read(min(HASH_CHUNK_SIZE, length))
+        if not chunk:
+            break
+        crc = zlib.crc32(chunk, crc)
+        length -= len(chunk)
+    file.seek(0)
+    return crc
+
+
+def crc32_of_path(path):
+    """
+    Compute the CRC32 of the file at `path`
+    
+    Args:
+        path: Path of the file
+    """
+    with open(path, 'rb') as file:
+        return crc32_of(file)
+
+
+# Shared by every server engine in this process
+checksum_cache = ChecksumCache()
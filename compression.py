@@ -0,0 +1,327 @@
+"""
+Transfer Compression - codecs negotiated per GET request
+A client lists the encodings it can decode in 'accept_encoding'; the server
+picks the first one it also supports if the body is worth compressing: text
+types are, already-compressed types and small bodies are not, and anything
+else is only if a sample of it compresses well (see compressible()). gzip
+is always available; zstd and lz4 are offered when their Python packages
+are installed.
+
+Compressed bodies are streamed as a series of OP_DATA frames, because their
+size is not known until the last byte has been compressed. Whole-file
+variants of small files are kept in a VariantCache so hot files are only
+compressed once per version; a file that does not get smaller is recorded
+as incompressible and sent as it is.
+"""
+
+import collections
+import os
+import threading
+import zlib
+from config import (COMPRESSION_LEVEL, COMPRESS_MIN_SIZE, COMPRESS_CHUNK_SIZE, COMPRESSED_CACHE_SIZE,
+                    FILE_CACHE_MAX_FILE_SIZE, COMPRESS_SAMPLE_SIZE, COMPRESS_MAX_RATIO)
+from file_cache import file_version
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# File types whose contents are already compressed; compressing them again wastes CPU
+SKIP_EXTENSIONS = frozenset((
+    '.7z', '.apk', '.avi', '.bz2', '.docx', '.epub', '.flac', '.gif', '.gz', '.jar', '.jpeg',
+    '.jpg', '.lz4', '.mkv', '.mov', '.mp3', '.mp4', '.odt', '.ogg', '.png', '.pptx', '.rar',
+    '.tgz', '.webm', '.webp', '.woff', '.woff2', '.xlsx', '.xz', '.zip', '.zst'
+))
+
+# Text file types; they always compress well, so they are compressed without sampling
+TEXT_EXTENSIONS = frozenset((
+    '.c', '.cfg', '.conf', '.cpp', '.css', '.csv', '.go', '.h', '.htm', '.html', '.ini', '.java', '.js',
+    '.json', '.log', '.md', '.py', '.rs', '.rst', '.sh', '.sql', '.svg', '.tex', '.toml', '.ts', '.tsv',
+    '.txt', '.xml', '.yaml', '.yml'
+))
+
+
+class GzipCodec:
+    """gzip container around zlib deflate (what browsers accept as Content-Encoding: gzip)"""
+    
+    name = 'gzip'
+    
+    def compressor(self):
+        """Create a streaming compressor"""
+        return zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+    
+    def decompressor(self):
+        """Create a streaming decompressor"""
+        return zlib.decompressobj(31)
+
+
+class ZstdCodec:
+    """Zstandard, via the optional zstandard package"""
+    
+    name = 'zstd'
+    
+    def compressor(self):
+        """Create a streaming compressor"""
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    
+    def decompressor(self):
+        """Create a streaming decompressor"""
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+class Lz4Codec:
+    """LZ4 frames, via the optional lz4 package"""
+    
+    name = 'lz4'
+    
+    def compressor(self):
+        """Create a streaming compressor"""
+        return Lz4Compressor()
+    
+    def decompressor(self):
+        """Create a streaming decompressor"""
+        return lz4_frame.LZ4FrameDecompressor()
+
+
+class Lz4Compressor:
+    """Adapts lz4.frame.LZ4FrameCompressor to the compress()/flush() interface of zlib"""
+    
+    def __init__(self):
+        """Start a new LZ4 frame"""
+        self.compressor = lz4_frame.LZ4FrameCompressor()
+        self.header = self.compressor.begin()
+    
+    def compress(self, data):
+        """Compress a chunk; the first call also returns the frame header"""
+        header, self.header = self.header, b''
+        return header + self.compressor.compress(data)
+    
+    def flush(self):
+        """Finish the frame and return the remaining output"""
+        header, self.header = self.header, b''
+        return header + self.compressor.flush()
+
+
+# Supported codecs in order of preference
+CODECS = collections.OrderedDict(
+    (codec.name, codec) for codec in (
+        ZstdCodec() if zstandard else None,
+        Lz4Codec() if lz4_frame else None,
+        GzipCodec()
+    ) if codec
+)
+
+
+def supported_encodings():
+    """Return the names of the available codecs, most preferred first"""
+    return list(CODECS)
+
+
+def choose_encoding(filename, length, accepted, file=None, offset=0):
+    """
+    Pick the codec for a response body
+    
+    Args:
+        filename: Name of the file being sent
+        length: Number of (uncompressed) bytes to send
+        accepted: Encodings the client listed in 'accept_encoding', in its order of preference
+        file: Open binary file to sample if its type is not known to compress (None = don't sample)
+        offset: Position in the file of the first byte to send
+    
+    Returns:
+        Codec name, or None to send the body uncompressed
+    """
+    if not accepted or not isinstance(accepted, list) or length < COMPRESS_MIN_SIZE:
+        return None
+    for name in accepted:
+        if isinstance(name, str) and name in CODECS:
+            return name if compressible(filename, file, offset, length) else None
+    return None
+
+
+def compressible(filename, file=None, offset=0, length=None):
+    """
+    Check whether a body is worth compressing
+    
+    Text types always are and already-compressed types never are. Anything
+    else is only if COMPRESS_SAMPLE_SIZE bytes from the start of the body
+    shrink below COMPRESS_MAX_RATIO of their size at the fastest zlib level;
+    compressing random or packed data only costs CPU and the zero-copy path.
+    
+    Args:
+        filename: Name of the file being sent
+        file: Open binary file to sample (its position is left unchanged), or None
+        offset: Position in the file of the first byte to send
+        length: Number of bytes to send, if known
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in TEXT_EXTENSIONS:
+        return True
+    if extension in SKIP_EXTENSIONS or file is None or not COMPRESS_SAMPLE_SIZE:
+        return False
+    
+    position = file.tell()
+    try:
+        file.seek(offset)
+        sample = file.read(COMPRESS_SAMPLE_SIZE if length is None else min(COMPRESS_SAMPLE_SIZE, length))
+    finally:
+        file.seek(position)
+    return bool(sample) and len(zlib.compress(sample, 1)) < len(sample) * COMPRESS_MAX_RATIO
+
+
+class Decoder:
+    """Decompresses a response body chunk by chunk"""
+    
+    def __init__(self, encoding):
+        """
+        Initialize the decoder
+        
+        Args:
+            encoding: Codec name from the response
+        """
+        if encoding not in CODECS:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+        self.decompressor = CODECS[encoding].decompressor()
+    
+    def decode(self, data):
+        """Return the decompressed bytes available after feeding `data`"""
+        return self.decompressor.decompress(data)
+    
+    def finish(self):
+        """Return any output still held by the decompressor at the end of the body"""
+        if not getattr(self.decompressor, 'eof', True):
+            raise ValueError("Compressed data ended early")
+        flush = getattr(self.decompressor, 'flush', None)
+        return flush() if flush else b''
+
+
+def compress_range(file, offset, length, encoding):
+    """
+    Compress part of an open file, one chunk at a time
+    
+    Args:
+        file: Open binary file object
+        offset: First byte to compress
+        length: Number of bytes to compress
+        encoding: Codec name
+    
+    Yields:
+        Tuples of (compressed bytes, is_last); only the final tuple has is_last set
+    """
+    compressor = CODECS[encoding].compressor()
+    file.seek(offset)
+    remaining = length
+    while remaining > 0:
+        chunk = file.read(min(COMPRESS_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        data = compressor.compress(chunk)
+        if data:
+            yield data, False
+    yield compressor.flush(), True
+
+
+class VariantCache:
+    """Thread-safe LRU cache of compressed whole-file variants, bounded by total size"""
+    
+    def __init__(self, max_bytes=COMPRESSED_CACHE_SIZE, max_file_size=FILE_CACHE_MAX_FILE_SIZE):
+        """
+        Initialize the cache
+        
+        Args:
+            max_bytes: Total bytes of compressed data kept in memory (0 disables the cache)
+            max_file_size: Largest (uncompressed) file whose variants are cached
+        """
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.incompressible = 0
+    
+    def cacheable(self, st, offset, length):
+        """
+        Check whether a response body can be served from (and stored in) the cache
+        
+        Args:
+            st: os.stat_result for the file
+            offset: First byte requested
+            length: Number of bytes requested
+        """
+        return bool(self.max_bytes) and offset == 0 and length == st.st_size <= self.max_file_size
+    
+    def get(self, path, st, file, encoding):
+        """
+        Return the compressed file and its CRC32, compressing it on a miss
+        
+        Args:
+            path: Path of the file
+            st: os.stat_result for the file
+            file: Open binary file to compress on a miss
+            encoding: Codec name
+        
+        Returns:
+            Tuple of (compressed bytes, CRC32 of the compressed bytes), or None if
+            compressing does not make this version of the file any smaller
+        """
+        key = (os.path.abspath(path), encoding)
+        version = file_version(st)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1:] if entry[1] is not None else None
+            self.misses += 1
+        
+        data = b''.join(chunk for chunk, _ in compress_range(file, 0, st.st_size, encoding))
+        if len(data) >= st.st_size:
+            # Remember the verdict (it costs no space) instead of the useless variant
+            data = crc = None
+        else:
+            crc = zlib.crc32(data)
+        size = len(data) if data is not None else 0
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self._forget(old)
+            while self.entries and self.size + size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self._forget(evicted)
+            if size <= self.max_bytes:
+                self.entries[key] = (version, data, crc)
+                self.size += size
+                if data is None:
+                    self.incompressible += 1
+        return (data, crc) if data is not None else None
+    
+    def _forget(self, entry):
+        """Update the counters for an entry leaving the cache (called with the lock held)"""
+        if entry[1] is None:
+            self.incompressible -= 1
+        else:
+            self.size -= len(entry[1])
+    
+    def get_stats(self):
+        """Return a snapshot of the cache counters"""
+        with self.lock:
+            return {
+                'compressed_entries': len(self.entries),
+                'compressed_bytes': self.size,
+                'compressed_hits': self.hits,
+                'compressed_misses': self.misses,
+                'compressed_incompressible': self.incompressible
+            }
+
+
+# Shared by every server engine in this process
+variant_cache = VariantCache()
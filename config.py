@@ -4,11 +4,93 @@
 SERVER_HOST = 'localhost'
 SERVER_PORT = 9999
 BUFFER_SIZE = 1000  # Maximum bytes per flush operation
-SLEEP_TIME = 0.2    # Sleep time in seconds (200 milliseconds)
+USE_SENDFILE = True  # Send regular files with kernel zero-copy sendfile()
+LISTEN_BACKLOG = 128  # Pending connections the kernel queues before refusing
+FILE_CACHE_SIZE = 64 * 1024 * 1024        # Bytes of hot file contents kept in memory (0 = off)
+FILE_CACHE_MAX_FILE_SIZE = 4 * 1024 * 1024  # Larger files are always read from disk
+COMPRESSION_LEVEL = 6        # gzip level used for compressed transfers
+COMPRESS_MIN_SIZE = 1024     # Smaller bodies are always sent uncompressed
+COMPRESS_SAMPLE_SIZE = 64 * 1024  # Bytes of a non-text file test-compressed to decide (0 = text types only)
+COMPRESS_MAX_RATIO = 0.9     # Such a file is compressed only if its sample shrinks below this fraction
+COMPRESS_CHUNK_SIZE = 256 * 1024          # Bytes compressed per step while streaming
+COMPRESSED_CACHE_SIZE = 32 * 1024 * 1024  # Bytes of precompressed hot files kept in memory (0 = off)
+MMAP_MODE = 'auto'        # Serve mid-size files from shared mmaps: 'auto' (only without os.sendfile), 'on' or 'off'
+MMAP_MIN_SIZE = 1024 * 1024             # Smaller files use sendfile or buffered reads
+MMAP_MAX_SIZE = 2 * 1024 * 1024 * 1024  # Larger files are never mapped whole
+
+# Wire Protocol (see protocol.py)
+CLIENT_PROTOCOL = 'auto'     # 'auto' (framed, falling back to legacy), 'framed' or 'legacy'
+NEGOTIATION_TIMEOUT = 5      # Seconds to wait for the PING opening a session before giving up on the server
+VERIFY_CHECKSUMS = True      # Send and verify a CRC32 of every framed file transfer
+MAX_CONTROL_PAYLOAD = 65536  # Largest control message (request / response header) accepted
+CLIENT_RECV_SIZE = 65536     # Bytes the client asks for per recv() in framed transfers
+KEEPALIVE_TIMEOUT = 30       # Seconds an idle framed session stays open (0 = forever)
+PIPELINE_DEPTH = 16          # Requests a client keeps in flight on one connection
+RESUME_DOWNLOADS = True      # Keep interrupted framed downloads as <file>.part and resume them
+CLIENT_COMPRESSION = True    # Ask the server to compress downloads (see compression.py)
+SKIP_UNCHANGED = True        # Send the hash of an existing local copy; the server skips sending it if unchanged
+DOWNLOAD_STREAMS = 0         # Connections per segmented download (0 = auto from the file size)
+MAX_DOWNLOAD_STREAMS = 8     # Upper bound for the automatic stream count
+SEGMENT_MIN_SIZE = 8 * 1024 * 1024  # Auto mode opens one more stream per this many bytes
+
+# Client Connection Pool (used by the web interface)
+POOL_MAX_SIZE = 8            # Idle connections kept open per server
+POOL_IDLE_TIMEOUT = 20       # Seconds a pooled connection may sit idle (keep below KEEPALIVE_TIMEOUT)
+
+# Bandwidth Shaping (bytes per second, 0 = unlimited)
+GLOBAL_BANDWIDTH_LIMIT = 0       # Total for the server, shared fairly between active transfers
+PER_CLIENT_BANDWIDTH_LIMIT = 0   # Shared by all transfers to the same client IP
+PER_FILE_BANDWIDTH_LIMITS = {}   # e.g. {'big.iso': 1000000}, shared by all transfers of that file
+BANDWIDTH_BURST = 0.25           # Seconds of unused bandwidth a transfer may save up
+THROTTLE_CHUNK_SIZE = 65536      # Largest slice sent at once by a rate-limited transfer
+
+# Concurrency Configuration
+SERVER_ENGINE = 'threaded'  # 'threaded' (blocking sockets) or 'asyncio' (single event loop)
+SERVER_MODE = 'thread'      # 'thread' = one thread per client, 'pool' = bounded worker pool
+WORKER_POOL_SIZE = 32       # Worker threads in 'pool' mode
+REQUEST_QUEUE_SIZE = 256    # Requests waiting for a free worker in 'pool' mode
+OVERLOAD_POLICY = 'queue'   # Full queue: 'queue' (wait), 'reject' (send BUSY) or 'shed_oldest'
+SERVER_PROCESSES = 1        # Server processes sharing the port (0 = one per CPU core)
+REUSE_PORT = True           # Let each process bind with SO_REUSEPORT where supported (else share one socket)
+WORKER_RESTART_DELAY = 1    # Seconds before a crashed server process is restarted
+
+# Slow-Client Protection (seconds, 0 = no limit)
+HANDSHAKE_TIMEOUT = 10      # A new connection must send its first request within this time
+IDLE_TIMEOUT = 60           # A request is abandoned when the client sends or accepts no data for this long
+TRANSFER_TIMEOUT = 3600     # Longest one request (a whole download or upload) may take
+REAP_INTERVAL = 1           # Seconds between checks for requests past TRANSFER_TIMEOUT
+MAX_PENDING_CONNECTIONS = 1024  # Connections waiting to send their first request; beyond this accepting pauses
+
+# Logging (see logs.py)
+LOG_LEVEL = 'INFO'           # 'DEBUG' adds per-connection and per-request detail; 'WARNING' keeps only problems
+LOG_FILE = None              # Append log records to this file instead of writing them to standard output
+LOG_FORMAT = 'text'          # 'text' ('[TAG] message' lines) or 'json' (one object per line)
+LOG_PROGRESS_INTERVAL = 1.0  # Seconds between progress records of one transfer (0 = summaries only)
+
+# Metrics (see metrics.py)
+METRICS_ENABLED = True       # Count requests, bytes and errors and time them (OP_STATS and the web /metrics page)
+METRICS_DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
 
 # Web Server Configuration
 WEB_HOST = 'localhost'
 WEB_PORT = 5000
+WEB_STREAM_DOWNLOADS = True  # Relay downloads straight to the browser instead of staging them in the temp directory
+WEB_COALESCE_DOWNLOADS = True  # Concurrent whole-file downloads of the same file share one transfer from the server
+
+# Background Download Jobs (see download_jobs.py; used when a download is staged)
+DOWNLOAD_JOB_WORKERS = 4             # Staged downloads the web interface runs at once
+DOWNLOAD_JOB_MAX_PENDING = 64        # Queued and running jobs before new ones are refused (503)
+DOWNLOAD_JOB_TTL = 600               # Seconds a finished job and its staged file are kept
+DOWNLOAD_JOB_MAX_JOBS = 256          # Finished jobs kept at most; the oldest are evicted first
+DOWNLOAD_JOB_MAX_BYTES = 1024 ** 3   # Bytes of staged files kept at most; the oldest are evicted first
+DOWNLOAD_JOB_SHARE_TTL = 30          # Seconds a completed job still serves new requests for the same file version
+DOWNLOAD_JOB_EVENT_INTERVAL = 0.5    # Least seconds between two progress events of one job
+DOWNLOAD_JOB_KEEPALIVE = 15          # Seconds between keep-alive comments on an idle event stream
 
 # File Storage
 FILES_DIRECTORY = 'server_files'
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes read from the request body per write during uploads
+UPLOAD_SESSION_TIMEOUT = 3600    # Seconds an unfinished resumable upload is kept while idle
+FILE_INDEX_SCAN_INTERVAL = 30  # Seconds between full rescans of FILES_DIRECTORY by the web interface (0 = never)
+ARCHIVE_CHUNK_SIZE = 256 * 1024  # Bytes of each file read per step while streaming an archive
+CONTENT_STORE = False          # Store identical files once, as hard links to SHA-256 named objects (see content_store.py)
@@ -0,0 +1,345 @@
+"""
+Content Store - SHA-256 content hashes and optional deduplicated storage
+Every file in FILES_DIRECTORY can be identified by the SHA-256 of its
+contents. Hashes are kept in a name -> hash map, revalidated against the
+file's size, modification time and inode, so each version of a file is
+only read once to hash it. The hash is what the web interface sends as the
+ETag and what the framed protocol's 'if_none_match' is compared against.
+
+With CONTENT_STORE on, the store also deduplicates: the first copy of some
+content is hard-linked into OBJECTS_DIRECTORY under its hash, and any other
+file with the same hash is replaced by a link to that object, so identical
+files take up disk space (and page cache) only once. The name -> hash map is
+then saved next to the objects so it survives restarts and is shared by the
+file server and the web interface. Files must be replaced (as uploads do),
+not edited in place, while the store is on: an in-place edit would change
+every name linked to the same object. Bulk hashing (a directory scan) runs
+inside batch(), which saves the map every MAP_SAVE_INTERVAL seconds and once
+at the end instead of rewriting it after every file.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from config import FILES_DIRECTORY, CONTENT_STORE
+from checksums import HASH_CHUNK_SIZE
+from file_cache import file_version
+import logs
+
+# Directory inside FILES_DIRECTORY holding hash-named objects (hidden from listings)
+OBJECTS_DIRECTORY = '.objects'
+
+# Name -> hash map saved inside OBJECTS_DIRECTORY
+MAP_FILENAME = 'names.json'
+
+# Seconds between map saves while a batch() defers them
+MAP_SAVE_INTERVAL = 5.0
+
+log = logs.get_logger('store')
+
+
+class ContentStore:
+    """Thread-safe name -> SHA-256 map of one directory, optionally backed by deduplicated objects"""
+    
+    def __init__(self, directory=FILES_DIRECTORY, enabled=CONTENT_STORE):
+        """
+        Initialize the store
+        
+        Args:
+            directory: Directory whose files are hashed
+            enabled: Deduplicate into hash-named objects and persist the map
+        """
+        self.directory = directory
+        self.enabled = enabled
+        self.objects_directory = os.path.join(directory, OBJECTS_DIRECTORY)
+        self.map_path = os.path.join(self.objects_directory, MAP_FILENAME)
+        self.hashes = {}
+        self.map_mtime = None
+        self.lock = threading.Lock()
+        self.deduplicated = 0
+        self.batching = threading.local()
+        self.saved_at = 0.0
+    
+    def lookup(self, path, st):
+        """
+        Return the known hash of a file without reading it
+        
+        Args:
+            path: Path of the file
+            st: os.stat_result for the file
+        
+        Returns:
+            Hex SHA-256, or None if this version of the file has not been hashed
+        """
+        self._reload_map()
+        with self.lock:
+            entry = self.hashes.get(self.key_of(path))
+        if entry and entry[1] == file_version(st):
+            return entry[0]
+        return None
+    
+    def hash_of(self, path, st=None, file=None):
+        """
+        Return the hash of a file, computing (and storing) it if the file changed
+        
+        Args:
+            path: Path of the file
+            st: os.stat_result for the file (stat()ed if omitted)
+            file: Optional open binary file to hash instead of reopening `path`
+        
+        Returns:
+            Hex SHA-256
+        """
+        if st is None:
+            st = os.stat(path)
+        digest = self.lookup(path, st)
+        if digest is None:
+            digest = sha256_of(file) if file is not None else sha256_of_path(path)
+            self.add(path, digest, st)
+        return digest
+    
+    def add(self, path, digest, st=None):
+        """
+        Record the hash of a new or replaced file and, with the store on, deduplicate it
+        
+        Args:
+            path: Path of the file
+            digest: Hex SHA-256 of its contents
+            st: os.stat_result for the file (stat()ed if omitted)
+        """
+        name = self.name_of(path)
+        key = self.key_of(path)
+        if st is None:
+            st = os.stat(path)
+        
+        with self.lock:
+            previous = self.hashes.get(key)
+        if self.enabled and name:
+            try:
+                if previous and previous[0] != digest:
+                    self._detach(previous[0], st)
+                st = self._link_object(path, digest, st)
+            except OSError as e:
+                # e.g. a filesystem without hard links - keep the plain file
+                log.warning(f"Could not store {name} as object {digest[:12]}: {str(e)}")
+        
+        with self.lock:
+            self.hashes[key] = (digest, file_version(st))
+        if self.enabled and name:
+            if previous and previous[0] != digest:
+                self._release(previous[0])
+            self._map_changed()
+    
+    def remove(self, path):
+        """
+        Forget a file (call after deleting it); its object goes once nothing links to it
+        
+        Args:
+            path: Path the file had
+        """
+        name = self.name_of(path)
+        with self.lock:
+            previous = self.hashes.pop(self.key_of(path), None)
+        if self.enabled and name and previous:
+            self._release(previous[0])
+            self._map_changed()
+    
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context manager deferring this thread's map saves, for adding many files at once
+        
+        Rewriting the whole map after each file would make hashing a directory
+        quadratic in its size; inside a batch the map is saved at most every
+        MAP_SAVE_INTERVAL seconds, and once more when the outermost batch ends.
+        """
+        depth = getattr(self.batching, 'depth', 0)
+        self.batching.depth = depth + 1
+        try:
+            yield self
+        finally:
+            self.batching.depth = depth
+            if not depth and getattr(self.batching, 'dirty', False):
+                self._save_map()
+    
+    def name_of(self, path):
+        """
+        Return the map key of a file: its path relative to the store directory
+        
+        Args:
+            path: Path of the file
+        
+        Returns:
+            Relative name, or None if the file is outside the directory or is an object
+        """
+        root = os.path.realpath(self.directory)
+        path = os.path.realpath(path)
+        if os.path.commonpath([root, path]) != root or path == root:
+            return None
+        name = os.path.relpath(path, root)
+        if name.split(os.sep)[0] == OBJECTS_DIRECTORY:
+            return None
+        return name
+    
+    def key_of(self, path):
+        """
+        Return the map key of a file: its name inside the directory, or its absolute
+        path for files elsewhere (which are hashed but never stored or saved)
+        
+        Args:
+            path: Path of the file
+        """
+        return self.name_of(path) or os.path.abspath(path)
+    
+    def object_path(self, digest):
+        """
+        Return the path of the object holding some content
+        
+        Args:
+            digest: Hex SHA-256
+        """
+        return os.path.join(self.objects_directory, digest[:2], digest[2:])
+    
+    def get_stats(self):
+        """Return a snapshot of the store counters"""
+        with self.lock:
+            return {
+                'hashed_files': len(self.hashes),
+                'distinct_contents': len({entry[0] for entry in self.hashes.values()}),
+                'deduplicated_files': self.deduplicated
+            }
+    
+    def _link_object(self, path, digest, st):
+        """
+        Make `path` and the object for `digest` the same file
+        
+        Returns:
+            os.stat_result of `path` afterwards
+        """
+        object_path = self.object_path(digest)
+        try:
+            object_st = os.stat(object_path)
+        except FileNotFoundError:
+            # First copy of this content: it becomes the object
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.link(path, object_path)
+            return os.stat(path)
+        
+        if os.path.samestat(object_st, st) or object_st.st_size != st.st_size:
+            return st
+        
+        # Same content is already stored - swap this copy for another link to it.
+        # The link is made under a temporary name and renamed over the file, so
+        # readers see either the old copy or the object, never a missing file.
+        temp_path = os.path.join(self.objects_directory, f".link-{uuid.uuid4().hex}")
+        os.link(object_path, temp_path)
+        try:
+            os.replace(temp_path, path)
+        except OSError:
+            os.remove(temp_path)
+            raise
+        with self.lock:
+            self.deduplicated += 1
+        return os.stat(path)
+    
+    def _detach(self, digest, st):
+        """Drop the object for `digest` if it is `st` - a linked file that was edited in place"""
+        object_path = self.object_path(digest)
+        try:
+            if os.path.samestat(os.stat(object_path), st):
+                os.remove(object_path)
+        except OSError:
+            pass
+    
+    def _release(self, digest):
+        """Delete the object for `digest` if no file in the directory links to it any more"""
+        object_path = self.object_path(digest)
+        try:
+            if os.stat(object_path).st_nlink <= 1:
+                os.remove(object_path)
+                os.rmdir(os.path.dirname(object_path))
+        except OSError:
+            pass
+    
+    def _map_changed(self):
+        """Save the map, unless a batch() on this thread defers it"""
+        if getattr(self.batching, 'depth', 0) and time.monotonic() - self.saved_at < MAP_SAVE_INTERVAL:
+            self.batching.dirty = True
+            return
+        self._save_map()
+    
+    def _reload_map(self):
+        """Pick up changes the other process (server or web interface) saved to the map"""
+        if not self.enabled:
+            return
+        try:
+            mtime = os.stat(self.map_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self.map_mtime:
+            return
+        try:
+            with open(self.map_path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            for name, (digest, size, mtime_ns, ino) in saved.items():
+                self.hashes[name] = (digest, (size, mtime_ns, ino))
+            self.map_mtime = mtime
+    
+    def _save_map(self):
+        """Write the map next to the objects (a temporary file renamed into place)"""
+        self.batching.dirty = False
+        self.saved_at = time.monotonic()
+        with self.lock:
+            saved = {name: [digest, *version] for name, (digest, version) in self.hashes.items()
+                     if not os.path.isabs(name)}
+        try:
+            os.makedirs(self.objects_directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(prefix='.map-', dir=self.objects_directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(saved, f)
+            os.replace(temp_path, self.map_path)
+            with self.lock:
+                self.map_mtime = os.stat(self.map_path).st_mtime_ns
+        except OSError as e:
+            log.warning(f"Could not save {self.map_path}: {str(e)}")
+
+
+def sha256_of(file):
+    """
+    Compute the SHA-256 of an open binary file from its start, then rewind it
+    
+    Args:
+        file: Open binary file object
+    
+    Returns:
+        Hex digest
+    """
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def sha256_of_path(path):
+    """
+    Compute the SHA-256 of the file at `path`
+    
+    Args:
+        path: Path of the file
+    """
+    with open(path, 'rb') as file:
+        return sha256_of(file)
+
+
+# Shared by every server engine (and the web interface) in this process
+content_store = ContentStore()
@@ -0,0 +1,457 @@
+"""
+Download Jobs - staged downloads that run in the background of the web interface
+Submitting a job returns its id at once; a bounded pool of worker threads
+copies the file from the file server into the job's own staging directory,
+so no web worker waits on the file server while a large file is transferred.
+Progress is recorded on the job and wakes whoever waits for it to change (the
+web interface's server-sent event stream). Finished jobs and their staged
+files are evicted after DOWNLOAD_JOB_TTL seconds, or sooner, oldest first,
+while more than DOWNLOAD_JOB_MAX_JOBS of them or DOWNLOAD_JOB_MAX_BYTES of
+staged data are kept.
+
+Jobs are single-flight: submitting a version of a file that a queued or
+running job is already fetching joins that job instead of starting a second
+transfer, and a job that completed less than DOWNLOAD_JOB_SHARE_TTL seconds
+ago is handed out again as it is. Submissions that do not know the version
+always get a job of their own, since it could be a different file. Any number of readers can follow one job
+with iter_file(), which yields the staged bytes while they are still arriving.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from config import (DOWNLOAD_JOB_WORKERS, DOWNLOAD_JOB_MAX_PENDING, DOWNLOAD_JOB_TTL, DOWNLOAD_JOB_MAX_JOBS,
+                    DOWNLOAD_JOB_MAX_BYTES, DOWNLOAD_JOB_SHARE_TTL, UPLOAD_CHUNK_SIZE)
+from file_client import PARTIAL_SUFFIX
+import logs
+import metrics
+
+# Every state a job can be in, and the ones it ends in
+STATES = ('queued', 'running', 'done', 'failed', 'cancelled')
+FINAL_STATES = ('done', 'failed', 'cancelled')
+
+log = logs.get_logger('jobs')
+
+# Submissions by outcome: 'started' a transfer, 'joined' a running job or reused a 'cached' one
+job_requests = metrics.counter('download_job_requests_total', "Download job submissions", ('outcome',))
+
+
+class JobQueueFull(Exception):
+    """Raised when DOWNLOAD_JOB_MAX_PENDING jobs are already queued or running"""
+
+
+class JobCancelled(Exception):
+    """Raised from the progress callback to stop the transfer of a cancelled job"""
+
+
+class JobFailed(Exception):
+    """Raised by iter_file() when the job it follows fails, is cancelled or loses its file"""
+
+
+class DownloadJob:
+    """One staged download and its progress"""
+    
+    def __init__(self, job_id, filename, version, path, lock):
+        """
+        Initialize the job
+        
+        Args:
+            job_id: Id of the job
+            filename: Name of the file on the server
+            version: Version the server reported for the file, if known
+            path: Path the file is staged at
+            lock: Lock of the DownloadJobManager, guarding the job's fields
+        """
+        self.id = job_id
+        self.filename = filename
+        self.version = version
+        self.path = path
+        self.subscribers = 1
+        self.state = 'queued'
+        self.received = 0
+        self.total = None
+        self.message = None
+        self.result = None
+        self.created = time.time()
+        self.finished_at = None
+        self.cancelled = False
+        self.future = None
+        self.revision = 0
+        self.changed = threading.Condition(lock)
+    
+    @property
+    def finished(self):
+        """True once the job is done, failed or cancelled"""
+        return self.state in FINAL_STATES
+    
+    @property
+    def staged_bytes(self):
+        """Bytes the job's staged file takes (only completed jobs keep one)"""
+        return self.result['size'] if self.state == 'done' else 0
+    
+    def to_dict(self):
+        """Return the job's state as a JSON-friendly dictionary"""
+        return {
+            'job_id': self.id,
+            'filename': self.filename,
+            'state': self.state,
+            'received': self.received,
+            'total': self.total,
+            'progress': round(self.received / self.total * 100, 1) if self.total else None,
+            'message': self.message,
+            'created': self.created,
+            'shared': self.subscribers > 1
+        }
+
+
+class DownloadJobManager:
+    """Runs download jobs on a bounded thread pool and keeps them until they are evicted"""
+    
+    def __init__(self, download, workers=DOWNLOAD_JOB_WORKERS, max_pending=DOWNLOAD_JOB_MAX_PENDING,
+                 ttl=DOWNLOAD_JOB_TTL, max_jobs=DOWNLOAD_JOB_MAX_JOBS, max_bytes=DOWNLOAD_JOB_MAX_BYTES,
+                 share_ttl=DOWNLOAD_JOB_SHARE_TTL, directory=None):
+        """
+        Initialize the manager
+        
+        Args:
+            download: Called as download(filename, save_path, on_progress) on a worker thread,
+                on_progress taking (bytes received, file size); returns a
+                FileClient.download_file() result dictionary
+            workers: Jobs run at once
+            max_pending: Queued and running jobs before submit() raises JobQueueFull
+            ttl: Seconds a finished job is kept
+            max_jobs: Finished jobs kept at most
+            max_bytes: Bytes of staged files kept at most
+            share_ttl: Seconds a completed job is handed out again to new submissions (0 = never)
+            directory: Directory the jobs stage their files in (default: a new temporary
+                directory, removed by close())
+        """
+        self.download = download
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.share_ttl = share_ttl
+        self.owns_directory = directory is None
+        self.directory = directory or tempfile.mkdtemp(prefix='fileserver-jobs-')
+        self.jobs = {}
+        self.latest = {}  # (filename, version) -> newest job for it, for single-flight lookups
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download-job')
+    
+    def submit(self, filename, version=None):
+        """
+        Queue the download of a file, or join a job already fetching the same version of it
+        
+        Every call counts as one subscriber of the job it returns; see leave().
+        
+        Args:
+            filename: Name of the file on the server
+            version: Version the server currently reports for the file (its 'version'
+                response field); None (unknown) never joins or is joined
+        
+        Returns:
+            DownloadJob
+        
+        Raises:
+            JobQueueFull: If a new job is needed and max_pending jobs are already queued or running
+        """
+        self.expire()
+        with self.lock:
+            job = self.latest.get((filename, version)) if version is not None else None
+            if job is not None and not job.cancelled and self.jobs.get(job.id) is job:
+                if not job.finished:
+                    outcome = 'joined'
+                elif job.state == 'done' and time.monotonic() - job.finished_at <= self.share_ttl:
+                    outcome = 'cached'
+                else:
+                    outcome = None
+                if outcome:
+                    job.subscribers += 1
+                    self._changed(job)
+                    job_requests.inc(outcome)
+                    log.debug(f"Request for {filename} {outcome} job {job.id}")
+                    return job
+            
+            pending = sum(1 for job in self.jobs.values() if not job.finished)
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"{pending} downloads are already queued or running, try again later")
+            
+            job_id = uuid.uuid4().hex
+            path = os.path.join(self.directory, job_id, os.path.basename(filename) or 'download')
+            job = self.jobs[job_id] = DownloadJob(job_id, filename, version, path, self.lock)
+            if version is not None:
+                self.latest[(filename, version)] = job
+            job.future = self.executor.submit(self.run, job)
+        job_requests.inc('started')
+        log.debug(f"Queued job {job_id} for {filename}")
+        return job
+    
+    def get(self, job_id):
+        """
+        Look up a job
+        
+        Args:
+            job_id: Id of the job
+        
+        Returns:
+            DownloadJob, or None if unknown or evicted
+        """
+        self.expire()
+        with self.lock:
+            return self.jobs.get(job_id)
+    
+    def list(self):
+        """Return the states of all jobs kept, oldest first"""
+        self.expire()
+        with self.lock:
+            return [job.to_dict() for job in sorted(self.jobs.values(), key=lambda job: job.created)]
+    
+    def counts(self):
+        """Return the number of jobs kept in each state"""
+        with self.lock:
+            counts = dict.fromkeys(STATES, 0)
+            for job in self.jobs.values():
+                counts[job.state] += 1
+            return counts
+    
+    def wait(self, job, revision, timeout):
+        """
+        Wait for a job to change
+        
+        Args:
+            job: DownloadJob to watch
+            revision: Revision returned by the previous call (-1 returns the current state at once)
+            timeout: Seconds to wait at most (None = until it changes)
+        
+        Returns:
+            Tuple of (job state dictionary, new revision), or (None, revision) on timeout
+        """
+        with self.lock:
+            if not job.changed.wait_for(lambda: job.revision != revision, timeout):
+                return None, revision
+            return job.to_dict(), job.revision
+    
+    def cancel(self, job_id):
+        """
+        Withdraw one subscriber from a job (see leave()), discarding the job and its staged file
+        once it has finished and nobody else subscribed to it
+        
+        Args:
+            job_id: Id of the job
+        
+        Returns:
+            DownloadJob, or None if unknown or evicted
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            self.leave(job, discard=True)
+        return job
+    
+    def leave(self, job, discard=False):
+        """
+        Withdraw one subscriber from a job; the last one to leave a queued or running job cancels it
+        
+        A running job stops after the chunk it is receiving.
+        
+        Args:
+            job: DownloadJob returned by submit()
+            discard: If this was the last subscriber of a finished job, evict it and its staged file
+        """
+        removed = False
+        with self.lock:
+            job.subscribers = max(0, job.subscribers - 1)
+            if job.subscribers:
+                return
+            if not job.finished:
+                job.cancelled = True
+                removed = job.future.cancel()
+                if removed:
+                    self._finish(job, 'cancelled', 'Download cancelled')
+            elif discard and self.jobs.get(job.id) is job:
+                self._evict(job)
+                removed = True
+        if removed:
+            self.remove_files(job)
+    
+    def size_of(self, job):
+        """
+        Wait until a job knows how big the file it stages is
+        
+        Args:
+            job: DownloadJob to follow
+        
+        Returns:
+            Size of the file in bytes, as the job's own transfer reported it
+        
+        Raises:
+            JobFailed: If the job fails or is cancelled first
+        """
+        revision = -1
+        while True:
+            state, revision = self.wait(job, revision, None)
+            if state['state'] in ('failed', 'cancelled'):
+                raise JobFailed(state['message'])
+            if state['total'] is not None:
+                return state['total']
+    
+    def iter_file(self, job, chunk_size=UPLOAD_CHUNK_SIZE):
+        """
+        Yield the staged file of a job from its first byte, waiting for the bytes still to arrive
+        
+        The bytes are read back from the staging file, so a reader only keeps up
+        with the transfer as far as it is able to and slow readers never hold
+        up the transfer or each other.
+        
+        Args:
+            job: DownloadJob to follow
+            chunk_size: Bytes read per step
+        
+        Yields:
+            Chunks of file data
+        
+        Raises:
+            JobFailed: If the job fails or is cancelled, or its file was evicted before it was opened
+        """
+        position = 0
+        revision = -1
+        file = None
+        try:
+            while True:
+                state, revision = self.wait(job, revision, None)
+                if state['state'] in ('failed', 'cancelled'):
+                    raise JobFailed(state['message'])
+                
+                if file is None:
+                    file = open_staged(job.path)
+                    if file is None:
+                        if state['state'] == 'done':
+                            raise JobFailed(f"Staged copy of {job.filename} was evicted")
+                        continue
+                
+                # Bytes the transfer still holds in its write buffer show up on a later round
+                while position < state['received']:
+                    data = file.read(min(chunk_size, state['received'] - position))
+                    if not data:
+                        break
+                    position += len(data)
+                    yield data
+                
+                if state['state'] == 'done' and position >= state['received']:
+                    return
+        finally:
+            if file is not None:
+                file.close()
+    
+    def run(self, job):
+        """Transfer the file of a job (runs on a worker thread)"""
+        with self.lock:
+            if job.cancelled:
+                return
+            job.state = 'running'
+            self._changed(job)
+        
+        def on_progress(received, total):
+            with self.lock:
+                if job.cancelled:
+                    raise JobCancelled("Download cancelled")
+                job.received = received
+                job.total = total
+                self._changed(job)
+        
+        try:
+            result = self.download(job.filename, job.path, on_progress)
+        except Exception as e:
+            result = {'status': 'error', 'message': str(e), 'filename': job.filename}
+        
+        with self.lock:
+            job.result = result
+            if job.cancelled:
+                self._finish(job, 'cancelled', 'Download cancelled')
+            elif result['status'] == 'success':
+                job.received = job.total = result['size']
+                self._finish(job, 'done', result['message'])
+            else:
+                self._finish(job, 'failed', result['message'])
+        
+        log.info(f"Job {job.id} for {job.filename} {job.state}: {job.message}")
+        if job.state != 'done':
+            self.remove_files(job)
+        self.expire()
+    
+    def _finish(self, job, state, message):
+        """Put a job in a final state (called with the lock held)"""
+        job.state = state
+        job.message = message
+        job.finished_at = time.monotonic()
+        self._changed(job)
+    
+    def _changed(self, job):
+        """Wake everyone waiting for a job to change (called with the lock held)"""
+        job.revision += 1
+        job.changed.notify_all()
+    
+    def _evict(self, job):
+        """Forget a job (called with the lock held; its files are removed by the caller)"""
+        del self.jobs[job.id]
+        if self.latest.get((job.filename, job.version)) is job:
+            del self.latest[(job.filename, job.version)]
+    
+    def expire(self):
+        """Evict finished jobs past their TTL, then the oldest ones while over max_jobs or max_bytes"""
+        now = time.monotonic()
+        with self.lock:
+            finished = sorted((job for job in self.jobs.values() if job.finished), key=lambda job: job.finished_at)
+            evicted = [job for job in finished if now - job.finished_at > self.ttl]
+            kept = finished[len(evicted):]
+            staged = sum(job.staged_bytes for job in kept)
+            # The newest finished job is kept until its TTL, so it can still be fetched
+            while len(kept) > 1 and (len(kept) > self.max_jobs or staged > self.max_bytes):
+                job = kept.pop(0)
+                staged -= job.staged_bytes
+                evicted.append(job)
+            for job in evicted:
+                self._evict(job)
+        
+        for job in evicted:
+            log.debug(f"Evicting job {job.id} for {job.filename}")
+            self.remove_files(job)
+    
+    def remove_files(self, job):
+        """Delete a job's staging directory"""
+        shutil.rmtree(os.path.dirname(job.path), ignore_errors=True)
+    
+    def close(self):
+        """Cancel every job, wait for the running ones to stop and remove the staged files"""
+        with self.lock:
+            for job in self.jobs.values():
+                job.cancelled = True
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        if self.owns_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        else:
+            for job in list(self.jobs.values()):
+                self.remove_files(job)
+
+
+def open_staged(path):
+    """
+    Open a job's file for reading: the partial file while it is being downloaded, then the complete one
+    
+    Args:
+        path: Path the job stages its file at
+    
+    Returns:
+        Open binary file, or None if neither exists
+    """
+    for candidate in (path + PARTIAL_SUFFIX, path):
+        try:
+            return open(candidate, 'rb')
+        except FileNotFoundError:
+            pass
+    return None
@@ -0,0 +1,261 @@
+"""
+Hot File Cache - shared in-memory copies of small, frequently served files
+Entries are keyed by path and revalidated against the file's size, modification
+time and inode on every lookup, so a file replaced or deleted by the web
+interface (a separate process) is never served stale. Least recently used
+entries are evicted once the cache holds FILE_CACHE_SIZE bytes.
+
+Larger files can instead be served from read-only memory maps shared by every
+transfer of the same file version (see MMAP_MODE in config.py). A mapped file
+must be replaced (written elsewhere and renamed), never truncated in place:
+on POSIX systems reading a truncated mapping kills the process with SIGBUS.
+"""
+
+import collections
+import contextlib
+import io
+import mmap
+import os
+import stat
+import threading
+from config import (FILE_CACHE_SIZE, FILE_CACHE_MAX_FILE_SIZE, USE_SENDFILE, MMAP_MODE,
+                    MMAP_MIN_SIZE, MMAP_MAX_SIZE)
+
+
+class CachedFile(io.BytesIO):
+    """Read-only file object over cached contents; servers send `data` straight from memory"""
+    
+    def __init__(self, data):
+        """
+        Initialize the file object
+        
+        Args:
+            data: Cached file contents
+        """
+        io.BytesIO.__init__(self, data)
+        self.data = data
+
+
+class FileCache:
+    """Thread-safe LRU cache of file contents bounded by total size"""
+    
+    def __init__(self, max_bytes=FILE_CACHE_SIZE, max_file_size=FILE_CACHE_MAX_FILE_SIZE):
+        """
+        Initialize the cache
+        
+        Args:
+            max_bytes: Total bytes of file contents kept in memory (0 disables the cache)
+            max_file_size: Largest file that is cached; bigger files are always read from disk
+        """
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_served = 0
+    
+    def open(self, path):
+        """
+        Open a regular file for reading, from the cache when it holds the current version
+        
+        Args:
+            path: Path of the file
+        
+        Returns:
+            Tuple of (file object, os.stat_result); the file object is a
+            CachedFile when the contents came from (or went into) the cache
+        """
+        # Legacy requests name files relative to FILES_DIRECTORY, framed ones by real path
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.invalidate(path)
+            raise
+        if not stat.S_ISREG(st.st_mode):
+            raise FileNotFoundError(f"Not a regular file: {path}")
+        
+        if not self.max_bytes or st.st_size > self.max_file_size:
+            file = open(path, 'rb')
+            return file, os.fstat(file.fileno())
+        
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] == file_version(st):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                self.bytes_served += st.st_size
+                return CachedFile(entry[1]), st
+            self.misses += 1
+        
+        with open(path, 'rb') as file:
+            # Version the entry by what was actually read, not by the earlier stat
+            st = os.fstat(file.fileno())
+            data = file.read()
+        if len(data) == st.st_size and st.st_size <= self.max_file_size:
+            self.store(path, file_version(st), data)
+        return CachedFile(data), st
+    
+    def store(self, path, version, data):
+        """
+        Add file contents to the cache, evicting least recently used entries to make room
+        
+        Args:
+            path: Path of the file
+            version: file_version() of the contents
+            data: File contents
+        """
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old:
+                self.size -= len(old[1])
+            while self.entries and self.size + len(data) > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+            self.entries[path] = (version, data)
+            self.size += len(data)
+    
+    def invalidate(self, path):
+        """
+        Drop the cached contents of a file
+        
+        Args:
+            path: Path of the file
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry:
+                self.size -= len(entry[1])
+    
+    def describe(self):
+        """Return a one-line summary of the cache limits"""
+        if not self.max_bytes:
+            return "off"
+        return f"{self.max_bytes} bytes, files up to {self.max_file_size} bytes"
+    
+    def get_stats(self):
+        """Return a snapshot of the cache counters"""
+        with self.lock:
+            return {
+                'cache_entries': len(self.entries),
+                'cache_bytes': self.size,
+                'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'cache_evictions': self.evictions,
+                'cache_bytes_served': self.bytes_served
+            }
+
+
+class MappingTable:
+    """Read-only memory maps shared by concurrent transfers of the same file version"""
+    
+    def __init__(self, mode=MMAP_MODE, min_size=MMAP_MIN_SIZE, max_size=MMAP_MAX_SIZE):
+        """
+        Initialize the table
+        
+        Args:
+            mode: 'auto' (map only where os.sendfile is unavailable), 'on' or 'off'
+            min_size: Smallest file that is mapped
+            max_size: Largest file that is mapped
+        """
+        if mode not in ('auto', 'on', 'off'):
+            raise ValueError(f"Unknown mmap mode: {mode}")
+        if mode == 'auto':
+            # sendfile never copies into user space, so it beats a mapping where it exists
+            mode = 'off' if USE_SENDFILE and hasattr(os, 'sendfile') else 'on'
+        
+        self.enabled = mode == 'on'
+        self.min_size = max(1, min_size)
+        self.max_size = max_size
+        self.mappings = {}
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.shared = 0
+    
+    def should_map(self, st):
+        """
+        Decide whether a file is served from a shared mapping
+        
+        Args:
+            st: os.stat_result for the open file
+        """
+        return self.enabled and stat.S_ISREG(st.st_mode) and self.min_size <= st.st_size <= self.max_size
+    
+    @contextlib.contextmanager
+    def map(self, file, st):
+        """
+        Context manager yielding a shared read-only mmap of an open file
+        
+        Args:
+            file: Open binary file object
+            st: os.stat_result for the open file
+        """
+        key = (st.st_dev,) + file_version(st)
+        with self.lock:
+            entry = self.mappings.get(key)
+            if entry:
+                entry[1] += 1
+                self.shared += 1
+            else:
+                entry = [mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ), 1]
+                self.mappings[key] = entry
+                self.opened += 1
+        try:
+            yield entry[0]
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                last_user = not entry[1]
+                if last_user:
+                    del self.mappings[key]
+            if last_user:
+                try:
+                    entry[0].close()
+                except BufferError:
+                    # A transport still holds a slice; the mapping is freed along with it
+                    pass
+    
+    def describe(self):
+        """Return a one-line summary of the mapping thresholds"""
+        if not self.enabled:
+            return "off"
+        return f"files of {self.min_size}-{self.max_size} bytes"
+    
+    def get_stats(self):
+        """Return a snapshot of the mapping counters"""
+        with self.lock:
+            return {
+                'mapped_files': len(self.mappings),
+                'mappings_opened': self.opened,
+                'mappings_shared': self.shared
+            }
+
+
+def file_version(st):
+    """
+    Identify a version of a file from its metadata
+    
+    Args:
+        st: os.stat_result for the file
+    """
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def version_tag(st):
+    """
+    Return file_version() as the string GET responses report as the file's 'version'
+    
+    Args:
+        st: os.stat_result for the file
+    """
+    return '-'.join(f"{value:x}" for value in file_version(st))
+
+
+# Shared by every server engine in this process
+file_cache = FileCache()
+shared_mappings = MappingTable()
@@ -5,22 +5,64 @@ Can be used as a standalone client or imported by the web interface
 
 import socket
 import os
-from config import SERVER_HOST, SERVER_PORT
+import zlib
+import collections
+import contextlib
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import (SERVER_HOST, SERVER_PORT, CLIENT_PROTOCOL, NEGOTIATION_TIMEOUT, CLIENT_RECV_SIZE,
+                    PIPELINE_DEPTH, RESUME_DOWNLOADS, POOL_MAX_SIZE, POOL_IDLE_TIMEOUT,
+                    DOWNLOAD_STREAMS, MAX_DOWNLOAD_STREAMS, SEGMENT_MIN_SIZE, VERIFY_CHECKSUMS,
+                    UPLOAD_CHUNK_SIZE, CLIENT_COMPRESSION, SKIP_UNCHANGED, LOG_PROGRESS_INTERVAL)
+from checksums import crc32_of_path
+from content_store import sha256_of_path
+from archive import archive_name
+import compression
+import logs
+import protocol
+
+# (host, port) of servers that answered a framed request in the legacy protocol
+legacy_servers = set()
+
+# Appended to the save path while a framed download is in progress
+PARTIAL_SUFFIX = '.part'
+
+log = logs.get_logger('client')
 
 
 class FileClient:
     """Client class for requesting files from the server"""
     
-    def __init__(self, host=SERVER_HOST, port=SERVER_PORT):
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, protocol_mode=CLIENT_PROTOCOL, pool=None,
+                 resume=RESUME_DOWNLOADS, compress=CLIENT_COMPRESSION, skip_unchanged=SKIP_UNCHANGED,
+                 on_progress=None):
         """
         Initialize the file client
         
         Args:
             host: Server host address
             port: Server port number
+            protocol_mode: 'auto', 'framed' or 'legacy' (see CLIENT_PROTOCOL in config.py)
+            pool: Optional ConnectionPool for the same server to reuse connections from
+            resume: Download into <save_path>.part and resume from it after an interruption
+            compress: Let the server compress framed downloads (see compression.py)
+            skip_unchanged: If save_path already exists, only download the file if it differs
+            on_progress: Called as on_progress(bytes received, file size) after every chunk of
+                a download_file() transfer; an exception it raises aborts the download
         """
+        if protocol_mode not in ('auto', 'framed', 'legacy'):
+            raise ValueError(f"Unknown protocol mode: {protocol_mode}")
+        
         self.host = host
         self.port = port
+        self.protocol_mode = protocol_mode
+        self.pool = pool
+        self.resume = resume
+        self.compress = compress
+        self.skip_unchanged = skip_unchanged
+        self.on_progress = on_progress
         
     def download_file(self, filename, save_path=None):
         """
@@ -42,16 +84,563 @@ class FileClient:
             os.makedirs(download_dir)
         
         try:
-            # Create TCP socket
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if self.protocol_mode == 'framed' or (
+                    self.protocol_mode == 'auto' and (self.host, self.port) not in legacy_servers):
+                try:
+                    return self.download_file_framed(filename, save_path)
+                except protocol.LegacyPeerError:
+                    if self.protocol_mode == 'framed':
+                        raise
+                    legacy_servers.add((self.host, self.port))
+                    log.warning("Server did not answer in the framed protocol, retrying in legacy mode")
+            
+            return self.download_file_legacy(filename, save_path)
+            
+        except ConnectionRefusedError:
+            error_msg = f"Connection refused. Is the server running on {self.host}:{self.port}?"
+            log.warning(error_msg)
+            return {
+                'status': 'error',
+                'message': error_msg,
+                'filename': filename
+            }
+            
+        except Exception as e:
+            error_msg = f"Error downloading file: {str(e)}"
+            log.warning(error_msg)
+            return {
+                'status': 'error',
+                'message': error_msg,
+                'filename': filename
+            }
+    
+    def download_file_segmented(self, filename, save_path=None, streams=DOWNLOAD_STREAMS):
+        """
+        Download a file over several connections at once, one byte range per connection
+        
+        The ranges are written into place in a preallocated file, and each one is
+        checked against the CRC32 the server sends for it. Every range must come
+        from the file 'version' (size, modification time, inode) the first
+        request saw, so a file replaced during the download (even by one of the
+        same size) fails it instead of being stitched together from two versions.
+        Small files, legacy servers and a single stream fall back to download_file.
+        
+        Args:
+            filename: Name of the file to download
+            save_path: Path where the file should be saved (optional)
+            streams: Number of connections (0 = pick from the file size, see choose_streams)
+            
+        Returns:
+            Dictionary containing status, message, and file info
+        """
+        if save_path is None:
+            save_path = os.path.join('downloads', filename)
+        
+        if self.protocol_mode == 'legacy' or (
+                self.protocol_mode == 'auto' and (self.host, self.port) in legacy_servers):
+            return self.download_file(filename, save_path)
+        
+        if self.resume and os.path.exists(save_path + PARTIAL_SUFFIX):
+            # Finishing an interrupted single-stream download only fetches what is missing
+            return self.download_file(filename, save_path)
+        
+        try:
+            # An empty range tells us the file size and version without transferring anything
+            with self.session() as session:
+                session.request_file(filename, 0, 0)
+                header, response = session.read_response()
+                if header.status == protocol.STATUS_OK:
+                    for _ in session.iter_body(0):
+                        pass
+        except protocol.LegacyPeerError:
+            # download_file works out the fallback to the legacy protocol
+            return self.download_file(filename, save_path)
+        except Exception as e:
+            return self.failed_results([filename], e)[0]
+        
+        if header.status != protocol.STATUS_OK:
+            error_msg = response.get('message', f"Server returned status {header.status}")
+            log.warning(f"Server error: {error_msg}")
+            return {
+                'status': 'error',
+                'message': error_msg,
+                'filename': filename
+            }
+        
+        file_size = response['size']
+        version = response.get('version')
+        streams = self.choose_streams(file_size, streams)
+        if streams <= 1:
+            return self.download_file(filename, save_path)
+        
+        save_dir = os.path.dirname(save_path)
+        if save_dir and not os.path.exists(save_dir):
+            os.makedirs(save_dir, exist_ok=True)
+        
+        # Split the file into `streams` nearly equal ranges
+        bounds = [file_size * i // streams for i in range(streams + 1)]
+        segments = [(bounds[i], bounds[i + 1] - bounds[i]) for i in range(streams)]
+        log.debug(f"File size: {file_size} bytes, downloading in {streams} segments")
+        
+        partial_path = save_path + PARTIAL_SUFFIX
+        with open(partial_path, 'wb') as file:
+            file.truncate(file_size)
+        
+        try:
+            with ThreadPoolExecutor(max_workers=streams, thread_name_prefix='Segment') as executor:
+                futures = [executor.submit(self.fetch_segment, filename, partial_path, offset, length,
+                                           file_size, version)
+                           for offset, length in segments]
+                bytes_received = sum(future.result() for future in futures)
+            
+            if bytes_received != file_size:
+                raise protocol.ProtocolError(f"Received {bytes_received} of {file_size} bytes")
+        except Exception as e:
+            # A preallocated file has no usable prefix to resume from
+            os.remove(partial_path)
+            return self.failed_results([filename], e)[0]
+        
+        os.replace(partial_path, save_path)
+        
+        log.info(f"File downloaded successfully: {save_path}")
+        log.info(f"Total bytes received: {bytes_received} ({streams} streams)")
+        
+        return {
+            'status': 'success',
+            'message': 'File downloaded successfully',
+            'filename': filename,
+            'save_path': save_path,
+            'size': bytes_received,
+            'streams': streams
+        }
+    
+    def choose_streams(self, file_size, streams=DOWNLOAD_STREAMS):
+        """
+        Decide how many connections a segmented download uses
+        
+        Args:
+            file_size: Size of the file in bytes
+            streams: Requested number of connections (0 = automatic)
+            
+        Returns:
+            Number of connections, at least 1
+        """
+        if not streams:
+            # One stream per SEGMENT_MIN_SIZE bytes, up to MAX_DOWNLOAD_STREAMS
+            streams = min(MAX_DOWNLOAD_STREAMS, file_size // SEGMENT_MIN_SIZE)
+        # Never split into ranges smaller than one receive buffer
+        return max(1, min(streams, file_size // CLIENT_RECV_SIZE))
+    
+    def fetch_segment(self, filename, path, offset, length, file_size, version=None):
+        """
+        Download one byte range of a file into place in a preallocated file
+        
+        Args:
+            filename: Name of the file on the server
+            path: Preallocated local file to write into
+            offset: First byte of the range
+            length: Number of bytes in the range
+            file_size: Size reported when the download started
+            version: File 'version' reported when the download started (None = only check the size)
+            
+        Returns:
+            Number of bytes received
+        """
+        with self.session() as session:
+            session.request_file(filename, offset, length)
+            header, response = session.read_response()
+            if header.status != protocol.STATUS_OK:
+                raise protocol.ProtocolError(response.get('message', f"Server returned status {header.status}"))
+            if (response['size'], response['offset'], response['length']) != (file_size, offset, length) or (
+                    version and response.get('version') != version):
+                raise protocol.ProtocolError(f"File '{filename}' changed on the server during the download")
+            
+            with open(path, 'r+b') as file:
+                file.seek(offset)
+                return session.receive_body(file, length, name=filename)
+    
+    def upload_file(self, local_path, filename=None, verify=VERIFY_CHECKSUMS):
+        """
+        Upload a file to the server over the framed protocol
+        
+        The server writes it to a temporary file and renames it into place only
+        once all of it has arrived intact.
+        
+        Args:
+            local_path: Path of the file to upload
+            filename: Name to store it under on the server (default: its base name)
+            verify: Send a CRC32 with every data frame and compare the server's total
+            
+        Returns:
+            Dictionary containing status, message, and file info
+        """
+        if filename is None:
+            filename = os.path.basename(local_path)
+        
+        try:
+            with open(local_path, 'rb') as file, self.session() as session:
+                crc = session.send_file(filename, file, os.fstat(file.fileno()).st_size, verify)
+                header, response = session.read_response()
+                
+        except protocol.LegacyPeerError:
+            legacy_servers.add((self.host, self.port))
+            return self.failed_upload(filename, "Server does not support uploads (legacy protocol)")
+            
+        except ConnectionRefusedError:
+            return self.failed_upload(filename, f"Connection refused. Is the server running on {self.host}:{self.port}?")
+            
+        except Exception as e:
+            return self.failed_upload(filename, f"Error uploading file: {str(e)}")
+        
+        if header.status != protocol.STATUS_OK:
+            return self.failed_upload(filename, response.get('message', f"Server returned status {header.status}"))
+        if verify and response.get('crc32') != crc:
+            return self.failed_upload(filename, "Checksum mismatch - the server stored different data")
+        
+        log.info(f"File uploaded successfully: {filename} ({response['size']} bytes)")
+        return {
+            'status': 'success',
+            'message': 'File uploaded successfully',
+            'filename': filename,
+            'size': response['size'],
+            'crc32': f"{response['crc32']:08x}",
+            'sha256': response.get('sha256')
+        }
+    
+    def failed_upload(self, filename, error_msg):
+        """
+        Build the error result of an upload
+        
+        Args:
+            filename: Name the file was to be stored under
+            error_msg: Description of the failure
+        """
+        log.warning(error_msg)
+        return {
+            'status': 'error',
+            'message': error_msg,
+            'filename': filename
+        }
+    
+    def download_files(self, filenames, save_dir='downloads', pipeline_depth=PIPELINE_DEPTH):
+        """
+        Download several files over one connection, pipelining the requests
+        
+        Up to `pipeline_depth` requests are kept in flight, so the server
+        starts on the next file while the previous response is still arriving.
+        
+        Args:
+            filenames: Names of the files to download
+            save_dir: Directory the files are saved into
+            pipeline_depth: Maximum number of outstanding requests
+            
+        Returns:
+            List of result dictionaries (see download_file), in request order
+        """
+        filenames = list(filenames)
+        if save_dir and not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        
+        if self.protocol_mode == 'legacy' or (
+                self.protocol_mode == 'auto' and (self.host, self.port) in legacy_servers):
+            return [self.download_file(name, os.path.join(save_dir, name)) for name in filenames]
+        
+        results = []
+        try:
+            with self.session() as session:
+                pending = collections.deque()
+                queued = iter(filenames)
+                
+                # The session's opening PING has already told a legacy server apart
+                for name in itertools.islice(queued, max(1, pipeline_depth)):
+                    self.request_download(session, name, os.path.join(save_dir, name))
+                    pending.append(name)
+                
+                while pending:
+                    name = pending.popleft()
+                    results.append(self.receive_file(session, name, os.path.join(save_dir, name)))
+                    
+                    # Keep the pipeline full
+                    for next_name in itertools.islice(queued, max(1, pipeline_depth) - len(pending)):
+                        self.request_download(session, next_name, os.path.join(save_dir, next_name))
+                        pending.append(next_name)
+            
+        except protocol.LegacyPeerError as e:
+            if results or self.protocol_mode == 'framed':
+                return results + self.failed_results(filenames[len(results):], e)
+            legacy_servers.add((self.host, self.port))
+            log.warning("Server did not answer in the framed protocol, retrying in legacy mode")
+            return [self.download_file(name, os.path.join(save_dir, name)) for name in filenames]
+            
+        except Exception as e:
+            return results + self.failed_results(filenames[len(results):], e)
+        
+        return results
+    
+    def failed_results(self, filenames, error):
+        """
+        Build error results for files that could not be downloaded
+        
+        Args:
+            filenames: Names of the files that failed
+            error: Exception that ended the session
+        """
+        if isinstance(error, ConnectionRefusedError):
+            error_msg = f"Connection refused. Is the server running on {self.host}:{self.port}?"
+        else:
+            error_msg = f"Error downloading file: {str(error)}"
+        log.warning(error_msg)
+        return [{'status': 'error', 'message': error_msg, 'filename': name} for name in filenames]
+    
+    def download_archive(self, names=None, pattern=None, save_path=None, archive_format='tar', compress=False):
+        """
+        Download several files as one archive, which the server builds while sending it
+        
+        Args:
+            names: Names of the files to include
+            pattern: Glob selecting the files to include (instead of `names`)
+            save_path: Path where the archive should be saved (default: downloads/files.<format>)
+            archive_format: 'tar' or 'zip'
+            compress: gzip the tar archive / deflate the members of the zip archive
+            
+        Returns:
+            Dictionary containing status, message, and archive info ('files' lists its members)
+        """
+        label = pattern if names is None else ', '.join(names)
+        if save_path is None:
+            save_path = os.path.join('downloads', archive_name(archive_format, compress))
+        save_dir = os.path.dirname(save_path)
+        if save_dir and not os.path.exists(save_dir):
+            os.makedirs(save_dir, exist_ok=True)
+        
+        partial_path = save_path + PARTIAL_SUFFIX
+        try:
+            with self.session() as session:
+                session.request_archive(names, pattern, archive_format, compress)
+                header, response = session.read_response()
+                if header.status != protocol.STATUS_OK:
+                    error_msg = response.get('message', f"Server returned status {header.status}")
+                    log.warning(f"Server error: {error_msg}")
+                    return {'status': 'error', 'message': error_msg, 'filename': label}
+                
+                log.debug(f"Receiving archive of {len(response['files'])} files ({response['size']} bytes)...")
+                with open(partial_path, 'wb') as file:
+                    bytes_received = session.receive_body(file, response['size'],
+                                                          name=archive_name(archive_format, compress))
+            os.replace(partial_path, save_path)
             
+        except Exception as e:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            if isinstance(e, protocol.LegacyPeerError):
+                error_msg = "Server does not support archives (legacy protocol)"
+            elif isinstance(e, ConnectionRefusedError):
+                error_msg = f"Connection refused. Is the server running on {self.host}:{self.port}?"
+            else:
+                error_msg = f"Error downloading archive: {str(e)}"
+            log.warning(error_msg)
+            return {'status': 'error', 'message': error_msg, 'filename': label}
+        
+        log.info(f"Archive downloaded successfully: {save_path} ({bytes_received} bytes)")
+        return {
+            'status': 'success',
+            'message': 'Archive downloaded successfully',
+            'filename': os.path.basename(save_path),
+            'save_path': save_path,
+            'size': bytes_received,
+            'files': response['files']
+        }
+    
+    @contextlib.contextmanager
+    def session(self):
+        """
+        Context manager yielding a framed session - pooled if this client has a pool
+        
+        A pooled session goes back to the pool when the block completes, and is
+        discarded if the block raised (the connection may be mid-response).
+        """
+        if self.pool is None:
+            with self.open_session() as session:
+                yield session
+        else:
+            with self.pool.session() as session:
+                yield session
+    
+    def open_session(self):
+        """
+        Open a persistent framed-protocol connection to the server
+        
+        Returns:
+            FileSession (usable as a context manager)
+        """
+        log.debug(f"Connecting to server {self.host}:{self.port}")
+        session = FileSession(self.host, self.port)
+        log.debug("Connected to server")
+        return session
+    
+    def download_file_framed(self, filename, save_path):
+        """
+        Download a file using the framed protocol (see protocol.py)
+        
+        Args:
+            filename: Name of the file to download
+            save_path: Path where the file should be saved
+            
+        Returns:
+            Dictionary containing status, message, and file info
+        """
+        session = None
+        try:
+            with self.session() as session:
+                self.request_download(session, filename, save_path)
+                return self.receive_file(session, filename, save_path)
+        except ConnectionError:
+            # A pooled connection may have been closed by the server just as it was
+            # reused; retry once on a fresh one
+            if session is None or not session.reused:
+                raise
+            log.warning("Pooled connection went stale, reconnecting")
+            with self.session() as session:
+                self.request_download(session, filename, save_path)
+                return self.receive_file(session, filename, save_path)
+    
+    def request_download(self, session, filename, save_path):
+        """
+        Send the GET request for a download, resuming from a partial file if there is one,
+        or sending the hash of an existing copy so an unchanged file is not sent again
+        
+        Args:
+            session: FileSession to send the request on
+            filename: Name of the file to download
+            save_path: Path where the file will be saved
+        """
+        offset, prefix_crc32 = 0, None
+        if self.resume:
+            try:
+                offset = os.path.getsize(save_path + PARTIAL_SUFFIX)
+            except OSError:
+                offset = 0
+            if offset:
+                # The server checks this against its copy before sending only the rest
+                prefix_crc32 = crc32_of_path(save_path + PARTIAL_SUFFIX)
+                log.debug(f"Found partial download, resuming from byte {offset}")
+        
+        if_none_match = None
+        if self.skip_unchanged and not offset and os.path.isfile(save_path):
+            if_none_match = sha256_of_path(save_path)
+        
+        accept_encoding = compression.supported_encodings() if self.compress else None
+        session.request_file(filename, offset, prefix_crc32=prefix_crc32, accept_encoding=accept_encoding,
+                             if_none_match=if_none_match)
+    
+    def receive_file(self, session, filename, save_path):
+        """
+        Read the response to a GET request already sent on `session` into a file
+        
+        Args:
+            session: FileSession the request was sent on
+            filename: Name of the requested file
+            save_path: Path where the file should be saved
+            
+        Returns:
+            Dictionary containing status, message, and file info
+        """
+        header, response = session.read_response()
+        
+        if header.status == protocol.STATUS_NOT_MODIFIED:
+            log.info(f"{save_path} is already up to date")
+            return {
+                'status': 'success',
+                'message': 'File is already up to date',
+                'filename': filename,
+                'save_path': save_path,
+                'size': response['size'],
+                'sha256': response['sha256'],
+                'unchanged': True
+            }
+        
+        if header.status != protocol.STATUS_OK:
+            error_msg = response.get('message', f"Server returned status {header.status}")
+            log.warning(f"Server error: {error_msg}")
+            return {
+                'status': 'error',
+                'message': error_msg,
+                'filename': filename
+            }
+        
+        file_size = response['size']
+        offset = response.get('offset', 0)
+        length = response.get('length', file_size)
+        encoding = response.get('encoding')
+        log.debug(f"File size: {file_size} bytes")
+        if encoding:
+            log.debug(f"Server is sending the data {encoding} compressed")
+        if offset:
+            log.debug(f"Receiving the remaining {length} bytes from byte {offset}...")
+        else:
+            log.debug("Receiving file...")
+        
+        save_dir = os.path.dirname(save_path)
+        if save_dir and not os.path.exists(save_dir):
+            os.makedirs(save_dir, exist_ok=True)
+        
+        # The server sends from offset 0 if our partial file no longer matched its copy
+        partial_path = save_path + PARTIAL_SUFFIX if self.resume else save_path
+        on_progress = None
+        if self.on_progress:
+            on_progress = lambda count: self.on_progress(offset + count, file_size)
+        with open(partial_path, 'r+b' if offset else 'wb') as file:
+            file.seek(offset)
+            file.truncate()
+            try:
+                bytes_received = session.receive_body(file, length, encoding, filename, on_progress)
+            except protocol.ChecksumMismatchError as e:
+                # The whole body was read, so the session is still usable; drop the
+                # corrupted bytes but keep the verified prefix for the next attempt
+                file.truncate(offset)
+                log.warning(str(e))
+                return {
+                    'status': 'error',
+                    'message': str(e),
+                    'filename': filename
+                }
+        
+        if partial_path != save_path:
+            os.replace(partial_path, save_path)
+        
+        log.info(f"File downloaded successfully: {save_path}")
+        
+        return {
+            'status': 'success',
+            'message': 'File downloaded successfully',
+            'filename': filename,
+            'save_path': save_path,
+            'size': offset + bytes_received,
+            'sha256': response.get('sha256')
+        }
+    
+    def download_file_legacy(self, filename, save_path):
+        """
+        Download a file using the legacy FILESIZE/READY/EOF protocol
+        
+        Args:
+            filename: Name of the file to download
+            save_path: Path where the file should be saved
+            
+        Returns:
+            Dictionary containing status, message, and file info
+        """
+        # Create TCP socket
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        
+        try:
             # Connect to server
-            print(f"[CLIENT] Connecting to server {self.host}:{self.port}")
+            log.debug(f"Connecting to server {self.host}:{self.port}")
             client_socket.connect((self.host, self.port))
-            print(f"[CLIENT] Connected to server")
+            log.debug("Connected to server")
             
             # Send filename to server
-            print(f"[CLIENT] Requesting file: {filename}")
+            log.debug(f"Requesting file: {filename}")
             client_socket.send(filename.encode('utf-8'))
             
             # Receive file size or error message
@@ -60,7 +649,7 @@ class FileClient:
             # Check for error
             if initial_response.startswith("ERROR"):
                 error_msg = initial_response.split("ERROR: ")[1]
-                print(f"[CLIENT] Server error: {error_msg}")
+                log.warning(f"Server error: {error_msg}")
                 client_socket.close()
                 return {
                     'status': 'error',
@@ -71,7 +660,7 @@ class FileClient:
             # Parse file size
             if initial_response.startswith("FILESIZE:"):
                 file_size = int(initial_response.split(":")[1])
-                print(f"[CLIENT] File size: {file_size} bytes")
+                log.debug(f"File size: {file_size} bytes")
             else:
                 raise Exception("Invalid server response")
             
@@ -79,8 +668,9 @@ class FileClient:
             client_socket.send("READY".encode('utf-8'))
             
             # Receive file data
-            print(f"[CLIENT] Receiving file...")
+            log.debug("Receiving file...")
             bytes_received = 0
+            progress = logs.TransferLog(log, 'Received', filename, file_size, (self.host, self.port))
             
             with open(save_path, 'wb') as file:
                 while bytes_received < file_size:
@@ -96,16 +686,17 @@ class FileClient:
                         if chunk:
                             file.write(chunk)
                             bytes_received += len(chunk)
+                            progress.update(len(chunk))
                         break
                     
                     file.write(chunk)
                     bytes_received += len(chunk)
-                    
-                    progress = (bytes_received / file_size) * 100
-                    print(f"[CLIENT] Progress: {bytes_received}/{file_size} bytes ({progress:.1f}%)")
+                    progress.update(len(chunk))
+                    if self.on_progress:
+                        self.on_progress(bytes_received, file_size)
             
-            print(f"[CLIENT] File downloaded successfully: {save_path}")
-            print(f"[CLIENT] Total bytes received: {bytes_received}")
+            progress.finish()
+            log.info(f"File downloaded successfully: {save_path}")
             
             client_socket.close()
             
@@ -117,22 +708,422 @@ class FileClient:
                 'size': bytes_received
             }
             
-        except ConnectionRefusedError:
-            error_msg = f"Connection refused. Is the server running on {self.host}:{self.port}?"
-            print(f"[CLIENT] {error_msg}")
-            return {
-                'status': 'error',
-                'message': error_msg,
-                'filename': filename
-            }
+        finally:
+            client_socket.close()
+
+
+class FileSession:
+    """Persistent framed-protocol connection that can carry many pipelined requests"""
+    
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT):
+        """
+        Connect to the server
+        
+        Args:
+            host: Server host address
+            port: Server port number
+        """
+        self.host = host
+        self.port = port
+        self.sock = socket.create_connection((host, port))
+        self.reader = protocol.SocketReader(self.sock)
+        self.negotiated = False
+        self.in_flight = 0
+        self.reused = False
+        self.last_used = time.monotonic()
+    
+    def ping(self):
+        """
+        Send a PING and wait for the answer
+        
+        Returns:
+            Round-trip time in seconds
+        """
+        started = time.monotonic()
+        # A server that only speaks the legacy protocol answers with plain text (or not at all)
+        self.sock.settimeout(NEGOTIATION_TIMEOUT)
+        try:
+            self.send_request(protocol.OP_PING, {})
+            header, response = self.read_response()
+        finally:
+            self.sock.settimeout(None)
+        if header.status != protocol.STATUS_OK:
+            raise protocol.ProtocolError(response.get('message', f"Ping failed with status {header.status}"))
+        return time.monotonic() - started
+    
+    def server_stats(self):
+        """
+        Ask the server for its counters and metrics (OP_STATS)
+        
+        Returns:
+            Response fields: 'stats' (counters), 'metrics' (see metrics.py), 'processes'
+        """
+        self.send_request(protocol.OP_STATS, {})
+        header, response = self.read_response()
+        if header.status != protocol.STATUS_OK:
+            raise protocol.ProtocolError(response.get('message', f"Stats failed with status {header.status}"))
+        return response
+    
+    def is_alive(self):
+        """
+        Cheap health check for an idle connection, without a network round-trip
+        
+        Returns:
+            False if the server closed the connection or sent unexpected data
+        """
+        try:
+            self.sock.setblocking(False)
+            try:
+                self.sock.recv(1, socket.MSG_PEEK)
+            finally:
+                self.sock.setblocking(True)
+        except (BlockingIOError, InterruptedError):
+            # Nothing to read - the connection is open and idle
+            return True
+        except OSError:
+            return False
+        # b'' means the server closed it; any data means the stream is out of sync
+        return False
+    
+    def request_file(self, filename, offset=0, length=None, prefix_crc32=None, accept_encoding=None,
+                     if_none_match=None):
+        """
+        Send a GET request without waiting for earlier responses
+        
+        Args:
+            filename: Name of the file to request
+            offset: First byte wanted (negative counts back from the end of the file)
+            length: Number of bytes wanted (None = up to the end of the file)
+            prefix_crc32: CRC32 of the bytes before `offset` already held by the caller;
+                the server sends the whole file instead if they no longer match
+            accept_encoding: Codec names the caller can decode, most preferred first; the server
+                may then send the body compressed and names the codec in the response's 'encoding'
+            if_none_match: SHA-256 of a copy the caller already has; the server answers
+                STATUS_NOT_MODIFIED without a body if the file still has that hash
+        """
+        log.debug(f"Requesting file: {filename}")
+        fields = {'name': filename}
+        if offset:
+            fields['offset'] = offset
+        if length is not None:
+            fields['length'] = length
+        if prefix_crc32 is not None:
+            fields['prefix_crc32'] = prefix_crc32
+        if accept_encoding:
+            fields['accept_encoding'] = list(accept_encoding)
+        if if_none_match is not None:
+            fields['if_none_match'] = if_none_match
+        self.send_request(protocol.OP_GET, fields)
+    
+    def request_archive(self, names=None, pattern=None, archive_format='tar', compress=False):
+        """
+        Send an ARCHIVE request without waiting for earlier responses
+        
+        Args:
+            names: Names of the files to include
+            pattern: Glob selecting the files to include (instead of `names`)
+            archive_format: 'tar' or 'zip'
+            compress: gzip the tar archive / deflate the members of the zip archive
+        """
+        fields = {'format': archive_format, 'compress': compress}
+        if names is not None:
+            fields['names'] = list(names)
+        if pattern is not None:
+            fields['pattern'] = pattern
+        log.debug(f"Requesting {archive_name(archive_format, compress)} of "
+                  f"{pattern if names is None else ', '.join(fields['names'])}")
+        self.send_request(protocol.OP_ARCHIVE, fields)
+    
+    def send_file(self, filename, file, file_size, checksum=True):
+        """
+        Send a PUT request followed by the contents of an open file
+        
+        Args:
+            filename: Name to store the file under on the server
+            file: Open binary file to read from
+            file_size: Size of the file (the server rejects the upload if it differs)
+            checksum: Attach a CRC32 to every data frame
+        
+        Returns:
+            CRC32 of everything sent
+        """
+        log.debug(f"Uploading file: {filename} ({file_size} bytes)")
+        self.send_request(protocol.OP_PUT, {'name': filename, 'size': file_size})
+        progress = logs.TransferLog(log, 'Sent', filename, file_size, (self.host, self.port))
+        
+        # Read one chunk ahead so the last frame can be flagged FLAG_END
+        crc = 0
+        chunk = file.read(UPLOAD_CHUNK_SIZE)
+        while True:
+            next_chunk = file.read(UPLOAD_CHUNK_SIZE) if chunk else b''
+            chunk_crc = zlib.crc32(chunk)
+            crc = zlib.crc32(chunk, crc)
+            self.sock.sendall(protocol.pack_header(protocol.OP_DATA, length=len(chunk),
+                                                   checksum=chunk_crc if checksum else None,
+                                                   flags=0 if next_chunk else protocol.FLAG_END) + chunk)
+            progress.update(len(chunk))
             
-        except Exception as e:
-            error_msg = f"Error downloading file: {str(e)}"
-            print(f"[CLIENT] {error_msg}")
+            if not next_chunk:
+                progress.finish()
+                return crc
+            chunk = next_chunk
+    
+    def send_request(self, opcode, fields):
+        """
+        Send a request frame, opening a new session with a PING first
+        
+        Only the PING answer is waited for with NEGOTIATION_TIMEOUT: the server
+        may read a whole file (checksums, hashes) before it answers a GET, so
+        a slow answer to a real request says nothing about the dialect.
+        
+        Args:
+            opcode: protocol.OP_* value
+            fields: Request fields
+        
+        Raises:
+            protocol.LegacyPeerError: If the server answered the PING in the legacy protocol
+        """
+        if not self.negotiated and opcode != protocol.OP_PING:
+            self.ping()
+        self.sock.sendall(protocol.pack_message(opcode, fields, checksum=False))
+        self.in_flight += 1
+    
+    def read_response(self):
+        """
+        Read the response header for the oldest outstanding request
+        
+        Returns:
+            Tuple of (protocol.Header, response fields)
+        """
+        header, response = self.reader.read_message()
+        self.negotiated = True
+        self.in_flight -= 1
+        return header, response
+    
+    def receive_body(self, file, file_size, encoding=None, name=None, progress=None):
+        """
+        Receive OP_DATA frames up to the one flagged FLAG_END and write them to a file
+        
+        Args:
+            file: Open binary file to write to
+            file_size: Expected body size (used for progress output)
+            encoding: Codec the body was compressed with ('encoding' of the response), if any
+            name: File name for the transfer log (see iter_body)
+            progress: Called with the number of bytes written so far after every chunk
+            
+        Returns:
+            Number of (decompressed) bytes written
+        """
+        bytes_received = 0
+        for chunk in self.iter_body(file_size, encoding, name):
+            file.write(chunk)
+            bytes_received += len(chunk)
+            if progress:
+                progress(bytes_received)
+        return bytes_received
+    
+    def iter_body(self, file_size, encoding=None, name=None):
+        """
+        Yield the data of OP_DATA frames up to the one flagged FLAG_END
+        
+        The checksum is verified once the whole body has been read, so the
+        final iteration raises ChecksumMismatchError if the data was corrupted.
+        
+        Args:
+            file_size: Expected body size (used for progress output)
+            encoding: Codec to decompress the body with; None yields the frames' data as sent
+            name: File name for the transfer log; None logs nothing (e.g. when a body is discarded)
+        
+        Yields:
+            Chunks of file data
+        """
+        decoder = compression.Decoder(encoding) if encoding else None
+        progress = logs.TransferLog(log, 'Received', name, file_size, (self.host, self.port),
+                                    LOG_PROGRESS_INTERVAL if name else 0)
+        checksum_ok = True
+        decode_ok = True
+        while True:
+            header = self.reader.read_header()
+            if header.opcode != protocol.OP_DATA:
+                raise protocol.ProtocolError(f"Expected data frame, got opcode {header.opcode}")
+            
+            remaining = header.length
+            crc = 0
+            while remaining:
+                chunk = self.reader.read_some(min(CLIENT_RECV_SIZE, remaining))
+                if not chunk:
+                    raise ConnectionError("Connection closed during transfer")
+                
+                crc = zlib.crc32(chunk, crc)
+                remaining -= len(chunk)
+                if decoder and decode_ok:
+                    # Keep reading after a decoding error so the session stays in step
+                    try:
+                        chunk = decoder.decode(chunk)
+                    except Exception:
+                        decode_ok = False
+                if decode_ok and chunk:
+                    progress.update(len(chunk))
+                    yield chunk
+            
+            if header.flags & protocol.FLAG_CHECKSUM and crc != header.checksum:
+                checksum_ok = False
+            
+            if header.flags & protocol.FLAG_END:
+                break
+        
+        if not checksum_ok:
+            raise protocol.ChecksumMismatchError("Checksum mismatch - file data was corrupted in transit")
+        if decoder and decode_ok:
+            try:
+                tail = decoder.finish()
+            except Exception:
+                decode_ok = False
+            else:
+                if tail:
+                    progress.update(len(tail))
+                    yield tail
+        if not decode_ok:
+            raise protocol.ChecksumMismatchError(f"Could not decompress {encoding} data - corrupted in transit")
+        if name:
+            progress.finish()
+    
+    def close(self):
+        """Close the connection"""
+        self.sock.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ConnectionPool:
+    """Thread-safe pool of idle framed-protocol connections to one server"""
+    
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, max_size=POOL_MAX_SIZE,
+                 idle_timeout=POOL_IDLE_TIMEOUT):
+        """
+        Initialize the connection pool
+        
+        Args:
+            host: Server host address
+            port: Server port number
+            max_size: Maximum number of idle connections kept open
+            idle_timeout: Seconds an idle connection may be kept before it is closed
+        """
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+    
+    def acquire(self):
+        """
+        Take a healthy idle connection, or open a new one
+        
+        Returns:
+            FileSession owned by the caller until release()
+        """
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                session = self.idle.pop() if self.idle else None
+            if session is None:
+                break
+            
+            if now - session.last_used < self.idle_timeout and session.is_alive():
+                session.reused = True
+                with self.lock:
+                    self.reused += 1
+                return session
+            
+            self.discard(session)
+        
+        session = FileSession(self.host, self.port)
+        with self.lock:
+            self.created += 1
+        return session
+    
+    def release(self, session):
+        """
+        Return a connection to the pool once its responses have all been read
+        
+        Args:
+            session: FileSession obtained from acquire()
+        """
+        if session.in_flight:
+            self.discard(session)
+            return
+        
+        session.last_used = time.monotonic()
+        with self.lock:
+            if len(self.idle) < self.max_size:
+                self.idle.append(session)
+                return
+        self.discard(session)
+    
+    def discard(self, session):
+        """
+        Close a connection instead of returning it to the pool
+        
+        Args:
+            session: FileSession to close
+        """
+        with self.lock:
+            self.discarded += 1
+        try:
+            session.close()
+        except OSError:
+            pass
+    
+    @contextlib.contextmanager
+    def session(self):
+        """Context manager that acquires a connection and releases (or discards) it"""
+        session = self.acquire()
+        try:
+            yield session
+        except BaseException:
+            self.discard(session)
+            raise
+        self.release(session)
+    
+    def ping(self):
+        """
+        Check that the server is up and speaks the framed protocol
+        
+        Returns:
+            Round-trip time in seconds
+        """
+        with self.session() as session:
+            return session.ping()
+    
+    def server_stats(self):
+        """Ask the server for its counters and metrics over a pooled connection (see FileSession.server_stats)"""
+        with self.session() as session:
+            return session.server_stats()
+    
+    def close_all(self):
+        """Close every idle connection"""
+        with self.lock:
+            sessions = list(self.idle)
+            self.idle.clear()
+        for session in sessions:
+            self.discard(session)
+    
+    def get_stats(self):
+        """Return a snapshot of the pool counters"""
+        with self.lock:
             return {
-                'status': 'error',
-                'message': error_msg,
-                'filename': filename
+                'idle': len(self.idle),
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded
             }
 
 
@@ -141,22 +1132,32 @@ def main():
     print("=== File Download Client ===")
     print(f"Server: {SERVER_HOST}:{SERVER_PORT}\n")
     
-    filename = input("Enter filename to download: ").strip()
+    filenames = input("Enter filename(s) to download (separate several with spaces, "
+                      "or one pattern such as *.txt for an archive): ").split()
     
-    if not filename:
+    if not filenames:
         print("No filename provided. Exiting.")
         return
     
     client = FileClient()
-    result = client.download_file(filename)
-    
-    if result['status'] == 'success':
-        print(f"\n✓ SUCCESS: {result['message']}")
-        print(f"  File: {result['filename']}")
-        print(f"  Saved to: {result['save_path']}")
-        print(f"  Size: {result['size']} bytes")
+    if len(filenames) == 1 and any(char in filenames[0] for char in '*?['):
+        # A wildcard pattern: everything that matches comes as one archive
+        results = [client.download_archive(pattern=filenames[0])]
+    elif len(filenames) == 1:
+        # Large files are split across several connections
+        results = [client.download_file_segmented(filenames[0])]
     else:
-        print(f"\n✗ ERROR: {result['message']}")
+        # Several files share one connection with pipelined requests
+        results = client.download_files(filenames)
+    
+    for result in results:
+        if result['status'] == 'success':
+            print(f"\n✓ SUCCESS: {result['message']}")
+            print(f"  File: {result['filename']}")
+            print(f"  Saved to: {result['save_path']}")
+            print(f"  Size: {result['size']} bytes")
+        else:
+            print(f"\n✗ ERROR: {result['filename']}: {result['message']}")
 
 
 if __name__ == "__main__":
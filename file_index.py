@@ -0,0 +1,254 @@
+"""
+File Index - in-memory metadata for the files in FILES_DIRECTORY
+Keeps name, size, modification time, content type, CRC32 and SHA-256 of every file so
+the web interface can list, sort, filter and page through the directory
+without touching the disk on each request.
+
+The index stays current three ways: the web interface updates it directly on
+upload and delete; every query compares the directory's mtime (one stat) and,
+if it changed, rescans the names to pick up added and removed files; and a
+background thread periodically re-stats every file to catch files rewritten
+in place, hashing new and changed ones as it goes.
+"""
+
+import bisect
+import mimetypes
+import os
+import threading
+import time
+from config import FILES_DIRECTORY, FILE_INDEX_SCAN_INTERVAL
+from checksums import crc32_of_path
+from content_store import content_store
+from uploads import TEMP_PREFIX
+import logs
+
+log = logs.get_logger('index')
+
+# Sort keys accepted by FileIndex.query
+SORT_KEYS = ('name', 'size', 'mtime')
+
+
+class FileIndex:
+    """Thread-safe metadata index of one directory"""
+    
+    def __init__(self, directory=FILES_DIRECTORY, scan_interval=FILE_INDEX_SCAN_INTERVAL):
+        """
+        Initialize the index (the directory is first scanned on the first query)
+        
+        Args:
+            directory: Directory to index
+            scan_interval: Seconds between background full rescans (0 = never)
+        """
+        self.directory = directory
+        self.scan_interval = scan_interval
+        self.entries = {}
+        self.names = []
+        self.views = {}
+        self.directory_mtime = None
+        self.lock = threading.Lock()
+        self.scan_lock = threading.Lock()
+        self.scanner = None
+    
+    def start(self):
+        """Scan the directory and start the background rescan thread"""
+        self.full_scan()
+        if self.scan_interval and self.scanner is None:
+            self.scanner = threading.Thread(target=self._scan_loop, name="FileIndexScanner")
+            self.scanner.daemon = True
+            self.scanner.start()
+    
+    def query(self, prefix='', sort='name', descending=False, offset=0, limit=None):
+        """
+        Return one page of file entries
+        
+        Args:
+            prefix: Only include names starting with this string
+            sort: One of SORT_KEYS
+            descending: Reverse the sort order
+            offset: Number of matching entries to skip
+            limit: Maximum number of entries to return (None = all)
+        
+        Returns:
+            Tuple of (number of matching entries, list of entry dictionaries)
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort key: {sort}")
+        self.check_directory()
+        
+        with self.lock:
+            if sort == 'name':
+                # Names are kept sorted, so a prefix is a contiguous range
+                ordered = self.names
+                start = bisect.bisect_left(ordered, prefix)
+                end = bisect.bisect_left(ordered, prefix + '\U0010ffff') if prefix else len(ordered)
+            else:
+                ordered = self.sorted_view(sort)
+                if prefix:
+                    ordered = [name for name in ordered if name.startswith(prefix)]
+                start, end = 0, len(ordered)
+            
+            # Only the requested page is copied out
+            total = end - start
+            count = max(0, total - offset) if limit is None else max(0, min(limit, total - offset))
+            if descending:
+                page = ordered[end - offset - count:end - offset][::-1]
+            else:
+                page = ordered[start + offset:start + offset + count]
+            return total, [dict(self.entries[name]) for name in page]
+    
+    def get(self, name):
+        """
+        Return the entry for one file, or None if it is not indexed
+        
+        Args:
+            name: File name
+        """
+        self.check_directory()
+        with self.lock:
+            entry = self.entries.get(name)
+            return dict(entry) if entry else None
+    
+    def update(self, name, crc32=None, sha256=None):
+        """
+        Re-read one file's metadata (call after creating or replacing it)
+        
+        Args:
+            name: File name
+            crc32: CRC32 of the new contents, if the caller already computed it
+            sha256: Hex SHA-256 of the new contents, if the caller already computed it
+        """
+        try:
+            st = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            self.remove(name)
+            return
+        with self.lock:
+            self._put(name, st)
+            if crc32 is not None:
+                self.entries[name]['crc32'] = f"{crc32:08x}"
+            if sha256 is not None:
+                self.entries[name]['sha256'] = sha256
+    
+    def remove(self, name):
+        """
+        Drop one file from the index (call after deleting it)
+        
+        Args:
+            name: File name
+        """
+        with self.lock:
+            self._drop(name)
+    
+    def check_directory(self):
+        """Rescan the file names if the directory changed since the last scan"""
+        mtime = os.stat(self.directory).st_mtime_ns
+        if mtime != self.directory_mtime:
+            self.scan_names()
+    
+    def scan_names(self):
+        """Pick up added and removed files; only new files are stat()ed"""
+        with self.scan_lock:
+            mtime = os.stat(self.directory).st_mtime_ns
+            with os.scandir(self.directory) as it:
+                found = {entry.name: entry for entry in it
+                         if entry.is_file() and not entry.name.startswith(TEMP_PREFIX)}
+            
+            with self.lock:
+                known = set(self.entries)
+            added = {}
+            for name in found.keys() - known:
+                try:
+                    added[name] = found[name].stat()
+                except OSError:
+                    pass
+            
+            with self.lock:
+                for name in known - found.keys():
+                    self._drop(name)
+                for name, st in added.items():
+                    self._put(name, st)
+                self.directory_mtime = mtime
+    
+    def full_scan(self):
+        """Re-stat every file, then hash the ones whose checksums are unknown"""
+        with self.scan_lock:
+            mtime = os.stat(self.directory).st_mtime_ns
+            found = {}
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file() and not entry.name.startswith(TEMP_PREFIX):
+                            found[entry.name] = entry.stat()
+                    except OSError:
+                        pass
+            
+            with self.lock:
+                for name in set(self.entries) - found.keys():
+                    self._drop(name)
+                for name, st in found.items():
+                    entry = self.entries.get(name)
+                    if not entry or (entry['size'], entry['mtime_ns']) != (st.st_size, st.st_mtime_ns):
+                        self._put(name, st)
+                self.directory_mtime = mtime
+                unhashed = [(name, entry['mtime_ns']) for name, entry in self.entries.items()
+                             if entry['crc32'] is None or entry['sha256'] is None]
+        
+        # One map save for the whole scan rather than one per file hashed
+        with content_store.batch():
+            for name, mtime_ns in unhashed:
+                path = os.path.join(self.directory, name)
+                try:
+                    crc = crc32_of_path(path)
+                    # Also deduplicates the file if the content store is enabled
+                    digest = content_store.hash_of(path)
+                except OSError:
+                    continue
+                with self.lock:
+                    entry = self.entries.get(name)
+                    # Only record the hashes if the file did not change while it was read
+                    if entry and entry['mtime_ns'] == mtime_ns:
+                        entry['crc32'] = f"{crc:08x}"
+                        entry['sha256'] = digest
+    
+    def sorted_view(self, key):
+        """
+        Return all names ordered by `key`, reusing the order until the index changes
+        
+        Args:
+            key: 'size' or 'mtime'
+        """
+        view = self.views.get(key)
+        if view is None:
+            view = sorted(self.names, key=lambda name: self.entries[name][key])
+            self.views[key] = view
+        return view
+    
+    def _put(self, name, st):
+        """Add or replace an entry (caller holds the lock)"""
+        if name not in self.entries:
+            bisect.insort(self.names, name)
+        self.entries[name] = {
+            'name': name,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'mtime_ns': st.st_mtime_ns,
+            'content_type': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            'crc32': None,
+            'sha256': content_store.lookup(os.path.join(self.directory, name), st)
+        }
+        self.views.clear()
+    
+    def _drop(self, name):
+        """Remove an entry if present (caller holds the lock)"""
+        if self.entries.pop(name, None) is not None:
+            del self.names[bisect.bisect_left(self.names, name)]
+            self.views.clear()
+    
+    def _scan_loop(self):
+        """Rescan the directory every scan_interval seconds"""
+        while True:
+            time.sleep(self.scan_interval)
+            try:
+                self.full_scan()
+            except OSError as e:
+                log.warning(f"Scan of {self.directory} failed: {str(e)}")
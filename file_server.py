@@ -1,21 +1,67 @@
 """
 Concurrent File Server - Multi-threaded TCP Server
 Handles multiple client connections simultaneously using threading.
-Each client connection is handled by a separate thread.
+Each client connection is handled by a separate thread, or by a bounded
+pool of worker threads when SERVER_MODE is 'pool'. A ConnectionGuard reads
+the first request of every connection off the accept thread and closes
+connections whose clients stall (see HANDSHAKE_TIMEOUT, IDLE_TIMEOUT and
+TRANSFER_TIMEOUT in config.py).
 """
 
+import argparse
+import collections
+import selectors
 import socket
 import threading
-import time
+import queue
 import os
+import stat
 import sys
-from config import SERVER_HOST, SERVER_PORT, BUFFER_SIZE, SLEEP_TIME, FILES_DIRECTORY
+import time
+import zlib
+from config import (SERVER_HOST, SERVER_PORT, BUFFER_SIZE, FILES_DIRECTORY, USE_SENDFILE,
+                    LISTEN_BACKLOG, SERVER_ENGINE, SERVER_MODE, WORKER_POOL_SIZE,
+                    REQUEST_QUEUE_SIZE, OVERLOAD_POLICY, VERIFY_CHECKSUMS,
+                    KEEPALIVE_TIMEOUT, SERVER_PROCESSES, HANDSHAKE_TIMEOUT, IDLE_TIMEOUT, TRANSFER_TIMEOUT,
+                    REAP_INTERVAL, MAX_PENDING_CONNECTIONS)
+from rate_limiter import bandwidth_manager
+from checksums import checksum_cache
+from file_cache import file_cache, shared_mappings, CachedFile, version_tag
+from uploads import AtomicUpload, UploadError
+from content_store import content_store
+import archive
+import compression
+import logs
+import metrics
+import protocol
+
+# Sent to clients that are turned away because the server is at capacity
+BUSY_MESSAGE = "ERROR: BUSY - server is at capacity, try again later"
+
+log = logs.get_logger('server')
+pool_log = logs.get_logger('pool')
+thread_log = logs.get_logger('thread')
+
+# Metrics recorded by both server engines (see metrics.py)
+connections_total = metrics.counter('connections_total', "Client connections accepted", ('protocol',))
+open_connections = metrics.gauge('active_connections', "Client connections being served")
+requests_total = metrics.counter('requests_total', "Requests answered", ('op',))
+request_seconds = metrics.histogram('request_duration_seconds',
+                                    "Time from reading a request to sending the end of its answer", ('op',))
+errors_total = metrics.counter('errors_total', "Error responses and failed connections", ('op', 'status'))
+queue_wait_seconds = metrics.histogram('queue_wait_seconds', "Time a connection waited for a free worker ('pool' mode)")
+connections_reaped = metrics.counter('connections_reaped_total', "Connections closed because the client stalled",
+                                     ('reason',))
+
+# Why a connection was reaped: no request within HANDSHAKE_TIMEOUT, no data moved
+# for IDLE_TIMEOUT, or a request still running after TRANSFER_TIMEOUT
+REAP_REASONS = ('handshake', 'idle', 'deadline')
 
 
 class FileServerThread(threading.Thread):
     """Thread class to handle individual client file requests"""
     
-    def __init__(self, client_socket, client_address, filename):
+    def __init__(self, client_socket, client_address, filename, guard=None):
         """
         Initialize the file server thread
         
@@ -23,33 +69,84 @@ class FileServerThread(threading.Thread):
             client_socket: Socket object for client connection
             client_address: Tuple containing client's address information
             filename: Name of the file requested by the client
+            guard: ConnectionGuard enforcing the transfer deadline of requests, if any
         """
         threading.Thread.__init__(self)
         self.client_socket = client_socket
         self.client_address = client_address
         self.filename = filename
+        self.guard = guard
+        self.deadline = None
+        self.reaped = False
+        self.progress = None
+        self.queued_at = None
         self.daemon = True
+    
+    def reject_busy(self):
+        """Tell the client the server is at capacity and close the connection"""
+        try:
+            self.client_socket.send(BUSY_MESSAGE.encode('utf-8'))
+        except OSError:
+            pass
+        finally:
+            self.client_socket.close()
+    
+    def transfer_log(self, name, total):
+        """
+        Start the log of a download to this client; the send methods count its bytes
+        
+        Args:
+            name: File (or archive) name
+            total: Number of bytes to send, if known
+        
+        Returns:
+            logs.TransferLog, to be used as a context manager
+        """
+        self.progress = logs.TransferLog(thread_log, 'Sent', name, total, self.client_address)
+        return self.progress
+    
+    def watch(self):
+        """Start the transfer deadline of a request"""
+        if self.guard:
+            self.guard.watch(self)
+    
+    def unwatch(self):
+        """End the transfer deadline of a request"""
+        if self.guard:
+            self.guard.unwatch(self)
+    
+    def log_stalled(self):
+        """Count and log a request abandoned because no data moved for IDLE_TIMEOUT seconds"""
+        connections_reaped.inc('idle')
+        thread_log.warning(f"Closing connection from {self.client_address}: "
+                           f"no data moved for {IDLE_TIMEOUT} seconds")
         
     def run(self):
         """
         Thread execution method - handles file transfer to client
         """
-        print(f"[THREAD {threading.current_thread().name}] Handling request from {self.client_address}")
-        print(f"[THREAD {threading.current_thread().name}] Requested file: {self.filename}")
+        thread_log.debug(f"Handling request from {self.client_address}")
+        thread_log.debug(f"Requested file: {self.filename}")
+        open_connections.inc()
+        started = time.monotonic()
+        self.watch()
         
         try:
             # Construct the full file path
             file_path = os.path.join(FILES_DIRECTORY, self.filename)
             
-            # Check if file exists
-            if not os.path.exists(file_path):
+            # Open the file (from memory if it is in the hot file cache)
+            try:
+                file, st = file_cache.open(file_path)
+            except OSError:
                 error_message = f"ERROR: File '{self.filename}' not found on server"
                 self.client_socket.send(error_message.encode('utf-8'))
-                print(f"[THREAD {threading.current_thread().name}] File not found: {self.filename}")
+                thread_log.info(f"File not found: {self.filename}")
+                errors_total.inc('legacy', 'not_found')
                 return
             
             # Get file size
-            file_size = os.path.getsize(file_path)
+            file_size = st.st_size
             
             # Send file size first
             self.client_socket.send(f"FILESIZE:{file_size}".encode('utf-8'))
@@ -57,66 +154,1063 @@ class FileServerThread(threading.Thread):
             # Wait for acknowledgment
             ack = self.client_socket.recv(1024).decode('utf-8')
             if ack != "READY":
-                print(f"[THREAD {threading.current_thread().name}] Client not ready")
+                file.close()
+                thread_log.warning("Client not ready")
                 return
             
-            print(f"[THREAD {threading.current_thread().name}] Starting file transfer ({file_size} bytes)")
-            
-            # Open and send file in chunks
-            bytes_sent = 0
-            with open(file_path, 'rb') as file:
-                while True:
-                    # Read chunk of data (max BUFFER_SIZE bytes)
-                    chunk = file.read(BUFFER_SIZE)
-                    
-                    if not chunk:
-                        break
-                    
-                    # Send the chunk
-                    self.client_socket.send(chunk)
-                    bytes_sent += len(chunk)
-                    
-                    print(f"[THREAD {threading.current_thread().name}] Sent {len(chunk)} bytes "
-                          f"({bytes_sent}/{file_size} bytes total)")
-                    
-                    # Sleep for 200 milliseconds after each flush
-                    time.sleep(SLEEP_TIME)
+            thread_log.debug(f"Starting file transfer ({file_size} bytes)")
             
-            print(f"[THREAD {threading.current_thread().name}] File transfer completed: {bytes_sent} bytes sent")
+            # Send the file: from memory, or zero-copy when the kernel can do it
+            with file, bandwidth_manager.open_transfer(self.client_address, self.filename) as transfer, \
+                    self.transfer_log(self.filename, file_size):
+                self.send_file_body(file, file_size, transfer)
             
             # Send completion signal
             self.client_socket.send(b"EOF")
             
+        except socket.timeout:
+            self.log_stalled()
+            
         except Exception as e:
+            if self.reaped:
+                # The ConnectionGuard shut the socket down at the transfer deadline
+                return
             error_message = f"ERROR: {str(e)}"
             try:
                 self.client_socket.send(error_message.encode('utf-8'))
             except:
                 pass
-            print(f"[THREAD {threading.current_thread().name}] Error: {str(e)}")
+            thread_log.error(f"Error: {str(e)}")
+            errors_total.inc('legacy', 'error')
             
         finally:
             # Close the client socket
+            self.unwatch()
             self.client_socket.close()
-            print(f"[THREAD {threading.current_thread().name}] Connection closed with {self.client_address}")
+            requests_total.inc('legacy')
+            request_seconds.observe(time.monotonic() - started, 'legacy')
+            open_connections.dec()
+            thread_log.debug(f"Connection closed with {self.client_address}")
+    
+
+    def send_file_body(self, file, length, transfer, offset=0):
+        """
+        Send part of an open file, picking the fastest path that applies
+        
+        Args:
+            file: Open binary file object
+            length: Number of bytes to send
+            transfer: rate_limiter.Transfer pacing this download
+            offset: Position in the file of the first byte to send
+            
+        Returns:
+            Number of bytes sent
+        """
+        if isinstance(file, CachedFile):
+            return self.send_from_memory(file.data, length, transfer, offset)
+        st = os.fstat(file.fileno())
+        if shared_mappings.should_map(st):
+            with shared_mappings.map(file, st) as data:
+                return self.send_from_memory(data, length, transfer, offset)
+        if USE_SENDFILE and stat.S_ISREG(st.st_mode):
+            return self.send_zero_copy(file, length, transfer, offset)
+        return self.send_buffered(file, length, transfer, offset)
+    
+    def send_from_memory(self, data, length, transfer, offset=0):
+        """
+        Send file contents held in memory (a cached copy or a shared mapping) as slices, without copying
+        
+        Args:
+            data: File contents (bytes or mmap)
+            length: Number of bytes to send
+            transfer: rate_limiter.Transfer pacing this download
+            offset: Position in the file of the first byte to send
+            
+        Returns:
+            Number of bytes sent
+        """
+        view = memoryview(data)[offset:offset + length]
+        if not transfer.limited:
+            self.send_view(view)
+            self.progress.update(len(view))
+            return len(view)
+        
+        bytes_sent = 0
+        while bytes_sent < len(view):
+            chunk = view[bytes_sent:bytes_sent + transfer.chunk_size()]
+            transfer.throttle(len(chunk))
+            self.client_socket.sendall(chunk)
+            bytes_sent += len(chunk)
+            self.progress.update(len(chunk))
+        return bytes_sent
+    
+    def send_view(self, view):
+        """
+        Send a buffer of any size, waiting at most IDLE_TIMEOUT for each part of it
+        
+        sendall() counts the socket timeout against the whole call, which
+        would cut off a large send to a slow but live client; send() only
+        times out if the client accepts nothing for the whole timeout.
+        
+        Args:
+            view: memoryview of the data
+        """
+        while view:
+            sent = self.client_socket.send(view)
+            view = view[sent:]
+    
+    def send_zero_copy(self, file, length, transfer, offset=0):
+        """
+        Send a regular file with socket.sendfile so the data never enters user space
+        
+        Args:
+            file: Open binary file object
+            length: Number of bytes to send
+            transfer: rate_limiter.Transfer pacing this download
+            offset: Position in the file of the first byte to send
+            
+        Returns:
+            Number of bytes sent
+        """
+        if not length:
+            return 0
+        
+        if not transfer.limited:
+            # No bandwidth limit applies - hand the whole range to the kernel in one call
+            bytes_sent = self.client_socket.sendfile(file, offset, length)
+            self.progress.update(bytes_sent)
+            return bytes_sent
+        
+        # Rate limited: send slices no larger than the token bucket's burst
+        bytes_sent = 0
+        while bytes_sent < length:
+            count = min(transfer.chunk_size(), length - bytes_sent)
+            transfer.throttle(count)
+            sent = self.client_socket.sendfile(file, offset + bytes_sent, count)
+            if not sent:
+                break
+            bytes_sent += sent
+            self.progress.update(sent)
+        return bytes_sent
+    
+    def send_buffered(self, file, length, transfer, offset=0):
+        """
+        Send a file by reading it in BUFFER_SIZE chunks (pipes, devices, or USE_SENDFILE off)
+        
+        Args:
+            file: Open binary file object
+            length: Number of bytes to send (the size reported for the file)
+            transfer: rate_limiter.Transfer pacing this download
+            offset: Position in the file of the first byte to send
+            
+        Returns:
+            Number of bytes sent
+        """
+        if offset:
+            file.seek(offset)
+        
+        bytes_sent = 0
+        while bytes_sent < length:
+            # Read chunk of data (max BUFFER_SIZE bytes)
+            chunk = file.read(min(BUFFER_SIZE, length - bytes_sent))
+            
+            if not chunk:
+                break
+            
+            # Wait for bandwidth, then send the chunk
+            transfer.throttle(len(chunk))
+            self.client_socket.sendall(chunk)
+            bytes_sent += len(chunk)
+            self.progress.update(len(chunk))
+        return bytes_sent
+
+
+class FramedSessionThread(FileServerThread):
+    """Thread class serving a client that speaks the framed protocol (see protocol.py)"""
+    
+    def __init__(self, client_socket, client_address, initial_data, server=None):
+        """
+        Initialize the session thread
+        
+        Args:
+            client_socket: Socket object for client connection
+            client_address: Tuple containing client's address information
+            initial_data: Bytes already received from the client (start of the first frame)
+            server: ConcurrentFileServer whose stats OP_STATS reports (and whose guard
+                enforces the transfer deadline of each request)
+        """
+        FileServerThread.__init__(self, client_socket, client_address, None, server.guard if server else None)
+        self.reader = protocol.SocketReader(client_socket, initial_data)
+        self.server = server
+        # Pool workers are not held while the session is idle (see run)
+        self.park_idle = bool(server and server.worker_pool)
+        self.opened = False
+        self.requests_served = 0
+    
+    def reject_busy(self):
+        """Tell the client the server is at capacity and close the connection"""
+        try:
+            self.send_error(protocol.OP_ERROR, protocol.STATUS_BUSY,
+                            "Server is at capacity, try again later")
+        except OSError:
+            pass
+        finally:
+            self.close()
+    
+    def close(self):
+        """Close the connection (the guard calls this for sessions that went idle while parked)"""
+        self.client_socket.close()
+        if self.opened:
+            open_connections.dec()
+            thread_log.debug(f"Connection closed with {self.client_address} "
+                             f"after {self.requests_served} requests")
+    
+    def request_waiting(self):
+        """
+        Check, without waiting, whether the next request has fully arrived
+        
+        Pulls whatever the socket already holds into the reader's buffer.
+        A closed connection counts as waiting, so run() sees the end of it.
+        """
+        self.client_socket.setblocking(False)
+        try:
+            while not protocol.request_complete(self.reader.buffer):
+                chunk = self.client_socket.recv(65536)
+                if not chunk:
+                    return True
+                self.reader.buffer += chunk
+            return True
+        except BlockingIOError:
+            return False
+        finally:
+            self.client_socket.settimeout(IDLE_TIMEOUT or None)
+    
+    def run(self):
+        """
+        Thread execution method - answers request frames until the client disconnects
+        
+        In 'pool' mode a session with no request waiting is parked with the
+        guard instead of holding its worker through KEEPALIVE_TIMEOUT; the guard
+        resubmits it to the pool once the next request has arrived, and this
+        method picks up where it left off.
+        """
+        if not self.opened:
+            self.opened = True
+            thread_log.debug(f"Handling protocol session from {self.client_address}")
+            open_connections.inc()
+        parked = False
+        
+        try:
+            while True:
+                if self.park_idle and not self.request_waiting():
+                    parked = True
+                    self.guard.park(self)
+                    return
+                
+                # Wait for the next (possibly already pipelined) request
+                self.client_socket.settimeout(KEEPALIVE_TIMEOUT or None)
+                try:
+                    message = self.reader.read_message(allow_eof=True)
+                except socket.timeout:
+                    thread_log.debug("Closing idle session")
+                    break
+                if message is None:
+                    break
+                self.client_socket.settimeout(IDLE_TIMEOUT or None)
+                
+                header, request = message
+                self.requests_served += 1
+                self.handle_request(header, request)
+            
+        except socket.timeout:
+            self.log_stalled()
+            
+        except protocol.ProtocolError as e:
+            thread_log.warning(f"Bad request: {str(e)}")
+            try:
+                self.send_error(protocol.OP_ERROR, protocol.STATUS_BAD_REQUEST, str(e))
+            except OSError:
+                pass
+            
+        except ConnectionError as e:
+            if not self.reaped:
+                thread_log.warning(f"Connection lost: {str(e)}")
+                errors_total.inc('connection', 'connection_lost')
+            
+        except Exception as e:
+            if self.reaped:
+                # The ConnectionGuard shut the socket down at the transfer deadline
+                return
+            thread_log.error(f"Error: {str(e)}")
+            try:
+                self.send_error(protocol.OP_ERROR, protocol.STATUS_ERROR, str(e))
+            except OSError:
+                pass
+            
+        finally:
+            if not parked:
+                self.close()
+    
+    def handle_request(self, header, request):
+        """
+        Dispatch one request frame to its handler
+        
+        Args:
+            header: protocol.Header of the request
+            request: Decoded request fields
+        """
+        operation = protocol.OPERATION_NAMES.get(header.opcode, 'unknown')
+        started = time.monotonic()
+        self.watch()
+        try:
+            if header.opcode == protocol.OP_GET:
+                self.handle_get(request)
+            elif header.opcode == protocol.OP_PUT:
+                self.handle_put(request)
+            elif header.opcode == protocol.OP_ARCHIVE:
+                self.handle_archive(request)
+            elif header.opcode == protocol.OP_PING:
+                self.client_socket.sendall(protocol.pack_message(
+                    protocol.OP_PING, {'version': protocol.PROTOCOL_VERSION}))
+            elif header.opcode == protocol.OP_STATS and self.server:
+                self.client_socket.sendall(protocol.pack_message(protocol.OP_STATS, self.server.stats_report()))
+            else:
+                self.send_error(header.opcode, protocol.STATUS_UNSUPPORTED,
+                                f"Unsupported operation: {header.opcode}")
+        finally:
+            self.unwatch()
+            requests_total.inc(operation)
+            request_seconds.observe(time.monotonic() - started, operation)
+    
+    def handle_get(self, request):
+        """
+        Answer a GET request: a response header, then the requested bytes as one OP_DATA frame
+        (or as several, if they are sent compressed)
+        
+        Args:
+            request: Decoded request fields ('name', optional range fields - see select_range,
+                optional 'accept_encoding' - see compression.choose_encoding, optional 'if_none_match')
+        """
+        self.filename = request.get('name')
+        thread_log.debug(f"Requested file: {self.filename}")
+        
+        file_path = resolve_file_path(self.filename)
+        if file_path is None:
+            self.send_error(protocol.OP_GET, protocol.STATUS_BAD_REQUEST,
+                            f"Invalid file name: {self.filename!r}")
+            return
+        
+        try:
+            file, st = file_cache.open(file_path)
+        except OSError:
+            self.send_error(protocol.OP_GET, protocol.STATUS_NOT_FOUND,
+                            f"File '{self.filename}' not found on server")
+            thread_log.info(f"File not found: {self.filename}")
+            return
+        
+        with file:
+            digest = content_hash(request, file_path, file, st)
+            if digest and digest == request.get('if_none_match'):
+                # The client already has this version - the response header is all it needs
+                self.client_socket.sendall(protocol.pack_message(
+                    protocol.OP_GET, {'name': self.filename, 'size': st.st_size, 'sha256': digest},
+                    protocol.STATUS_NOT_MODIFIED))
+                thread_log.info(f"Client copy of {self.filename} is current")
+                return
+            
+            status, offset, length = select_range(request, file_path, file, st)
+            if status != protocol.STATUS_OK:
+                self.send_error(protocol.OP_GET, status,
+                                f"Invalid range requested for '{self.filename}'", size=st.st_size)
+                return
+            
+            response = {'name': self.filename, 'size': st.st_size, 'offset': offset, 'length': length,
+                        'version': version_tag(st)}
+            if digest:
+                response['sha256'] = digest
+            encoding = compression.choose_encoding(self.filename, length, request.get('accept_encoding'), file, offset)
+            variant = None
+            if encoding and compression.variant_cache.cacheable(st, offset, length):
+                variant = compression.variant_cache.get(file_path, st, file, encoding)
+                if variant is None:
+                    # Compressed, the file would be no smaller
+                    encoding = None
+            
+            checksum = None
+            if VERIFY_CHECKSUMS and not encoding:
+                checksum = checksum_cache.crc32_range(file_path, st, file, offset, length)
+            
+            with bandwidth_manager.open_transfer(self.client_address, self.filename) as transfer, \
+                    self.transfer_log(self.filename, None if encoding else length):
+                if encoding:
+                    thread_log.debug(f"Starting {encoding} compressed transfer "
+                                     f"(bytes {offset}-{offset + length} of {st.st_size})")
+                    self.send_compressed(file, response, encoding, transfer, variant)
+                else:
+                    # Response header and data frame header go out together - no READY round-trip
+                    self.client_socket.sendall(
+                        protocol.pack_message(protocol.OP_GET, response) +
+                        protocol.pack_header(protocol.OP_DATA, length=length, checksum=checksum,
+                                             flags=protocol.FLAG_END))
+                    
+                    if offset or length != st.st_size:
+                        thread_log.debug(f"Starting ranged transfer "
+                                         f"(bytes {offset}-{offset + length} of {st.st_size})")
+                    else:
+                        thread_log.debug(f"Starting file transfer ({length} bytes)")
+                    self.send_file_body(file, length, transfer, offset)
+    
+    def send_compressed(self, file, response, encoding, transfer, variant=None):
+        """
+        Send the response header and the selected range compressed with `encoding`
+        
+        Whole small files are served from the compressed variant cache as one
+        OP_DATA frame; anything else is compressed while it is sent, one frame
+        per compressed chunk, since the compressed size is not known up front.
+        
+        Args:
+            file: Open binary file object
+            response: Response header fields ('offset' and 'length' select the range)
+            encoding: Codec name (see compression.py)
+            transfer: rate_limiter.Transfer pacing this download
+            variant: (compressed bytes, CRC32) from the variant cache, or None to compress the range
+            
+        Returns:
+            Number of compressed bytes sent
+        """
+        response = dict(response, encoding=encoding)
+        offset, length = response['offset'], response['length']
+        
+        if variant:
+            data, crc = variant
+            self.client_socket.sendall(
+                protocol.pack_message(protocol.OP_GET, response) +
+                protocol.pack_header(protocol.OP_DATA, length=len(data),
+                                     checksum=crc if VERIFY_CHECKSUMS else None, flags=protocol.FLAG_END))
+            return self.send_from_memory(data, len(data), transfer)
+        
+        self.client_socket.sendall(protocol.pack_message(protocol.OP_GET, response))
+        return self.send_frames(compression.compress_range(file, offset, length, encoding), transfer)
+    
+    def handle_archive(self, request):
+        """
+        Answer an ARCHIVE request: a response header listing the files, then the archive
+        as OP_DATA frames, generated while it is sent
+        
+        Args:
+            request: Decoded request fields (see archive.parse_request)
+        """
+        try:
+            archive_format, compress, files, missing = archive.parse_request(request)
+        except archive.ArchiveError as e:
+            self.send_error(protocol.OP_ARCHIVE, protocol.STATUS_BAD_REQUEST, str(e))
+            return
+        except OSError as e:
+            self.send_error(protocol.OP_ARCHIVE, protocol.STATUS_ERROR, str(e))
+            return
+        if missing or not files:
+            self.send_error(protocol.OP_ARCHIVE, protocol.STATUS_NOT_FOUND,
+                            f"Files not found on server: {', '.join(missing)}" if missing else "No files match")
+            return
+        
+        self.filename = archive.archive_name(archive_format, compress)
+        total = sum(st.st_size for _, _, st in files)
+        thread_log.debug(f"Streaming {self.filename} of {len(files)} files ({total} bytes)")
+        
+        with bandwidth_manager.open_transfer(self.client_address, self.filename) as transfer, \
+                self.transfer_log(self.filename, None):
+            self.client_socket.sendall(protocol.pack_message(protocol.OP_ARCHIVE, {
+                'format': archive_format, 'compress': compress,
+                'files': [name for name, _, _ in files], 'size': total}))
+            self.send_frames(archive.stream_archive(files, archive_format, compress), transfer)
+    
+    def send_frames(self, frames, transfer):
+        """
+        Send a body whose length is not known up front as a series of OP_DATA frames
+        
+        Args:
+            frames: Iterable of (bytes, is_last) tuples; the last one is flagged FLAG_END
+            transfer: rate_limiter.Transfer pacing this download
+            
+        Returns:
+            Number of bytes sent
+        """
+        bytes_sent = 0
+        for data, is_last in frames:
+            self.client_socket.sendall(protocol.pack_header(
+                protocol.OP_DATA, length=len(data), checksum=zlib.crc32(data) if VERIFY_CHECKSUMS else None,
+                flags=protocol.FLAG_END if is_last else 0))
+            bytes_sent += self.send_from_memory(data, len(data), transfer)
+        return bytes_sent
+    
+    def handle_put(self, request):
+        """
+        Answer a PUT request: store the OP_DATA frames that follow it as a file
+        
+        The body is always read to its end, even when it cannot be stored, so
+        the session stays in step with the client.
+        
+        Args:
+            request: Decoded request fields ('name', optional 'size')
+        """
+        self.filename = request.get('name')
+        thread_log.debug(f"Receiving upload: {self.filename}")
+        
+        upload, error = open_upload(request)
+        progress = logs.TransferLog(thread_log, 'Received', self.filename, request.get('size'), self.client_address)
+        try:
+            checksum_ok = True
+            while True:
+                header = self.reader.read_header()
+                if header.opcode != protocol.OP_DATA:
+                    raise protocol.ProtocolError(f"Expected data frame, got opcode {header.opcode}")
+                
+                remaining, crc = header.length, 0
+                while remaining:
+                    chunk = self.reader.read_some(min(65536, remaining))
+                    if not chunk:
+                        raise ConnectionError("Connection closed during upload")
+                    crc = zlib.crc32(chunk, crc)
+                    remaining -= len(chunk)
+                    progress.update(len(chunk))
+                    if upload:
+                        upload.write(chunk)
+                
+                if header.flags & protocol.FLAG_CHECKSUM and crc != header.checksum:
+                    checksum_ok = False
+                if header.flags & protocol.FLAG_END:
+                    break
+        except BaseException:
+            if upload:
+                upload.abort()
+            progress.finish('failed')
+            raise
+        
+        status, fields = finish_upload(upload, error, request, checksum_ok)
+        self.client_socket.sendall(protocol.pack_message(protocol.OP_PUT, fields, status))
+        progress.finish('stored' if status == protocol.STATUS_OK else 'rejected')
+    
+    def send_error(self, opcode, status, message, **fields):
+        """
+        Send an error response frame
+        
+        Args:
+            opcode: Opcode of the request being answered (OP_ERROR if unknown)
+            status: STATUS_* code
+            message: Human readable description
+            **fields: Extra response fields
+        """
+        errors_total.inc(protocol.OPERATION_NAMES.get(opcode, 'unknown'), protocol.STATUS_NAMES.get(status, 'unknown'))
+        fields['message'] = message
+        self.client_socket.sendall(protocol.pack_message(opcode, fields, status))
+
+
+class WorkerPool:
+    """Fixed set of worker threads fed from a bounded request queue"""
+    
+    def __init__(self, size=WORKER_POOL_SIZE, queue_size=REQUEST_QUEUE_SIZE,
+                 overload_policy=OVERLOAD_POLICY):
+        """
+        Initialize the worker pool
+        
+        Args:
+            size: Number of worker threads
+            queue_size: Maximum number of requests waiting for a worker
+            overload_policy: 'queue', 'reject' or 'shed_oldest' when the queue is full
+        """
+        if overload_policy not in ('queue', 'reject', 'shed_oldest'):
+            raise ValueError(f"Unknown overload policy: {overload_policy}")
+        
+        self.size = size
+        self.overload_policy = overload_policy
+        self.requests = queue.Queue(maxsize=queue_size)
+        self.workers = []
+        self.stats_lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.shed = 0
+        self.busy_workers = 0
+        self.peak_queue_depth = 0
+        self.room = threading.Condition()
+        self.stopping = False
+        
+    def start(self):
+        """Start the worker threads"""
+        for i in range(self.size):
+            worker = threading.Thread(target=self._worker_loop, name=f"Worker-{i + 1}")
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        pool_log.info(f"Started {self.size} workers (queue size: {self.requests.maxsize}, "
+                      f"overload policy: {self.overload_policy})")
+    
+    def submit(self, handler):
+        """
+        Queue a client request for the next free worker
+        
+        Args:
+            handler: FileServerThread (not started) that will serve the client
+            
+        Returns:
+            True if the request was queued, False if it was rejected
+        """
+        item = handler
+        handler.queued_at = time.monotonic()
+        
+        if self.overload_policy == 'queue':
+            # Wait for room (on the guard's dispatch thread); meanwhile the accept loop
+            # pauses in wait_for_room(), so further clients wait in the listen backlog
+            self.requests.put(item)
+        else:
+            try:
+                self.requests.put_nowait(item)
+            except queue.Full:
+                if self.overload_policy == 'reject':
+                    with self.stats_lock:
+                        self.rejected += 1
+                    self._turn_away(handler)
+                    return False
+                
+                # shed_oldest: drop the request that has waited longest
+                try:
+                    oldest = self.requests.get_nowait()
+                except queue.Empty:
+                    oldest = None
+                if oldest is not None:
+                    with self.stats_lock:
+                        self.shed += 1
+                    self._turn_away(oldest)
+                self.requests.put(item)
+        
+        with self.stats_lock:
+            self.submitted += 1
+            self.peak_queue_depth = max(self.peak_queue_depth, self.requests.qsize())
+        return True
+    
+    def wait_for_room(self):
+        """Block while the request queue is full under the 'queue' policy (the other policies never wait)"""
+        if self.overload_policy != 'queue':
+            return
+        with self.room:
+            while self.requests.full() and not self.stopping:
+                self.room.wait()
+    
+    def stop(self):
+        """Signal the workers to exit once the queue has drained"""
+        with self.room:
+            self.stopping = True
+            self.room.notify_all()
+        for _ in self.workers:
+            self.requests.put(None)
+    
+    def get_stats(self):
+        """Return a snapshot of the pool counters"""
+        with self.stats_lock:
+            return {
+                'workers': self.size,
+                'busy_workers': self.busy_workers,
+                'queue_depth': self.requests.qsize(),
+                'peak_queue_depth': self.peak_queue_depth,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'shed': self.shed
+            }
+    
+    def metrics(self):
+        """Report the pool's queue and worker counters to the metrics registry (see metrics.collector)"""
+        stats = self.get_stats()
+        yield 'pool_workers', 'gauge', "Worker threads", {}, stats['workers']
+        yield 'pool_busy_workers', 'gauge', "Worker threads serving a client", {}, stats['busy_workers']
+        yield 'pool_queue_depth', 'gauge', "Connections waiting for a free worker", {}, stats['queue_depth']
+        for policy, count in (('reject', stats['rejected']), ('shed_oldest', stats['shed'])):
+            yield 'pool_turned_away_total', 'counter', "Connections turned away with BUSY", {'policy': policy}, count
+    
+    def _worker_loop(self):
+        """Take requests off the queue and serve them until told to stop"""
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            with self.room:
+                self.room.notify()
+            
+            queue_wait_seconds.observe(time.monotonic() - item.queued_at)
+            with self.stats_lock:
+                self.busy_workers += 1
+            try:
+                # Run the per-client handler on this worker thread
+                item.run()
+            finally:
+                with self.stats_lock:
+                    self.busy_workers -= 1
+                    self.completed += 1
+    
+    def _turn_away(self, handler):
+        """Send the BUSY response and close the connection"""
+        pool_log.warning(f"Server busy, turning away {handler.client_address}")
+        handler.reject_busy()
+
+
+class PendingRequest:
+    """A connection the ConnectionGuard is reading a request from"""
+    
+    def __init__(self, client_socket, client_address, deadline, session=None):
+        """
+        Initialize the pending request
+        
+        Args:
+            client_socket: Client socket (non-blocking while the guard reads it)
+            client_address: Address of the client
+            deadline: time.monotonic() by which the whole request must have arrived
+            session: Parked FramedSessionThread whose next request this is, or None
+                for the first request of a new connection
+        """
+        self.client_socket = client_socket
+        self.client_address = client_address
+        self.deadline = deadline
+        self.session = session
+        # A parked session's requests go straight into its reader's buffer
+        self.data = session.reader.buffer if session else bytearray()
+
+
+class ConnectionGuard:
+    """
+    Keeps slow and silent clients from holding up the server
+    
+    The accept loop hands every new connection to the guard and goes straight
+    back to accepting (pausing in wait_for_room() while max_pending connections
+    are waiting). One thread waits for the first request of all pending
+    connections with a selector, so a client that connects and sends nothing
+    costs neither the accept loop nor a thread; it is closed after
+    HANDSHAKE_TIMEOUT seconds, as is one that has not sent its whole request
+    by then (see protocol.request_complete), so a client that trickles in a
+    byte and stalls never gets a worker either. A complete request is passed
+    to `dispatch` by a separate dispatch thread, so a dispatch that waits for
+    a full worker pool never holds up the selector. The selector also holds
+    idle keep-alive sessions parked by pool workers (see park()) and hands
+    them to `resume` when their next request has arrived, closing those idle
+    for KEEPALIVE_TIMEOUT seconds. A third thread shuts down
+    the socket of any request still running after TRANSFER_TIMEOUT seconds,
+    which makes the thread serving it fail out of whatever send or receive it
+    is blocked in. (IDLE_TIMEOUT is applied by the handlers as a timeout on
+    the socket itself.)
+    """
+    
+    def __init__(self, dispatch, resume=None, handshake_timeout=HANDSHAKE_TIMEOUT, transfer_timeout=TRANSFER_TIMEOUT,
+                 reap_interval=REAP_INTERVAL, max_pending=MAX_PENDING_CONNECTIONS, keepalive_timeout=KEEPALIVE_TIMEOUT):
+        """
+        Initialize the connection guard
+        
+        Args:
+            dispatch: Called as dispatch(client_socket, client_address, request_data) with the
+                (blocking) socket and the complete first request of every connection
+            resume: Called with each parked session once its next request has arrived
+            handshake_timeout: Seconds a new connection has to send its request (0 = no limit)
+            transfer_timeout: Seconds one request may take (0 = no limit)
+            reap_interval: Seconds between checks for requests past the transfer timeout
+            max_pending: Connections that may wait for their first request before accepting pauses
+            keepalive_timeout: Seconds a parked session may stay idle (0 = no limit)
+        """
+        self.dispatch = dispatch
+        self.resume = resume
+        self.handshake_timeout = handshake_timeout
+        self.transfer_timeout = transfer_timeout
+        self.reap_interval = reap_interval
+        self.max_pending = max_pending
+        self.keepalive_timeout = keepalive_timeout
+        self.selector = selectors.DefaultSelector()
+        self.wake_receiver, self.wake_sender = socket.socketpair()
+        self.wake_receiver.setblocking(False)
+        self.wake_sender.setblocking(False)
+        self.selector.register(self.wake_receiver, selectors.EVENT_READ)
+        self.incoming = collections.deque()
+        self.returning = collections.deque()
+        self.pending = {}
+        self.idle = {}
+        self.ready = queue.SimpleQueue()
+        self.requests = set()
+        self.lock = threading.Lock()
+        self.room = threading.Condition()
+        self.running = False
+    
+    def start(self):
+        """Start the handshake reader, dispatch and reaper threads"""
+        self.running = True
+        for target, name in ((self._read_loop, 'HandshakeReader'), (self._dispatch_loop, 'Dispatcher'),
+                             (self._reap_loop, 'Reaper')):
+            threading.Thread(target=target, name=name, daemon=True).start()
+    
+    def stop(self):
+        """Stop the threads; connections still waiting to send a request are closed"""
+        self.running = False
+        self._wake()
+        self.ready.put(None)
+        with self.room:
+            self.room.notify_all()
+    
+    def wait_for_room(self):
+        """Block (the accept loop) while max_pending connections are waiting to send their request"""
+        with self.room:
+            while self.running and len(self.incoming) + len(self.pending) >= self.max_pending:
+                self.room.wait()
+    
+    def add(self, client_socket, client_address):
+        """
+        Wait for the first request of a new connection in the background
+        
+        Args:
+            client_socket: Socket just returned by accept()
+            client_address: Address of the client
+        """
+        self.incoming.append((client_socket, client_address))
+        self._wake()
+    
+    def park(self, session):
+        """
+        Hold an idle keep-alive session until its next request has arrived (called by pool workers)
+        
+        Args:
+            session: FramedSessionThread with no complete request buffered
+        """
+        self.returning.append(session)
+        self._wake()
+    
+    def watch(self, handler):
+        """
+        Start the transfer deadline of the request a handler is about to serve
+        
+        Args:
+            handler: FileServerThread (or FramedSessionThread) serving the request
+        """
+        if self.transfer_timeout:
+            with self.lock:
+                handler.deadline = time.monotonic() + self.transfer_timeout
+                self.requests.add(handler)
+    
+    def unwatch(self, handler):
+        """End the transfer deadline of a handler's request"""
+        if self.transfer_timeout:
+            with self.lock:
+                self.requests.discard(handler)
+    
+    def get_stats(self):
+        """Return the number of connections waiting to send a request and of reaped connections"""
+        stats = {'pending_handshakes': len(self.pending), 'parked_sessions': len(self.idle)}
+        for reason in REAP_REASONS:
+            stats[f"reaped_{reason}"] = metrics.registry.total(connections_reaped, (reason,))
+        return stats
+    
+    def metrics(self):
+        """Report the connections waiting to send a request to the metrics registry (see metrics.collector)"""
+        yield ('pending_handshakes', 'gauge', "Connections accepted that have not sent a request yet", {},
+               len(self.pending))
+        yield 'parked_sessions', 'gauge', "Idle keep-alive sessions waiting without a worker", {}, len(self.idle)
+    
+    def _made_room(self):
+        """Wake the accept loop if it is waiting for pending connections to go"""
+        with self.room:
+            self.room.notify()
+    
+    def _wake(self):
+        """Interrupt the reader thread's select()"""
+        try:
+            self.wake_sender.send(b'\0')
+        except OSError:
+            # The buffer is full, so a wake-up is pending anyway
+            pass
+    
+    def _read_loop(self):
+        """Wait for the first request of pending connections and dispatch them"""
+        while self.running:
+            # The oldest entry of each table is the first to expire
+            deadlines = [next(iter(table.values())).deadline for table, limit in
+                         ((self.pending, self.handshake_timeout), (self.idle, self.keepalive_timeout))
+                         if table and limit]
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self.wake_receiver:
+                    self._take_incoming()
+                else:
+                    self._read_request(key.data)
+            self._expire_handshakes()
+            self._expire_idle()
+        
+        for request in list(self.pending.values()) + list(self.idle.values()):
+            self.selector.unregister(request.client_socket)
+            if request.session:
+                request.session.close()
+            else:
+                request.client_socket.close()
+        self.pending.clear()
+        self.idle.clear()
+    
+    def _take_incoming(self):
+        """Register the connections handed over by the accept loop"""
+        try:
+            while self.wake_receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        
+        deadline = time.monotonic() + self.handshake_timeout
+        while self.incoming:
+            client_socket, client_address = self.incoming.popleft()
+            client_socket.setblocking(False)
+            request = PendingRequest(client_socket, client_address, deadline)
+            self.selector.register(client_socket, selectors.EVENT_READ, request)
+            self.pending[client_socket] = request
+        
+        deadline = time.monotonic() + self.keepalive_timeout
+        while self.returning:
+            session = self.returning.popleft()
+            session.client_socket.setblocking(False)
+            request = PendingRequest(session.client_socket, session.client_address, deadline, session)
+            self.selector.register(session.client_socket, selectors.EVENT_READ, request)
+            self.idle[session.client_socket] = request
+    
+    def _read_request(self, request):
+        """Read from a pending connection or parked session; once its request is complete, queue it"""
+        client_socket = request.client_socket
+        try:
+            chunk = client_socket.recv(65536)
+        except BlockingIOError:
+            # Spurious wake-up: keep waiting
+            return
+        except OSError as e:
+            log.debug(f"Connection from {request.client_address} failed before its request: {str(e)}")
+            chunk = b''
+        
+        if chunk:
+            request.data += chunk
+            if not protocol.request_complete(request.data):
+                # Keep waiting for the rest, against the same deadline
+                return
+        
+        self.selector.unregister(client_socket)
+        if request.session:
+            del self.idle[client_socket]
+        else:
+            del self.pending[client_socket]
+            self._made_room()
+        
+        if not chunk:
+            if request.session:
+                request.session.close()
+            else:
+                log.debug(f"Connection from {request.client_address} closed before sending a request")
+                client_socket.close()
+            return
+        client_socket.setblocking(True)
+        self.ready.put(request)
+    
+    def _dispatch_loop(self):
+        """Pass connections that sent their request to `dispatch`, which may wait for a full worker pool"""
+        while True:
+            request = self.ready.get()
+            if request is None:
+                break
+            try:
+                if request.session:
+                    self.resume(request.session)
+                else:
+                    self.dispatch(request.client_socket, request.client_address, bytes(request.data))
+            except Exception as e:
+                log.error(f"Error dispatching connection from {request.client_address}: {str(e)}")
+                if request.session:
+                    request.session.close()
+                else:
+                    request.client_socket.close()
+    
+    def _expire_handshakes(self):
+        """Close the connections that have not sent a request within the handshake timeout"""
+        if not self.handshake_timeout:
+            return
+        now = time.monotonic()
+        while self.pending:
+            client_socket, request = next(iter(self.pending.items()))
+            if request.deadline > now:
+                break
+            del self.pending[client_socket]
+            self.selector.unregister(client_socket)
+            client_socket.close()
+            self._made_room()
+            connections_reaped.inc('handshake')
+            log.warning(f"Closing connection from {request.client_address}: "
+                        f"no request within {self.handshake_timeout} seconds")
+    
+    def _expire_idle(self):
+        """Close the parked sessions that have been idle for the keep-alive timeout"""
+        if not self.keepalive_timeout:
+            return
+        now = time.monotonic()
+        while self.idle:
+            client_socket, request = next(iter(self.idle.items()))
+            if request.deadline > now:
+                break
+            del self.idle[client_socket]
+            self.selector.unregister(client_socket)
+            log.debug(f"Closing idle session with {request.client_address}")
+            request.session.close()
+    
+    def _reap_loop(self):
+        """Shut down the connections of requests that have run past the transfer timeout"""
+        while self.running and self.transfer_timeout:
+            time.sleep(self.reap_interval)
+            now = time.monotonic()
+            with self.lock:
+                expired = [handler for handler in self.requests if handler.deadline <= now]
+                for handler in expired:
+                    self.requests.discard(handler)
+                    handler.reaped = True
+            
+            for handler in expired:
+                connections_reaped.inc('deadline')
+                log.warning(f"Closing connection from {handler.client_address}: "
+                            f"request still running after {self.transfer_timeout} seconds")
+                try:
+                    handler.client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
 
 
 class ConcurrentFileServer:
     """Main server class that accepts connections and spawns threads"""
     
-    def __init__(self, host=SERVER_HOST, port=SERVER_PORT):
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, mode=SERVER_MODE,
+                 backlog=LISTEN_BACKLOG, sock=None, reuse_port=False, cluster_stats=None):
         """
         Initialize the file server
         
         Args:
             host: Server host address
             port: Server port number
+            mode: 'thread' for one thread per client, 'pool' for a bounded worker pool
+            backlog: Listen backlog for the server socket
+            sock: Already listening socket to accept from (shared by pre-forked processes)
+            reuse_port: Bind with SO_REUSEPORT so other processes can listen on the same port
+            cluster_stats: Callable returning the OP_STATS answer for every process of a
+                pre-forked server (None, or a None result, reports this process only)
         """
+        if mode not in ('thread', 'pool'):
+            raise ValueError(f"Unknown server mode: {mode}")
+        
         self.host = host
         self.port = port
-        self.server_socket = None
+        self.mode = mode
+        self.backlog = backlog
+        self.server_socket = sock
+        self.reuse_port = reuse_port
         self.running = False
         self.thread_count = 0
+        self.worker_pool = WorkerPool() if mode == 'pool' else None
+        self.guard = ConnectionGuard(self.dispatch, self.resume)
+        self.cluster_stats = cluster_stats
+        if self.worker_pool:
+            metrics.registry.collector(self.worker_pool.metrics)
+        metrics.registry.collector(self.guard.metrics)
         
     def start(self):
         """Start the file server"""
@@ -124,77 +1218,324 @@ class ConcurrentFileServer:
         # Create server files directory if it doesn't exist
         if not os.path.exists(FILES_DIRECTORY):
             os.makedirs(FILES_DIRECTORY)
-            print(f"[SERVER] Created directory: {FILES_DIRECTORY}")
-        
-        # Create TCP socket
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            log.info(f"Created directory: {FILES_DIRECTORY}")
         
         try:
-            # Bind socket to address
-            self.server_socket.bind((self.host, self.port))
+            if self.server_socket is None:
+                # Create TCP socket
+                self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if self.reuse_port:
+                    self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                
+                # Bind socket to address
+                self.server_socket.bind((self.host, self.port))
+                
+                # Listen for incoming connections
+                self.server_socket.listen(self.backlog)
             
-            # Listen for incoming connections (max 5 in queue)
-            self.server_socket.listen(5)
+            if self.worker_pool:
+                self.worker_pool.start()
+            self.guard.start()
             
             self.running = True
-            print(f"[SERVER] File Server started on {self.host}:{self.port}")
-            print(f"[SERVER] Serving files from: {os.path.abspath(FILES_DIRECTORY)}")
-            print(f"[SERVER] Buffer size: {BUFFER_SIZE} bytes")
-            print(f"[SERVER] Sleep time: {SLEEP_TIME} seconds")
-            print("[SERVER] Waiting for client connections...")
+            log.info(f"File Server started on {self.host}:{self.port} ({self.mode} mode)")
+            log.info(f"Serving files from: {os.path.abspath(FILES_DIRECTORY)}")
+            log.info(f"Buffer size: {BUFFER_SIZE} bytes")
+            log.info(f"Bandwidth: {bandwidth_manager.describe()}")
+            log.info(f"Zero-copy sendfile: {'on' if USE_SENDFILE else 'off'}")
+            log.info(f"Hot file cache: {file_cache.describe()}")
+            log.info(f"Memory-mapped files: {shared_mappings.describe()}")
+            log.info(f"Timeouts: handshake {HANDSHAKE_TIMEOUT}s, idle {IDLE_TIMEOUT}s, "
+                     f"transfer {TRANSFER_TIMEOUT}s (0 = none)")
+            log.info("Waiting for client connections...")
             
             self.accept_connections()
             
         except Exception as e:
-            print(f"[SERVER] Error starting server: {str(e)}")
+            log.error(f"Error starting server: {str(e)}")
             sys.exit(1)
     
     def accept_connections(self):
-        """Accept incoming client connections and spawn threads"""
+        """Accept incoming client connections and hand them to the connection guard"""
         
         while self.running:
             try:
-                # Accept client connection
-                client_socket, client_address = self.server_socket.accept()
+                # Pause while the guard or (under the 'queue' policy) the worker pool has no room;
+                # further clients wait in the listen backlog
+                self.guard.wait_for_room()
+                if self.worker_pool:
+                    self.worker_pool.wait_for_room()
                 
-                print(f"\n[SERVER] New connection from {client_address}")
-                
-                # Receive filename from client
-                filename = client_socket.recv(1024).decode('utf-8').strip()
+                # Accept client connection; its request is read by the guard, never on this thread
+                client_socket, client_address = self.server_socket.accept()
                 
-                if filename:
-                    # Create and start a new thread for this client
-                    self.thread_count += 1
-                    client_thread = FileServerThread(client_socket, client_address, filename)
-                    client_thread.name = f"ClientThread-{self.thread_count}"
-                    client_thread.start()
-                    
-                    print(f"[SERVER] Spawned {client_thread.name} for file: {filename}")
-                else:
-                    print(f"[SERVER] No filename received from {client_address}")
-                    client_socket.close()
+                log.debug(f"New connection from {client_address}")
+                self.guard.add(client_socket, client_address)
                     
             except KeyboardInterrupt:
-                print("\n[SERVER] Shutting down server...")
+                log.info("Shutting down server...")
                 self.running = False
                 break
             except Exception as e:
-                print(f"[SERVER] Error accepting connection: {str(e)}")
+                log.error(f"Error accepting connection: {str(e)}")
                 
         self.stop()
     
+    def dispatch(self, client_socket, client_address, request_data):
+        """
+        Start serving a connection that has sent its first request (called by the guard)
+        
+        Args:
+            client_socket: Client socket
+            client_address: Address of the client
+            request_data: First data received: a protocol frame, or a bare filename from legacy clients
+        """
+        # From here on a request is abandoned when the client stops sending or reading
+        client_socket.settimeout(IDLE_TIMEOUT or None)
+        
+        if protocol.is_framed(request_data):
+            client_thread = FramedSessionThread(client_socket, client_address, request_data, self)
+            description = "protocol session"
+            connections_total.inc('framed')
+        else:
+            filename = request_data.decode('utf-8', errors='replace').strip()
+            client_thread = FileServerThread(client_socket, client_address, filename,
+                                             self.guard) if filename else None
+            description = f"file: {filename}"
+            connections_total.inc('legacy')
+        
+        if client_thread and self.worker_pool:
+            # Hand the request to the worker pool
+            if self.worker_pool.submit(client_thread):
+                log.debug(f"Queued request for {description} "
+                          f"(queue depth: {self.worker_pool.requests.qsize()})")
+        elif client_thread:
+            # Start a new thread for this client
+            self.thread_count += 1
+            client_thread.name = f"ClientThread-{self.thread_count}"
+            client_thread.start()
+            
+            log.debug(f"Spawned {client_thread.name} for {description}")
+        else:
+            log.warning(f"No filename received from {client_address}")
+            client_socket.close()
+    
+    def resume(self, session):
+        """
+        Resubmit a parked session whose next request has arrived (called by the guard; 'pool' mode only)
+        
+        Args:
+            session: FramedSessionThread parked by a worker
+        """
+        self.worker_pool.submit(session)
+    
+    def get_stats(self):
+        """Return a snapshot of the server counters"""
+        stats = {
+            'mode': self.mode,
+            'threads_spawned': self.thread_count,
+            'active_connections': metrics.registry.total(open_connections)
+        }
+        stats.update(bandwidth_manager.get_stats())
+        stats.update(file_cache.get_stats())
+        stats.update(shared_mappings.get_stats())
+        stats.update(compression.variant_cache.get_stats())
+        stats.update(content_store.get_stats())
+        stats.update(self.guard.get_stats())
+        if self.worker_pool:
+            stats.update(self.worker_pool.get_stats())
+        return stats
+    
+    def stats_report(self):
+        """Return the OP_STATS answer: this server's counters and metrics, or the whole pre-forked server's"""
+        report = self.cluster_stats() if self.cluster_stats else None
+        return report or stats_report(self.get_stats())
+    
     def stop(self):
         """Stop the file server"""
         self.running = False
         if self.server_socket:
             self.server_socket.close()
-        print("[SERVER] Server stopped")
+        self.guard.stop()
+        if self.worker_pool:
+            self.worker_pool.stop()
+            log.info(f"Pool stats: {self.worker_pool.get_stats()}")
+        log.info("Server stopped")
+
+
+def stats_report(stats):
+    """
+    Build the OP_STATS answer of one server process
+    
+    Args:
+        stats: The server's get_stats() counters
+    """
+    return {'pid': os.getpid(), 'processes': 1, 'stats': stats, 'metrics': metrics.registry.snapshot()}
+
+
+@metrics.registry.collector
+def shared_metrics():
+    """Report the counters of the caches and the bandwidth manager shared by both engines"""
+    for cache, stats, prefix in (('file', file_cache.get_stats(), 'cache_'),
+                                 ('compressed', compression.variant_cache.get_stats(), 'compressed_')):
+        labels = {'cache': cache}
+        yield 'cache_hits_total', 'counter', "Cache lookups answered from memory", labels, stats[prefix + 'hits']
+        yield 'cache_misses_total', 'counter', "Cache lookups that read the file", labels, stats[prefix + 'misses']
+        yield 'cache_entries', 'gauge', "Files held in the cache", labels, stats[prefix + 'entries']
+        yield 'cache_bytes', 'gauge', "Bytes held in the cache", labels, stats[prefix + 'bytes']
+    
+    bandwidth = bandwidth_manager.get_stats()
+    yield 'active_transfers', 'gauge', "Downloads in progress", {}, bandwidth['active_transfers']
+    yield 'allocated_bandwidth', 'gauge', "Bytes/s given to rate-limited downloads", {}, bandwidth['allocated_bandwidth']
+    yield 'mapped_files', 'gauge', "Files held as shared memory maps", {}, shared_mappings.get_stats()['mapped_files']
+
+
+def resolve_file_path(filename):
+    """
+    Map a requested file name to a path inside FILES_DIRECTORY
+    
+    Args:
+        filename: Name sent by the client
+        
+    Returns:
+        Path of the file, or None if the name is empty or escapes FILES_DIRECTORY
+    """
+    if not isinstance(filename, str) or not filename or '\0' in filename:
+        return None
+    root = os.path.realpath(FILES_DIRECTORY)
+    path = os.path.realpath(os.path.join(root, filename))
+    if os.path.commonpath([root, path]) != root or path == root:
+        return None
+    return path
+
+
+def open_upload(request):
+    """
+    Start storing the file of a PUT request
+    
+    Args:
+        request: Decoded request fields
+    
+    Returns:
+        Tuple of (AtomicUpload or None, error message or None)
+    """
+    try:
+        return AtomicUpload(request.get('name')), None
+    except (UploadError, OSError) as e:
+        return None, str(e)
+
+
+def finish_upload(upload, error, request, checksum_ok):
+    """
+    Commit (or discard) a received PUT body and build the response
+    
+    Args:
+        upload: AtomicUpload from open_upload(), or None if it failed
+        error: Error message from open_upload()
+        request: Decoded request fields (optional 'size' is checked)
+        checksum_ok: False if any data frame failed its checksum
+    
+    Returns:
+        Tuple of (STATUS_* code, response fields)
+    """
+    if upload is None:
+        return protocol.STATUS_BAD_REQUEST, {'message': error}
+    if not checksum_ok:
+        upload.abort()
+        return protocol.STATUS_CHECKSUM_MISMATCH, {'message': "Checksum mismatch - upload was corrupted in transit"}
+    
+    size = request.get('size')
+    try:
+        upload.commit(expected_size=size if is_integer(size) else None)
+    except (UploadError, OSError) as e:
+        upload.abort()
+        return protocol.STATUS_ERROR, {'message': str(e)}
+    return protocol.STATUS_OK, {'name': upload.filename, 'size': upload.size, 'crc32': upload.crc32,
+                                'sha256': upload.sha256}
+
+
+def content_hash(request, file_path, file, st):
+    """
+    Find the SHA-256 a GET response reports, hashing the file only if the client sent 'if_none_match'
+    
+    Args:
+        request: Decoded request fields
+        file_path: Path of the file
+        file: Open binary file (read only when the hash is not known yet)
+        st: os.stat_result for the file
+    
+    Returns:
+        Hex SHA-256, or None if it is not known and was not asked for
+    """
+    if 'if_none_match' in request:
+        return content_store.hash_of(file_path, st, file)
+    return content_store.lookup(file_path, st)
+
+
+def select_range(request, file_path, file, st):
+    """
+    Work out which bytes of a file a GET request asks for
+    
+    Args:
+        request: Decoded request fields ('offset', 'length', 'prefix_crc32', all optional)
+        file_path: Path of the file
+        file: Open binary file (read only when a prefix has to be verified)
+        st: os.stat_result for the file
+    
+    Returns:
+        Tuple of (STATUS_* code, offset, length)
+    """
+    file_size = st.st_size
+    offset = request.get('offset', 0)
+    length = request.get('length')
+    prefix_crc32 = request.get('prefix_crc32')
+    
+    if not is_integer(offset) or not (length is None or is_integer(length) and length >= 0):
+        return protocol.STATUS_BAD_REQUEST, 0, 0
+    if prefix_crc32 is not None and not is_integer(prefix_crc32):
+        return protocol.STATUS_BAD_REQUEST, 0, 0
+    
+    if offset < 0:
+        # Suffix range: the last -offset bytes
+        offset = max(0, file_size + offset)
+    
+    if prefix_crc32 is not None and offset:
+        # Resuming: the client's copy of the bytes before `offset` must still match,
+        # otherwise the file changed and the client gets all of it again
+        if offset > file_size or checksum_cache.prefix_crc32(file_path, st, file, offset) != prefix_crc32:
+            offset, length = 0, None
+    elif offset > file_size:
+        return protocol.STATUS_RANGE_NOT_SATISFIABLE, 0, 0
+    
+    remaining = file_size - offset
+    return protocol.STATUS_OK, offset, remaining if length is None else min(length, remaining)
+
+
+def is_integer(value):
+    """Check that a decoded JSON value is an integer (and not a boolean)"""
+    return isinstance(value, int) and not isinstance(value, bool)
 
 
 def main():
     """Main function to start the server"""
-    server = ConcurrentFileServer()
+    parser = argparse.ArgumentParser(description="Concurrent File Server")
+    parser.add_argument('--engine', choices=['threaded', 'asyncio'], default=SERVER_ENGINE,
+                        help="threaded: blocking sockets, asyncio: single event loop")
+    parser.add_argument('--mode', choices=['thread', 'pool'], default=SERVER_MODE,
+                        help="threaded engine only: thread per client or bounded worker pool")
+    parser.add_argument('--processes', type=int, default=SERVER_PROCESSES,
+                        help="server processes sharing the port (0 = one per CPU core)")
+    args = parser.parse_args()
+    
+    if args.processes != 1:
+        from prefork import PreforkSupervisor
+        server = PreforkSupervisor(engine=args.engine, mode=args.mode, processes=args.processes)
+    elif args.engine == 'asyncio':
+        from async_file_server import AsyncFileServer
+        server = AsyncFileServer()
+    else:
+        server = ConcurrentFileServer(mode=args.mode)
     server.start()
 
 
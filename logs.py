@@ -0,0 +1,264 @@
+"""
+Logging - leveled log output that never blocks a transfer
+Every module logs through a child of the 'fileserver' logger. Records are put
+on a queue and written by a background thread, so a thread or coroutine that
+logs only pays for formatting the message, never for a (possibly slow or
+contended) write to the terminal or log file.
+
+Transfers do not log every chunk: a TransferLog counts the bytes, reports
+progress at most every LOG_PROGRESS_INTERVAL seconds and logs one summary
+record (bytes, duration, throughput) when the transfer ends. With LOG_FORMAT
+'json' every record is written as one JSON object, with the summary's fields
+under 'transfer'. The same bytes and durations feed the transfer metrics
+(see metrics.py).
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from config import LOG_LEVEL, LOG_FILE, LOG_FORMAT, LOG_PROGRESS_INTERVAL
+import metrics
+
+# Parent of every logger in the project
+ROOT_LOGGER = 'fileserver'
+
+# Records from this component are tagged with the name of the thread that logged them
+THREAD_COMPONENT = 'thread'
+
+# Bytes and durations of every transfer logged with a TransferLog, by direction ('sent' or 'received')
+transfer_bytes = metrics.counter('transfer_bytes_total', "Bytes of file data transferred", ('direction',))
+transfer_seconds = metrics.histogram('transfer_duration_seconds', "Time from the start to the end of a transfer",
+                                     ('direction', 'status'))
+
+_listener = None
+_handler = None
+_lock = threading.Lock()
+
+
+class TagFormatter(logging.Formatter):
+    """Formats records as '[TAG] message', like the rest of the project's console output"""
+    
+    def format(self, record):
+        """Prefix the message with the record's tag"""
+        message = super().format(record)
+        return f"[{record_tag(record)}] {message}"
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line"""
+    
+    def format(self, record):
+        """Serialize the record's time, level, tag, message and transfer summary"""
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'tag': record_tag(record),
+            'message': record.getMessage()
+        }
+        if hasattr(record, 'transfer'):
+            entry['transfer'] = record.transfer
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TaggedLogger(logging.LoggerAdapter):
+    """Logger adapter that tags every record (e.g. with a connection's label)"""
+    
+    def process(self, msg, kwargs):
+        """Add the tag to whatever extra fields the call passes"""
+        kwargs['extra'] = {**self.extra, **kwargs.get('extra', {})}
+        return msg, kwargs
+
+
+def record_tag(record):
+    """Return the tag shown for a record: its own, or its component's name in capitals"""
+    tag = getattr(record, 'tag', None)
+    if tag:
+        return tag
+    component = record.name.rpartition('.')[2]
+    if component == THREAD_COMPONENT:
+        return f"THREAD {record.threadName}"
+    return component.upper()
+
+
+def setup_logging(level=LOG_LEVEL, filename=LOG_FILE, log_format=LOG_FORMAT):
+    """
+    Send the project's log records through a queue to a background writer thread
+    
+    Only the first call has an effect; get_logger() makes it with the
+    configured settings, so call this first to use different ones.
+    
+    Args:
+        level: Lowest level written ('DEBUG', 'INFO', 'WARNING', ...)
+        filename: Log file to append to, or None for standard output
+        log_format: 'text' for '[TAG] message' lines, 'json' for one JSON object per line
+    """
+    global _listener, _handler
+    with _lock:
+        if _handler is not None:
+            return
+        
+        if filename:
+            target = logging.FileHandler(filename, encoding='utf-8')
+        else:
+            target = logging.StreamHandler(sys.stdout)
+        target.setFormatter(JsonFormatter() if log_format == 'json' else TagFormatter())
+        
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(level.upper() if isinstance(level, str) else level)
+        root.propagate = False
+        
+        _handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+        root.addHandler(_handler)
+        _listener = logging.handlers.QueueListener(_handler.queue, target)
+        _listener.start()
+        atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Write out the records still queued and stop the writer thread"""
+    global _listener
+    with _lock:
+        listener, _listener = _listener, None
+    if listener:
+        listener.stop()
+
+
+def _restart_after_fork():
+    """Give a forked child its own queue and writer thread (threads do not survive fork)"""
+    global _listener
+    if _listener is None:
+        return
+    _handler.queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(_handler.queue, *_listener.handlers)
+    _listener.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def get_logger(component):
+    """
+    Return the logger of a component; its records are tagged with its name in capitals
+    
+    Args:
+        component: Short name such as 'server', 'client' or 'pool' ('thread' tags
+            records with the name of the logging thread)
+    """
+    setup_logging()
+    return logging.getLogger(f"{ROOT_LOGGER}.{component}")
+
+
+def tagged(component, tag):
+    """
+    Return a logger for a component whose records carry a fixed tag
+    
+    Args:
+        component: Short name of the component
+        tag: Tag shown instead of the component's name (e.g. a connection label)
+    """
+    return TaggedLogger(get_logger(component), {'tag': tag})
+
+
+def format_rate(count, seconds):
+    """Return a human readable throughput for `count` bytes moved in `seconds`"""
+    rate = count / seconds if seconds > 0 else 0.0
+    for unit in ('B/s', 'KB/s', 'MB/s'):
+        if rate < 1024:
+            return f"{rate:.1f} {unit}"
+        rate /= 1024
+    return f"{rate:.1f} GB/s"
+
+
+class TransferLog:
+    """Counts the bytes of one transfer, samples progress records and logs a summary at the end"""
+    
+    def __init__(self, logger, action, name, total=None, peer=None, interval=LOG_PROGRESS_INTERVAL):
+        """
+        Initialize the transfer log
+        
+        Args:
+            logger: Logger (or TaggedLogger) to log to
+            action: What the transfer does, e.g. 'Sent' or 'Received'
+            name: File (or archive) name
+            total: Expected number of bytes, if known
+            peer: Address of the other side, if any
+            interval: Least number of seconds between two progress records (0 = none)
+        """
+        self.logger = logger
+        self.action = action
+        self.name = name
+        self.total = total
+        self.peer = peer
+        self.interval = interval
+        self.direction = action.lower()
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.next_report = self.started + interval if interval else float('inf')
+        self.finished = False
+    
+    def update(self, count):
+        """
+        Count transferred bytes, logging progress if the interval has passed
+        
+        Args:
+            count: Number of bytes just transferred
+        """
+        self.bytes += count
+        transfer_bytes.inc(self.direction, amount=count)
+        if time.monotonic() >= self.next_report:
+            self.next_report = time.monotonic() + self.interval
+            if self.total:
+                self.logger.info(f"Progress: {self.name} {self.bytes}/{self.total} bytes "
+                                 f"({self.bytes / self.total * 100:.1f}%)")
+            else:
+                self.logger.info(f"Progress: {self.name} {self.bytes} bytes")
+    
+    def finish(self, status='completed'):
+        """
+        Log the summary record (only the first call does)
+        
+        Args:
+            status: How the transfer ended, e.g. 'completed' or 'failed'
+        
+        Returns:
+            Dictionary of the summary fields
+        """
+        duration = time.monotonic() - self.started
+        summary = {
+            'action': self.direction,
+            'name': self.name,
+            'peer': self.peer,
+            'status': status,
+            'bytes': self.bytes,
+            'duration': round(duration, 6),
+            'throughput': round(self.bytes / duration, 1) if duration > 0 else None
+        }
+        if not self.finished:
+            self.finished = True
+            transfer_seconds.observe(duration, self.direction, status)
+            peer = f" {'to' if self.action == 'Sent' else 'from'} {self.peer}" if self.peer else ''
+            self.logger.log(logging.INFO if status == 'completed' else logging.WARNING,
+                            f"{self.action} {self.name}{peer} ({status}): {self.bytes} bytes in "
+                            f"{duration:.3f}s ({format_rate(self.bytes, duration)})",
+                            extra={'transfer': summary})
+        return summary
+    
+    def __enter__(self):
+        """Restart the clock when used as a context manager"""
+        self.started = time.monotonic()
+        self.next_report = self.started + self.interval if self.interval else float('inf')
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Log the summary; a transfer that raised is logged as failed"""
+        self.finish('failed' if exc_type else 'completed')
+        return False
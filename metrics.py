@@ -0,0 +1,337 @@
+"""
+Metrics - counters, gauges and latency histograms cheap enough to leave on
+Every thread records into its own shard (a plain dict), so recording a value
+takes no lock and never contends with other threads; the shards are only
+summed when a snapshot is taken. Shards of threads that have exited are
+folded into one, so thread-per-client servers do not accumulate them.
+
+A snapshot is a JSON-friendly dictionary: the file server sends it in answer
+to OP_STATS, snapshots of several processes can be added up with
+merge_snapshots(), and render_prometheus() turns one into the Prometheus
+text format for the web interface's /metrics endpoint.
+
+    requests = metrics.counter('requests_total', "Requests handled", ('op',))
+    requests.inc('get')
+    latency = metrics.histogram('request_duration_seconds', "Time to answer a request", ('op',))
+    latency.observe(0.012, 'get')
+"""
+
+import bisect
+import math
+import threading
+from config import METRICS_ENABLED, METRICS_DURATION_BUCKETS
+
+
+class Metric:
+    """A named family of values, one per combination of label values"""
+    
+    kind = None
+    
+    def __init__(self, registry, name, help_text, labels=()):
+        """
+        Initialize the metric
+        
+        Args:
+            registry: MetricsRegistry recording the values
+            name: Metric name without namespace, e.g. 'requests_total'
+            help_text: One line description
+            labels: Names of the labels the values are split by
+        """
+        self.registry = registry
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+    
+    def describe(self):
+        """Return the snapshot entry of the metric, without samples"""
+        return {'type': self.kind, 'help': self.help, 'labels': list(self.labels)}
+
+
+class Counter(Metric):
+    """Value that only goes up (requests, bytes, errors)"""
+    
+    kind = 'counter'
+    
+    def inc(self, *label_values, amount=1):
+        """
+        Add to the value for the given label values
+        
+        Args:
+            *label_values: One value per label, in order
+            amount: How much to add
+        """
+        if self.registry.enabled:
+            values = self.registry.shard()
+            key = (self, label_values)
+            values[key] = values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    """Value that goes up and down (e.g. open connections)"""
+    
+    kind = 'gauge'
+    
+    def dec(self, *label_values, amount=1):
+        """Subtract from the value for the given label values"""
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(Metric):
+    """Distribution of observed values (durations) in fixed buckets"""
+    
+    kind = 'histogram'
+    
+    def __init__(self, registry, name, help_text, labels=(), buckets=METRICS_DURATION_BUCKETS):
+        """
+        Initialize the histogram
+        
+        Args:
+            registry: MetricsRegistry recording the values
+            name: Metric name without namespace
+            help_text: One line description
+            labels: Names of the labels the values are split by
+            buckets: Ascending upper bounds of the buckets (an unbounded one is added)
+        """
+        Metric.__init__(self, registry, name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+    
+    def describe(self):
+        """Return the snapshot entry of the metric, without samples"""
+        return {**Metric.describe(self), 'buckets': list(self.buckets)}
+    
+    def observe(self, value, *label_values):
+        """
+        Record one observation
+        
+        Args:
+            value: Observed value (seconds, for durations)
+            *label_values: One value per label, in order
+        """
+        if self.registry.enabled:
+            values = self.registry.shard()
+            key = (self, label_values)
+            counts = values.get(key)
+            if counts is None:
+                # One count per bucket plus the unbounded one, then the sum of the values
+                counts = values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+
+class MetricsRegistry:
+    """Holds the metrics of a process and the per-thread shards recording their values"""
+    
+    def __init__(self, enabled=METRICS_ENABLED):
+        """
+        Initialize the registry
+        
+        Args:
+            enabled: Record values; when False recording is a no-op and snapshots are empty
+        """
+        self.enabled = enabled
+        self.metrics = {}
+        self.collectors = {}
+        self.local = threading.local()
+        self.shards = []
+        self.retired = {}
+        self.fold_at = 64
+        self.lock = threading.Lock()
+    
+    def counter(self, name, help_text, labels=()):
+        """Return the counter called `name`, creating it on first use"""
+        return self._register(Counter, name, help_text, labels)
+    
+    def gauge(self, name, help_text, labels=()):
+        """Return the gauge called `name`, creating it on first use"""
+        return self._register(Gauge, name, help_text, labels)
+    
+    def histogram(self, name, help_text, labels=(), buckets=METRICS_DURATION_BUCKETS):
+        """Return the histogram called `name`, creating it on first use"""
+        return self._register(Histogram, name, help_text, labels, buckets)
+    
+    def _register(self, cls, name, help_text, labels, *args):
+        """Create a metric, or return the existing one of the same name"""
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(self, name, help_text, labels, *args)
+            elif type(metric) is not cls:
+                raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+            return metric
+    
+    def collector(self, function):
+        """
+        Add a function that reports values kept elsewhere (cache and pool counters)
+        
+        A function replaces an earlier one of the same name, so a module that is
+        loaded twice (as __main__ and by import) does not report its values twice.
+        
+        Args:
+            function: Called for every snapshot; returns an iterable of
+                (name, kind, help, {label: value}, value) tuples, kind being 'counter' or 'gauge'
+        """
+        self.collectors[function.__qualname__] = function
+        return function
+    
+    def shard(self):
+        """Return the calling thread's shard, creating it on first use"""
+        try:
+            return self.local.values
+        except AttributeError:
+            pass
+        values = self.local.values = {}
+        with self.lock:
+            self.shards.append((threading.current_thread(), values))
+            if len(self.shards) >= self.fold_at:
+                self._fold_exited()
+                self.fold_at = max(64, 2 * len(self.shards))
+        return values
+    
+    def _fold_exited(self):
+        """Merge the shards of exited threads into self.retired (called with the lock held)"""
+        live = []
+        for thread, values in self.shards:
+            if thread.is_alive():
+                live.append((thread, values))
+            else:
+                add_values(self.retired, values)
+        self.shards = live
+    
+    def total(self, metric, label_values=()):
+        """
+        Return the current value of a counter or gauge, summed over every thread
+        
+        Args:
+            metric: Counter or Gauge of this registry
+            label_values: Tuple of label values
+        """
+        key = (metric, tuple(label_values))
+        with self.lock:
+            values = [self.retired] + [values for _, values in self.shards]
+            return sum(shard.get(key, 0) for shard in values)
+    
+    def snapshot(self):
+        """
+        Sum the shards into a JSON-friendly dictionary
+        
+        Returns:
+            Dictionary of metric name -> {'type', 'help', 'labels', ['buckets'], 'samples'},
+            samples being [label values, value] pairs (histograms: [label values,
+            [bucket counts..., sum]])
+        """
+        if not self.enabled:
+            return {}
+        
+        with self.lock:
+            self._fold_exited()
+            totals = {}
+            add_values(totals, self.retired)
+            shards = [values for _, values in self.shards]
+        for values in shards:
+            # dict.copy() runs without releasing the GIL, so the owner thread cannot change it meanwhile
+            add_values(totals, values.copy())
+        
+        snapshot = {name: {**metric.describe(), 'samples': []} for name, metric in self.metrics.items()}
+        for (metric, label_values), value in sorted(totals.items(), key=lambda item: (item[0][0].name, item[0][1])):
+            snapshot[metric.name]['samples'].append([list(label_values), value])
+        
+        for function in list(self.collectors.values()):
+            for name, kind, help_text, labels, value in function():
+                entry = snapshot.setdefault(name, {'type': kind, 'help': help_text, 'labels': list(labels),
+                                                   'samples': []})
+                entry['samples'].append([[labels[label] for label in entry['labels']], value])
+        return snapshot
+
+
+def add_values(totals, values):
+    """Add a shard's values into `totals` (histogram counts are added bucket by bucket)"""
+    for key, value in values.items():
+        if isinstance(value, list):
+            current = totals.get(key)
+            totals[key] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+
+def merge_snapshots(snapshots):
+    """
+    Add up the snapshots of several processes (e.g. pre-forked server workers)
+    
+    Args:
+        snapshots: Snapshots from MetricsRegistry.snapshot()
+    
+    Returns:
+        One snapshot holding the sums
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for name, entry in snapshot.items():
+            target = merged.setdefault(name, {**entry, 'samples': {}})
+            for label_values, value in entry['samples']:
+                key = tuple(label_values)
+                current = target['samples'].get(key)
+                if current is None:
+                    target['samples'][key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    target['samples'][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    target['samples'][key] = current + value
+    for entry in merged.values():
+        entry['samples'] = [[list(key), value] for key, value in sorted(entry['samples'].items())]
+    return merged
+
+
+def render_prometheus(snapshot, namespace):
+    """
+    Write a snapshot in the Prometheus text exposition format
+    
+    Args:
+        snapshot: Snapshot from MetricsRegistry.snapshot() or merge_snapshots()
+        namespace: Prefix for every metric name, e.g. 'fileserver'
+    
+    Returns:
+        List of lines
+    """
+    lines = []
+    for name, entry in snapshot.items():
+        full_name = f"{namespace}_{name}"
+        lines.append(f"# HELP {full_name} {entry['help']}")
+        lines.append(f"# TYPE {full_name} {entry['type']}")
+        for label_values, value in entry['samples']:
+            pairs = list(zip(entry['labels'], label_values))
+            if entry['type'] != 'histogram':
+                lines.append(f"{full_name}{format_labels(pairs)} {format_value(value)}")
+                continue
+            
+            cumulative = 0
+            for bound, count in zip(entry['buckets'] + ['+Inf'], value[:-1]):
+                cumulative += count
+                le = bound if bound == '+Inf' else format_value(bound)
+                lines.append(f"{full_name}_bucket{format_labels(pairs + [('le', le)])} {cumulative}")
+            lines.append(f"{full_name}_sum{format_labels(pairs)} {format_value(value[-1])}")
+            lines.append(f"{full_name}_count{format_labels(pairs)} {cumulative}")
+    return lines
+
+
+def format_labels(pairs):
+    """Format (label, value) pairs as {label="value",...}"""
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    """Format a sample value"""
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(round(value, 6))
+    return str(value)
+
+
+# Shared by everything recording metrics in this process
+registry = MetricsRegistry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
@@ -0,0 +1,351 @@
+"""
+Pre-forked Server - several server processes sharing one port
+Both engines serve all clients from one process, so CPU-heavy work (checksums,
+compression, archives, the Python interpreter itself) is limited to one core.
+With SERVER_PROCESSES > 1 a supervisor starts that many server processes on
+the same port and the kernel spreads new connections between them.
+
+Where SO_REUSEPORT is available each process binds its own listening socket;
+elsewhere the supervisor binds one socket and every process accepts from it.
+The supervisor restarts processes that exit and can collect their counters.
+A worker asked for OP_STATS forwards the request to the supervisor, which
+answers with the counters and metrics of every process added up.
+Caches (hot files, mappings, compressed variants, content hashes) are per
+process, and the global bandwidth limit is split evenly between the processes.
+"""
+
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from config import (SERVER_HOST, SERVER_PORT, LISTEN_BACKLOG, SERVER_ENGINE, SERVER_MODE,
+                    SERVER_PROCESSES, REUSE_PORT, WORKER_RESTART_DELAY)
+import logs
+import metrics
+
+# Seconds to wait for a worker's counters, or for the supervisor's totals
+STATS_TIMEOUT = 2
+
+log = logs.get_logger('prefork')
+
+
+def reuse_port_supported():
+    """Check whether processes can bind the same port with SO_REUSEPORT and have it load balanced"""
+    # BSD and macOS accept the option but hand every connection to the last process that bound
+    return hasattr(socket, 'SO_REUSEPORT') and sys.platform.startswith('linux')
+
+
+def resolve_process_count(processes):
+    """
+    Return the number of server processes to run
+    
+    Args:
+        processes: Configured count; 0 means one per CPU core
+    """
+    if processes <= 0:
+        return os.cpu_count() or 1
+    return processes
+
+
+def create_listen_socket(host, port, backlog=LISTEN_BACKLOG, reuse_port=False):
+    """
+    Create a bound TCP socket
+    
+    Args:
+        host: Address to bind
+        port: Port to bind
+        backlog: Listen backlog, or None to only bind (connections are then never routed to it)
+        reuse_port: Set SO_REUSEPORT so other processes can bind the same port
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        sock.bind((host, port))
+        if backlog is not None:
+            sock.listen(backlog)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def run_worker(index, engine, mode, host, port, listen_socket, stats_conn, report_conn, processes):
+    """
+    Entry point of one server process
+    
+    Args:
+        index: Worker number (1-based), for log messages
+        engine: 'threaded' or 'asyncio'
+        mode: 'thread' or 'pool' (threaded engine only)
+        host: Address to serve on
+        port: Port to serve on
+        listen_socket: Socket shared by all workers, or None to bind with SO_REUSEPORT
+        stats_conn: Pipe end the supervisor asks for counters on
+        report_conn: Pipe end this worker asks the supervisor for the whole server's stats on
+        processes: Total number of server processes
+    """
+    # Ctrl+C reaches the whole process group; the supervisor decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    
+    from rate_limiter import bandwidth_manager
+    bandwidth_manager.share(processes)
+    reuse_port = listen_socket is None
+    cluster_stats = ClusterStats(report_conn)
+    
+    if engine == 'asyncio':
+        from async_file_server import AsyncFileServer
+        server = AsyncFileServer(host, port, sock=listen_socket, reuse_port=reuse_port, cluster_stats=cluster_stats)
+    else:
+        from file_server import ConcurrentFileServer
+        server = ConcurrentFileServer(host, port, mode=mode, sock=listen_socket, reuse_port=reuse_port,
+                                      cluster_stats=cluster_stats)
+    
+    def answer_stats():
+        """Send the server's counters and metrics whenever the supervisor asks"""
+        try:
+            while stats_conn.recv() is not None:
+                stats_conn.send((server.get_stats(), metrics.registry.snapshot()))
+        except (EOFError, OSError):
+            pass
+    
+    threading.Thread(target=answer_stats, name="StatsResponder", daemon=True).start()
+    log.info(f"Worker {index} running (pid {os.getpid()})")
+    server.start()
+
+
+class ClusterStats:
+    """Asks the supervisor for the stats of every server process (called for OP_STATS in a worker)"""
+    
+    def __init__(self, conn):
+        """
+        Initialize the client
+        
+        Args:
+            conn: Pipe end connected to the supervisor's stats relay
+        """
+        self.conn = conn
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+    
+    def __call__(self):
+        """
+        Return the supervisor's report, or None if it does not answer in time
+        
+        Requests carry an id, so an answer that arrives after its request gave
+        up is skipped instead of being taken for the answer to the next one.
+        """
+        with self.lock:
+            request_id = next(self.ids)
+            deadline = time.monotonic() + 2 * STATS_TIMEOUT
+            try:
+                self.conn.send(request_id)
+                while self.conn.poll(max(0.0, deadline - time.monotonic())):
+                    answer_id, report = self.conn.recv()
+                    if answer_id == request_id:
+                        return report
+            except (EOFError, OSError):
+                pass
+        log.warning("Supervisor did not send the server's stats; reporting this process only")
+        return None
+
+
+class PreforkSupervisor:
+    """Starts, watches and restarts the server processes"""
+    
+    def __init__(self, engine=SERVER_ENGINE, mode=SERVER_MODE, processes=SERVER_PROCESSES,
+                 host=SERVER_HOST, port=SERVER_PORT, reuse_port=REUSE_PORT):
+        """
+        Initialize the supervisor
+        
+        Args:
+            engine: 'threaded' or 'asyncio'
+            mode: 'thread' or 'pool' (threaded engine only)
+            processes: Number of server processes (0 = one per CPU core)
+            host: Address to serve on
+            port: Port to serve on
+            reuse_port: Let each process bind with SO_REUSEPORT where supported
+        """
+        self.engine = engine
+        self.mode = mode
+        self.processes = resolve_process_count(processes)
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port and reuse_port_supported()
+        self.listen_socket = None
+        self.workers = [None] * self.processes
+        self.restarts = 0
+        self.running = False
+        self.lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+    
+    def start(self):
+        """Start the server processes and supervise them until interrupted"""
+        try:
+            # Binding here first reports a port conflict once, instead of from every worker.
+            # Without SO_REUSEPORT this is the socket all the workers accept from; with it,
+            # the socket only holds the port and never listens, so no connection lands on it.
+            backlog = None if self.reuse_port else LISTEN_BACKLOG
+            self.listen_socket = create_listen_socket(self.host, self.port, backlog, self.reuse_port)
+        except OSError as e:
+            log.error(f"Error starting server: {str(e)}")
+            sys.exit(1)
+        
+        self.running = True
+        log.info(f"Starting {self.processes} {self.engine} server processes on "
+                 f"{self.host}:{self.port} "
+                 f"({'SO_REUSEPORT' if self.reuse_port else 'shared listening socket'})")
+        for index in range(self.processes):
+            self._spawn(index)
+        threading.Thread(target=self._relay_stats, name="StatsRelay", daemon=True).start()
+        
+        try:
+            self._supervise()
+        except KeyboardInterrupt:
+            log.info("Shutting down server processes...")
+        finally:
+            log.info(f"Stats: {self.get_stats()}")
+            self.stop()
+    
+    def _spawn(self, index):
+        """Start (or restart) the worker in slot `index`"""
+        parent_conn, child_conn = multiprocessing.Pipe()
+        report_conn, worker_report_conn = multiprocessing.Pipe()
+        shared_socket = None if self.reuse_port else self.listen_socket
+        process = multiprocessing.Process(
+            target=run_worker, name=f"FileServer-{index + 1}",
+            args=(index + 1, self.engine, self.mode, self.host, self.port, shared_socket, child_conn,
+                  worker_report_conn, self.processes)
+        )
+        process.start()
+        child_conn.close()
+        worker_report_conn.close()
+        with self.lock:
+            self.workers[index] = (process, parent_conn, report_conn)
+    
+    def _supervise(self):
+        """Restart workers that exit until the supervisor is stopped"""
+        while self.running:
+            time.sleep(0.5)
+            for index, (process, conn, report_conn) in enumerate(list(self.workers)):
+                if process.is_alive() or not self.running:
+                    continue
+                log.warning(f"Worker {index + 1} (pid {process.pid}) exited with code "
+                            f"{process.exitcode}; restarting in {WORKER_RESTART_DELAY}s")
+                with self.stats_lock:
+                    conn.close()
+                    report_conn.close()
+                time.sleep(WORKER_RESTART_DELAY)
+                if self.running:
+                    self.restarts += 1
+                    self._spawn(index)
+    
+    def _relay_stats(self):
+        """Answer workers asking for the whole server's stats, until the supervisor stops"""
+        while self.running:
+            with self.lock:
+                conns = [report_conn for _, _, report_conn in self.workers if not report_conn.closed]
+            try:
+                ready = multiprocessing.connection.wait(conns, timeout=0.5)
+            except OSError:
+                # A connection was closed while waiting (its worker is being restarted)
+                continue
+            for conn in ready:
+                try:
+                    request_id = conn.recv()
+                    conn.send((request_id, self.get_report()))
+                except (EOFError, OSError):
+                    # The worker exited; wait until _supervise replaces the connection
+                    conn.close()
+    
+    def _collect(self):
+        """
+        Ask every live worker for its counters and metrics
+        
+        Returns:
+            List of (process, stats dictionary, metrics snapshot); both are None
+            for a worker that is down or did not answer
+        """
+        with self.lock:
+            workers = list(self.workers)
+        
+        collected = []
+        with self.stats_lock:
+            for process, conn, _ in workers:
+                stats, snapshot = None, None
+                if process.is_alive():
+                    try:
+                        conn.send(True)
+                        if conn.poll(STATS_TIMEOUT):
+                            stats, snapshot = conn.recv()
+                    except (EOFError, OSError):
+                        pass
+                collected.append((process, stats, snapshot))
+        return collected
+    
+    def get_stats(self, collected=None):
+        """
+        Collect the counters of every live worker
+        
+        Args:
+            collected: Result of _collect() to summarize, instead of asking the workers
+        
+        Returns:
+            Dictionary with a 'workers' list of per-process stats and the numeric
+            counters summed over all processes
+        """
+        per_worker = []
+        for process, worker_stats, _ in collected or self._collect():
+            stats = {'pid': process.pid, 'alive': process.is_alive()}
+            stats.update(worker_stats or {})
+            per_worker.append(stats)
+        
+        totals = {}
+        for stats in per_worker:
+            for key, value in stats.items():
+                if key != 'pid' and isinstance(value, (int, float)) and not isinstance(value, bool):
+                    totals[key] = totals.get(key, 0) + value
+        
+        return {
+            'mode': 'prefork',
+            'engine': self.engine,
+            'processes': self.processes,
+            'restarts': self.restarts,
+            **totals,
+            'workers': per_worker
+        }
+    
+    def get_report(self):
+        """Return the OP_STATS answer for the whole server: summed counters and merged metrics"""
+        collected = self._collect()
+        stats = self.get_stats(collected)
+        # Per-worker detail would make the answer grow with the process count; keep who is up
+        stats['workers'] = [{'pid': worker['pid'], 'alive': worker['alive']} for worker in stats['workers']]
+        return {
+            'pid': os.getpid(),
+            'processes': self.processes,
+            'stats': stats,
+            'metrics': metrics.merge_snapshots(snapshot for _, _, snapshot in collected if snapshot)
+        }
+    
+    def stop(self):
+        """Stop every server process"""
+        self.running = False
+        with self.lock:
+            workers = list(self.workers)
+        for process, conn, report_conn in workers:
+            if process.is_alive():
+                process.terminate()
+        for process, conn, report_conn in workers:
+            process.join(5)
+            conn.close()
+            report_conn.close()
+        if self.listen_socket:
+            self.listen_socket.close()
+        log.info("Server stopped")
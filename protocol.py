@@ -0,0 +1,403 @@
+"""
+Wire Protocol - versioned, length-prefixed binary framing
+Shared by file_server.py, async_file_server.py and file_client.py.
+
+Every message is a frame: a fixed 20-byte header followed by `length` bytes
+of payload. All integers are in network byte order.
+
+    magic     3 bytes   b'FSP'
+    version   1 byte    protocol version of the sender
+    opcode    1 byte    OP_* value
+    status    1 byte    STATUS_* value (0 in requests)
+    flags     2 bytes   FLAG_* bits
+    length    8 bytes   payload size in bytes
+    checksum  4 bytes   CRC32 of the payload when FLAG_CHECKSUM is set
+
+Control messages (requests and response headers) carry a small JSON object.
+File contents travel in OP_DATA frames; the frame with FLAG_END set is the
+last one of a body, so no in-band end marker is ever needed.
+
+A GET may ask for part of a file with 'offset' (negative counts back from
+the end, like an HTTP suffix range) and 'length'. A client resuming a partial
+download also sends 'prefix_crc32', the CRC32 of the bytes it already holds;
+if that no longer matches the file, the server sends the whole file instead
+(like HTTP If-Range). The response header reports the 'offset' and 'length'
+actually sent along with the full 'size'.
+
+A client that already holds a copy of the file sends its SHA-256 as
+'if_none_match'; if the file still has that hash, the server answers
+STATUS_NOT_MODIFIED with no body (like HTTP If-None-Match), so an unchanged
+file costs one round trip. Responses report the file's 'sha256' whenever the
+server knows it, and always after an 'if_none_match' (an empty one just asks
+for the hash). They always report a 'version', an opaque string made from the
+file's size, modification time and inode, which changes whenever the file is
+replaced and costs nothing to compute.
+
+A PUT uploads a file: the request ('name', 'size') is followed straight away
+by the file as OP_DATA frames, each carrying the CRC32 of its own payload so
+the sender never has to read the file twice. The server answers once the
+last frame is stored, with the 'size' and whole-file 'crc32' it received.
+
+An ARCHIVE request streams several files as one tar or zip built on the fly:
+it names the files ('names') or matches them with a glob ('pattern'), picks
+a 'format' and whether to 'compress'. The response header lists the 'files'
+included and their total uncompressed 'size'; the archive follows as OP_DATA
+frames, each with the CRC32 of its own payload since the archive is never
+whole on the server.
+
+A STATS request asks for the server's counters and metrics; the response
+carries them as its fields ('stats', 'metrics' - see metrics.py). A
+pre-forked server answers for all of its processes together.
+
+A connection carries any number of requests. Clients may pipeline: send
+several requests before reading the responses, which always come back in
+request order. Either side ends the session by closing the connection
+between frames; the server also closes sessions idle for KEEPALIVE_TIMEOUT.
+
+Negotiation: the first bytes a client sends decide the dialect. A frame
+starts with MAGIC; anything else is treated as a legacy filename request
+(FILESIZE/READY/EOF). Servers keep reading until request_complete() holds,
+so a frame that arrives in small pieces is never mistaken for a filename.
+Clients leave FLAG_CHECKSUM off in requests so the whole frame is plain
+ASCII, which makes an old server answer with a legacy "ERROR:" line instead
+of choking on it - the cue for the client to fall back. Clients open every
+connection with a PING, so the dialect is settled before any request that
+the server may take a while to answer (a GET of a large file is checksummed
+before its header goes out).
+"""
+
+import asyncio
+import json
+import struct
+import zlib
+from collections import namedtuple
+from config import MAX_CONTROL_PAYLOAD
+
+MAGIC = b'FSP'
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!3sBBBHQI')
+HEADER_SIZE = HEADER.size
+
+# Opcodes
+OP_ERROR = 0    # Connection-level error not tied to a request (e.g. server busy)
+OP_GET = 1      # Request a file; response header is followed by OP_DATA frames
+OP_DATA = 2     # Bulk file data
+OP_PING = 3     # Health check; answered with the server's protocol version
+OP_PUT = 4      # Upload a file; the request is followed by OP_DATA frames
+OP_ARCHIVE = 5  # Request several files as one archive; response header is followed by OP_DATA frames
+OP_STATS = 6    # Request the server's counters and metrics
+
+# Status codes
+STATUS_OK = 0
+STATUS_NOT_FOUND = 1
+STATUS_ERROR = 2
+STATUS_BUSY = 3
+STATUS_BAD_REQUEST = 4
+STATUS_UNSUPPORTED = 5
+STATUS_RANGE_NOT_SATISFIABLE = 6
+STATUS_CHECKSUM_MISMATCH = 7
+STATUS_NOT_MODIFIED = 8
+
+# Short names used in logs and metrics; OP_ERROR answers are not tied to a request
+OPERATION_NAMES = {OP_ERROR: 'connection', OP_GET: 'get', OP_DATA: 'data', OP_PING: 'ping', OP_PUT: 'put',
+                   OP_ARCHIVE: 'archive', OP_STATS: 'stats'}
+STATUS_NAMES = {STATUS_OK: 'ok', STATUS_NOT_FOUND: 'not_found', STATUS_ERROR: 'error', STATUS_BUSY: 'busy',
+                STATUS_BAD_REQUEST: 'bad_request', STATUS_UNSUPPORTED: 'unsupported',
+                STATUS_RANGE_NOT_SATISFIABLE: 'range_not_satisfiable', STATUS_CHECKSUM_MISMATCH: 'checksum_mismatch',
+                STATUS_NOT_MODIFIED: 'not_modified'}
+
+# Flags
+FLAG_CHECKSUM = 0x0001  # checksum field holds the CRC32 of the payload
+FLAG_END = 0x0002       # last OP_DATA frame of a body
+
+Header = namedtuple('Header', 'version opcode status flags length checksum')
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends something that is not a valid frame"""
+
+
+class ChecksumMismatchError(ProtocolError):
+    """Raised when received file data does not match the checksum in its frame"""
+
+
+class LegacyPeerError(ProtocolError):
+    """Raised when the peer answered in the legacy (unframed) protocol"""
+
+
+def is_framed(data):
+    """
+    Check whether the first bytes received from a client start a frame
+    
+    Only meaningful once request_complete(data) holds: a shorter prefix of
+    MAGIC may still turn out to be a frame.
+    
+    Args:
+        data: Bytes received so far
+    """
+    return data[:len(MAGIC)] == MAGIC
+
+
+def request_complete(data):
+    """
+    Check whether the first bytes received from a client hold its whole first request
+    
+    A frame is complete once its header and control payload have arrived. A
+    legacy request is a bare filename sent in one piece with no terminator,
+    so anything that cannot be the start of a frame counts as complete.
+    
+    Args:
+        data: Bytes received so far
+    """
+    if not MAGIC.startswith(data[:len(MAGIC)]):
+        return True
+    if len(data) < HEADER_SIZE:
+        return False
+    length = HEADER.unpack_from(data)[5]
+    # An oversized control message is complete enough to be rejected
+    return length > MAX_CONTROL_PAYLOAD or len(data) >= HEADER_SIZE + length
+
+
+def pack_header(opcode, status=STATUS_OK, length=0, checksum=None, flags=0):
+    """
+    Build a frame header
+    
+    Args:
+        opcode: OP_* value
+        status: STATUS_* value
+        length: Payload size in bytes
+        checksum: CRC32 of the payload, or None to leave FLAG_CHECKSUM unset
+        flags: Extra FLAG_* bits
+    
+    Returns:
+        Header bytes
+    """
+    if checksum is None:
+        checksum = 0
+    else:
+        flags |= FLAG_CHECKSUM
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, opcode, status, flags, length, checksum)
+
+
+def pack_message(opcode, fields=None, status=STATUS_OK, checksum=True):
+    """
+    Build a complete control frame with a JSON payload
+    
+    Args:
+        opcode: OP_* value
+        fields: Dictionary to send as the payload
+        status: STATUS_* value
+        checksum: Include a CRC32 of the payload (clients pass False, see module docstring)
+    
+    Returns:
+        Frame bytes
+    """
+    payload = json.dumps(fields or {}, separators=(',', ':')).encode('ascii')
+    crc = zlib.crc32(payload) if checksum else None
+    return pack_header(opcode, status, len(payload), crc) + payload
+
+
+def unpack_header(data):
+    """
+    Parse a frame header
+    
+    Args:
+        data: Exactly HEADER_SIZE bytes
+    
+    Returns:
+        Header namedtuple
+    """
+    magic, version, opcode, status, flags, length, checksum = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise LegacyPeerError("Peer did not answer with a protocol frame")
+    return Header(version, opcode, status, flags, length, checksum)
+
+
+def decode_message(header, payload):
+    """
+    Verify and decode the JSON payload of a control frame
+    
+    Args:
+        header: Header of the frame
+        payload: Payload bytes
+    
+    Returns:
+        Dictionary carried by the frame
+    """
+    if header.flags & FLAG_CHECKSUM and zlib.crc32(payload) != header.checksum:
+        raise ProtocolError("Checksum mismatch in control message")
+    if not payload:
+        return {}
+    try:
+        fields = json.loads(payload.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        raise ProtocolError("Malformed control message")
+    if not isinstance(fields, dict):
+        raise ProtocolError("Control message must be a JSON object")
+    return fields
+
+
+class SocketReader:
+    """Reads exact byte counts from a blocking socket, starting with already-received bytes"""
+    
+    def __init__(self, sock, initial_data=b''):
+        """
+        Initialize the reader
+        
+        Args:
+            sock: Connected socket
+            initial_data: Bytes already received from the socket
+        """
+        self.sock = sock
+        self.buffer = bytearray(initial_data)
+    
+    def read_exact(self, size):
+        """
+        Read exactly `size` bytes
+        
+        Args:
+            size: Number of bytes to read
+        
+        Returns:
+            Bytes read
+        """
+        while len(self.buffer) < size:
+            chunk = self.sock.recv(max(65536, size - len(self.buffer)))
+            if not chunk:
+                raise ConnectionError("Connection closed by peer")
+            self.buffer += chunk
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+    
+    def read_some(self, max_size):
+        """
+        Read up to `max_size` bytes, blocking only if nothing is buffered
+        
+        Args:
+            max_size: Largest number of bytes to return
+        
+        Returns:
+            Bytes read (empty only when the peer closed the connection)
+        """
+        if self.buffer:
+            data = bytes(self.buffer[:max_size])
+            del self.buffer[:max_size]
+            return data
+        return self.sock.recv(max_size)
+    
+    def read_header(self, allow_eof=False):
+        """
+        Read and parse the next frame header
+        
+        Args:
+            allow_eof: Return None instead of raising if the peer closed the
+                connection cleanly before sending another frame
+        
+        Returns:
+            Header namedtuple (or None at end of stream when allow_eof is set)
+        """
+        if allow_eof and not self.buffer:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                return None
+            self.buffer += chunk
+        magic = self.read_exact(len(MAGIC))
+        if magic != MAGIC:
+            raise LegacyPeerError("Peer did not answer with a protocol frame")
+        return unpack_header(magic + self.read_exact(HEADER_SIZE - len(MAGIC)))
+    
+    def read_message(self, allow_eof=False):
+        """
+        Read a complete control frame
+        
+        Args:
+            allow_eof: Return None if the peer closed the connection between frames
+        
+        Returns:
+            Tuple of (header, fields dictionary), or None at end of stream
+        """
+        header = self.read_header(allow_eof)
+        if header is None:
+            return None
+        if header.length > MAX_CONTROL_PAYLOAD:
+            raise ProtocolError(f"Control message too large ({header.length} bytes)")
+        return header, decode_message(header, self.read_exact(header.length))
+
+
+class StreamFrameReader:
+    """asyncio counterpart of SocketReader, wrapping a StreamReader"""
+    
+    def __init__(self, reader, initial_data=b''):
+        """
+        Initialize the reader
+        
+        Args:
+            reader: asyncio StreamReader
+            initial_data: Bytes already read from the stream
+        """
+        self.reader = reader
+        self.buffer = bytearray(initial_data)
+    
+    async def read_exact(self, size):
+        """
+        Read exactly `size` bytes
+        
+        Args:
+            size: Number of bytes to read
+        
+        Returns:
+            Bytes read
+        """
+        if len(self.buffer) < size:
+            # On a short read the buffered prefix is kept for the caller to inspect
+            self.buffer += await self.reader.readexactly(size - len(self.buffer))
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+    
+    async def read_header(self):
+        """
+        Read and parse the next frame header
+        
+        Returns:
+            Header namedtuple
+        """
+        return unpack_header(await self.read_exact(HEADER_SIZE))
+    
+    async def read_some(self, max_size):
+        """
+        Read up to `max_size` bytes, waiting only if nothing is buffered
+        
+        Args:
+            max_size: Largest number of bytes to return
+        
+        Returns:
+            Bytes read (empty only when the peer closed the connection)
+        """
+        if self.buffer:
+            data = bytes(self.buffer[:max_size])
+            del self.buffer[:max_size]
+            return data
+        return await self.reader.read(max_size)
+    
+    async def read_message(self, allow_eof=False):
+        """
+        Read a complete control frame
+        
+        Args:
+            allow_eof: Return None if the peer closed the connection between frames
+        
+        Returns:
+            Tuple of (header, fields dictionary), or None at end of stream
+        """
+        try:
+            data = await self.read_exact(HEADER_SIZE)
+        except asyncio.IncompleteReadError as e:
+            if allow_eof and not e.partial and not self.buffer:
+                return None
+            raise
+        header = unpack_header(data)
+        if header.length > MAX_CONTROL_PAYLOAD:
+            raise ProtocolError(f"Control message too large ({header.length} bytes)")
+        return header, decode_message(header, await self.read_exact(header.length))
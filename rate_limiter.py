@@ -0,0 +1,276 @@
+"""
+Bandwidth Shaping - token-bucket rate limiting for file transfers
+Enforces a global bandwidth budget, per-client and per-file limits, and
+shares the global budget fairly between all active transfers.
+"""
+
+import threading
+import time
+from config import (GLOBAL_BANDWIDTH_LIMIT, PER_CLIENT_BANDWIDTH_LIMIT,
+                    PER_FILE_BANDWIDTH_LIMITS, BANDWIDTH_BURST, THROTTLE_CHUNK_SIZE)
+
+UNLIMITED = float('inf')
+
+
+class TokenBucket:
+    """Thread-safe token bucket that refills at `rate` bytes per second"""
+    
+    def __init__(self, rate, burst=BANDWIDTH_BURST):
+        """
+        Initialize the token bucket
+        
+        Args:
+            rate: Refill rate in bytes per second
+            burst: Seconds of unused bandwidth the bucket may save up
+        """
+        self.lock = threading.Lock()
+        self.burst = burst
+        self.rate = rate
+        self.capacity = rate * burst
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+    
+    def set_rate(self, rate):
+        """
+        Change the refill rate, keeping tokens earned at the old rate
+        
+        Args:
+            rate: New refill rate in bytes per second
+        """
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            self.capacity = rate * self.burst
+            self.tokens = min(self.tokens, self.capacity)
+    
+    def reserve(self, amount):
+        """
+        Take `amount` tokens, going into debt if the bucket runs dry
+        
+        Args:
+            amount: Number of bytes about to be sent
+        
+        Returns:
+            Seconds the caller must wait before sending
+        """
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+    
+    def _refill(self):
+        """Add the tokens earned since the last call (lock must be held)"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+
+class Transfer:
+    """Handle for one active transfer, throttled to its share of the bandwidth"""
+    
+    def __init__(self, manager, client_ip, filename):
+        """
+        Initialize the transfer handle
+        
+        Args:
+            manager: BandwidthManager that owns this transfer
+            client_ip: IP address of the receiving client
+            filename: Name of the file being sent
+        """
+        self.manager = manager
+        self.client_ip = client_ip
+        self.filename = filename
+        self.rate = UNLIMITED
+        self.bucket = None
+    
+    @property
+    def limited(self):
+        """True when this transfer currently has a finite rate"""
+        return self.bucket is not None
+    
+    def chunk_size(self, default=THROTTLE_CHUNK_SIZE):
+        """
+        Bytes to send per slice so a slice never exceeds the bucket's burst
+        
+        Args:
+            default: Slice size to use when the transfer is not limited
+        """
+        bucket = self.bucket
+        if bucket is None:
+            return default
+        return max(1, min(default, int(bucket.capacity)))
+    
+    def reserve(self, amount):
+        """
+        Account for `amount` bytes and return how long to wait before sending them
+        
+        Args:
+            amount: Number of bytes about to be sent
+        
+        Returns:
+            Seconds to wait (0 when the transfer is not limited)
+        """
+        bucket = self.bucket
+        if bucket is None:
+            return 0.0
+        return bucket.reserve(amount)
+    
+    def throttle(self, amount):
+        """
+        Block the calling thread until `amount` bytes may be sent
+        
+        Args:
+            amount: Number of bytes about to be sent
+        """
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+    
+    def close(self):
+        """Release this transfer's share of the bandwidth"""
+        self.manager.close_transfer(self)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def _apply_rate(self, rate):
+        """Switch to a new rate, creating or dropping the bucket as needed"""
+        self.rate = rate
+        if rate == UNLIMITED:
+            self.bucket = None
+        elif self.bucket is None:
+            self.bucket = TokenBucket(rate)
+        else:
+            self.bucket.set_rate(rate)
+
+
+class BandwidthManager:
+    """Splits the configured bandwidth limits between active transfers"""
+    
+    def __init__(self, global_limit=GLOBAL_BANDWIDTH_LIMIT, client_limit=PER_CLIENT_BANDWIDTH_LIMIT,
+                 file_limits=PER_FILE_BANDWIDTH_LIMITS):
+        """
+        Initialize the bandwidth manager
+        
+        Args:
+            global_limit: Bytes per second shared by all transfers (0 = unlimited)
+            client_limit: Bytes per second shared by one client's transfers (0 = unlimited)
+            file_limits: Dict of filename -> bytes per second shared by that file's transfers
+        """
+        self.global_limit = global_limit or UNLIMITED
+        self.client_limit = client_limit or UNLIMITED
+        self.file_limits = dict(file_limits)
+        self.lock = threading.Lock()
+        self.transfers = []
+        self.total_transfers = 0
+    
+    def open_transfer(self, client_address, filename):
+        """
+        Register a new transfer and rebalance everyone's share
+        
+        Args:
+            client_address: Client address tuple (or bare IP string)
+            filename: Name of the file being sent
+        
+        Returns:
+            Transfer handle; call close() (or use it as a context manager) when done
+        """
+        client_ip = client_address[0] if isinstance(client_address, tuple) else client_address
+        transfer = Transfer(self, client_ip, filename)
+        with self.lock:
+            self.transfers.append(transfer)
+            self.total_transfers += 1
+            self._rebalance()
+        return transfer
+    
+    def close_transfer(self, transfer):
+        """
+        Remove a finished transfer and hand its share to the others
+        
+        Args:
+            transfer: Transfer returned by open_transfer
+        """
+        with self.lock:
+            if transfer in self.transfers:
+                self.transfers.remove(transfer)
+                self._rebalance()
+    
+    def get_stats(self):
+        """Return a snapshot of the limits and current allocations"""
+        with self.lock:
+            allocated = [t.rate for t in self.transfers if t.rate != UNLIMITED]
+            return {
+                'active_transfers': len(self.transfers),
+                'total_transfers': self.total_transfers,
+                'limited_transfers': len(allocated),
+                'allocated_bandwidth': sum(allocated),
+                'global_limit': 0 if self.global_limit == UNLIMITED else self.global_limit
+            }
+    
+    def share(self, processes):
+        """
+        Keep this process's share of the global limit when several server processes
+        serve the same port (connections are spread evenly between them)
+        
+        Per-client and per-file limits stay per process: one client's or file's
+        transfers may land in different processes, so those become approximate.
+        
+        Args:
+            processes: Number of server processes
+        """
+        with self.lock:
+            if self.global_limit != UNLIMITED:
+                self.global_limit = max(1, self.global_limit // processes)
+            self._rebalance()
+    
+    def describe(self):
+        """Summarize the configured limits for the startup banner"""
+        limits = []
+        if self.global_limit != UNLIMITED:
+            limits.append(f"global {self.global_limit} B/s")
+        if self.client_limit != UNLIMITED:
+            limits.append(f"per client {self.client_limit} B/s")
+        if self.file_limits:
+            limits.append(f"{len(self.file_limits)} per-file limits")
+        return ", ".join(limits) if limits else "unlimited"
+    
+    def _rebalance(self):
+        """
+        Recompute every transfer's rate (lock must be held)
+        
+        Each transfer is first capped by its client's and file's limits, split
+        evenly between the transfers sharing them. The global budget is then
+        water-filled: transfers capped below an equal share keep their cap and
+        the leftover is divided among the rest (max-min fairness).
+        """
+        per_client = {}
+        per_file = {}
+        for transfer in self.transfers:
+            per_client[transfer.client_ip] = per_client.get(transfer.client_ip, 0) + 1
+            per_file[transfer.filename] = per_file.get(transfer.filename, 0) + 1
+        
+        caps = []
+        for transfer in self.transfers:
+            cap = self.client_limit / per_client[transfer.client_ip]
+            file_limit = self.file_limits.get(transfer.filename)
+            if file_limit:
+                cap = min(cap, file_limit / per_file[transfer.filename])
+            caps.append((cap, transfer))
+        
+        caps.sort(key=lambda item: item[0])
+        remaining = self.global_limit
+        for index, (cap, transfer) in enumerate(caps):
+            share = remaining / (len(caps) - index)
+            rate = min(cap, share)
+            if remaining != UNLIMITED:
+                remaining -= rate
+            transfer._apply_rate(rate)
+
+
+# Shared by every server engine in this process
+bandwidth_manager = BandwidthManager()
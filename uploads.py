@@ -0,0 +1,202 @@
+"""
+Uploads - atomic, checksummed writes into FILES_DIRECTORY
+Incoming data is streamed into a hidden temporary file in the target directory
+while its CRC32 and SHA-256 are computed, and only renamed to its real name
+once complete, so readers never see a half-written file. Committed files are
+recorded in the content store (and deduplicated, if it is enabled). Resumable uploads keep their
+temporary file open across requests in an UploadRegistry.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from config import FILES_DIRECTORY, UPLOAD_SESSION_TIMEOUT
+from content_store import content_store
+import logs
+
+# Temporary upload files start with this; listings skip them
+TEMP_PREFIX = '.upload-'
+
+log = logs.get_logger('upload')
+
+
+class UploadError(Exception):
+    """Raised when an upload cannot be completed"""
+
+
+class AtomicUpload:
+    """A file being written to a temporary name and renamed into place on commit"""
+    
+    def __init__(self, filename, directory=FILES_DIRECTORY):
+        """
+        Create the temporary file
+        
+        Args:
+            filename: Final name of the file inside `directory`
+            directory: Directory the file is uploaded into
+        """
+        if not is_valid_filename(filename):
+            raise UploadError(f"Invalid file name: {filename!r}")
+        os.makedirs(directory, exist_ok=True)
+        
+        self.filename = filename
+        self.path = os.path.join(directory, filename)
+        fd, self.temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=directory)
+        self.file = os.fdopen(fd, 'wb')
+        self.size = 0
+        self.crc32 = 0
+        self.digest = hashlib.sha256()
+        self.last_active = time.monotonic()
+        self.lock = threading.Lock()  # Held while a request is writing to a resumable upload
+    
+    def write(self, data):
+        """
+        Append data to the file
+        
+        Args:
+            data: Bytes to append
+        """
+        self.file.write(data)
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self.digest.update(data)
+        self.size += len(data)
+        self.last_active = time.monotonic()
+    
+    def write_from(self, stream, chunk_size):
+        """
+        Append everything readable from a stream, one chunk at a time
+        
+        Args:
+            stream: Binary file-like object to read from
+            chunk_size: Bytes read per call
+        
+        Returns:
+            Number of bytes appended
+        """
+        start = self.size
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            self.write(chunk)
+        return self.size - start
+    
+    def commit(self, expected_crc32=None, expected_size=None):
+        """
+        Flush the file to disk and rename it to its final name
+        
+        Args:
+            expected_crc32: CRC32 the data must have (None = not checked)
+            expected_size: Size the data must have (None = not checked)
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        
+        if expected_size is not None and expected_size != self.size:
+            self.abort()
+            raise UploadError(f"Size mismatch: expected {expected_size} bytes, received {self.size}")
+        if expected_crc32 is not None and expected_crc32 != self.crc32:
+            self.abort()
+            raise UploadError(f"Checksum mismatch: expected {expected_crc32:08x}, received {self.crc32:08x}")
+        
+        os.chmod(self.temp_path, 0o644)
+        os.replace(self.temp_path, self.path)
+        content_store.add(self.path, self.sha256)
+    
+    @property
+    def sha256(self):
+        """Hex SHA-256 of the data written so far"""
+        return self.digest.hexdigest()
+    
+    def abort(self):
+        """Discard the temporary file"""
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+class UploadRegistry:
+    """Thread-safe table of resumable uploads, expired after UPLOAD_SESSION_TIMEOUT idle seconds"""
+    
+    def __init__(self, timeout=UPLOAD_SESSION_TIMEOUT):
+        """
+        Initialize the registry
+        
+        Args:
+            timeout: Seconds an upload may sit idle before it is discarded
+        """
+        self.timeout = timeout
+        self.uploads = {}
+        self.lock = threading.Lock()
+    
+    def create(self, filename, directory=FILES_DIRECTORY):
+        """
+        Start a resumable upload
+        
+        Args:
+            filename: Final name of the file
+            directory: Directory the file is uploaded into
+        
+        Returns:
+            Tuple of (upload id, AtomicUpload)
+        """
+        self.expire()
+        upload = AtomicUpload(filename, directory)
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = upload
+        return upload_id, upload
+    
+    def get(self, upload_id):
+        """
+        Look up an upload in progress
+        
+        Args:
+            upload_id: Id returned by create()
+        
+        Returns:
+            AtomicUpload, or None if unknown or expired
+        """
+        self.expire()
+        with self.lock:
+            return self.uploads.get(upload_id)
+    
+    def pop(self, upload_id):
+        """
+        Remove an upload from the registry (to commit or abort it)
+        
+        Args:
+            upload_id: Id returned by create()
+        
+        Returns:
+            AtomicUpload, or None if unknown or expired
+        """
+        with self.lock:
+            return self.uploads.pop(upload_id, None)
+    
+    def expire(self):
+        """Abort uploads that have been idle for longer than the timeout"""
+        now = time.monotonic()
+        with self.lock:
+            stale = [upload_id for upload_id, upload in self.uploads.items()
+                     if now - upload.last_active > self.timeout and not upload.lock.locked()]
+            expired = [self.uploads.pop(upload_id) for upload_id in stale]
+        for upload in expired:
+            log.info(f"Discarding abandoned upload of {upload.filename}")
+            upload.abort()
+
+
+def is_valid_filename(filename):
+    """
+    Check that a name refers to a plain file directly inside the upload directory
+    
+    Args:
+        filename: Name to check
+    """
+    return (isinstance(filename, str) and filename not in ('', '.', '..') and '\0' not in filename
+            and os.path.basename(filename) == filename and '\\' not in filename
+            and not filename.startswith(TEMP_PREFIX))
@@ -3,19 +3,100 @@ Web Interface for Concurrent File Server
 Provides an interactive web UI for downloading files from the server
 """
 
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, g, render_template, request, jsonify, send_file, url_for
 from flask_cors import CORS
+import atexit
+import json
+import mimetypes
 import os
-import threading
-from file_client import FileClient
-from config import SERVER_HOST, SERVER_PORT, WEB_HOST, WEB_PORT, FILES_DIRECTORY
+import socket
+import time
+from file_client import FileClient, ConnectionPool
+from download_jobs import DownloadJobManager, JobQueueFull, JobFailed, FINAL_STATES
+from file_index import FileIndex
+from uploads import AtomicUpload, UploadRegistry, UploadError
+from content_store import content_store
+from archive import archive_name
+from config import (SERVER_HOST, SERVER_PORT, WEB_HOST, WEB_PORT, FILES_DIRECTORY, WEB_STREAM_DOWNLOADS,
+                    WEB_COALESCE_DOWNLOADS, UPLOAD_CHUNK_SIZE, CLIENT_COMPRESSION, DOWNLOAD_JOB_EVENT_INTERVAL,
+                    DOWNLOAD_JOB_KEEPALIVE)
+import logs
+import metrics
+import protocol
 
 app = Flask(__name__)
 CORS(app)
 
-# Store download results
-download_results = {}
-download_lock = threading.Lock()
+log = logs.get_logger('web')
+
+# Connections to the file server, shared by all Flask worker threads
+connection_pool = ConnectionPool(SERVER_HOST, SERVER_PORT)
+
+# Metadata of the files in FILES_DIRECTORY, kept up to date in the background
+file_index = FileIndex(FILES_DIRECTORY)
+
+# Resumable uploads in progress
+upload_registry = UploadRegistry()
+
+
+def stage_download(filename, save_path, on_progress):
+    """Download a file from the file server for a background job (runs on a job worker thread)"""
+    client = FileClient(SERVER_HOST, SERVER_PORT, pool=connection_pool, on_progress=on_progress)
+    return client.download_file(filename, save_path=save_path)
+
+
+# Staged downloads running in the background; their files are removed on exit
+job_manager = DownloadJobManager(stage_download)
+atexit.register(job_manager.close)
+
+# Appended to the ETag of gzip encoded responses, which differ byte-wise from the file
+GZIP_ETAG_SUFFIX = '-gzip'
+
+# Request metrics of the web interface, served with the file server's on /metrics
+http_requests = metrics.counter('http_requests_total', "HTTP requests answered", ('endpoint', 'method', 'status'))
+http_request_seconds = metrics.histogram('http_request_duration_seconds',
+                                         "Time until the response starts (relayed bodies: see transfer metrics)",
+                                         ('endpoint',))
+http_active_requests = metrics.gauge('http_active_requests', "HTTP requests being handled")
+
+
+@app.before_request
+def start_request_timer():
+    """Note when the request started, for the request metrics"""
+    g.started = time.monotonic()
+    http_active_requests.inc()
+
+
+@app.after_request
+def record_request(response):
+    """Count the request and time it until its response starts"""
+    endpoint = request.endpoint or 'unknown'
+    http_requests.inc(endpoint, request.method, str(response.status_code))
+    http_request_seconds.observe(time.monotonic() - g.started, endpoint)
+    return response
+
+
+@app.teardown_request
+def finish_request(error):
+    """Count the request as handled (also when it raised)"""
+    if 'started' in g:
+        http_active_requests.dec()
+
+
+@metrics.registry.collector
+def pool_metrics():
+    """Report the connection pool's counters"""
+    stats = connection_pool.get_stats()
+    yield 'pool_idle_connections', 'gauge', "Idle pooled connections to the file server", {}, stats['idle']
+    for event in ('created', 'reused', 'discarded'):
+        yield 'pool_connections_total', 'counter', "Pooled file server connections", {'event': event}, stats[event]
+
+
+@metrics.registry.collector
+def job_metrics():
+    """Report how many background download jobs are kept in each state"""
+    for state, count in job_manager.counts().items():
+        yield 'download_jobs', 'gauge', "Background download jobs kept", {'state': state}, count
 
 
 @app.route('/')
@@ -26,32 +107,45 @@ def index():
 
 @app.route('/api/files', methods=['GET'])
 def list_files():
-    """Get list of available files on the server"""
+    """
+    Get list of available files on the server, served from the file index
+    
+    Query parameters (all optional): prefix, sort ('name', 'size' or 'mtime'),
+    order ('asc' or 'desc'), offset and limit.
+    """
     try:
-        if not os.path.exists(FILES_DIRECTORY):
-            return jsonify({
-                'status': 'error',
-                'message': 'Server files directory not found',
-                'files': []
-            })
+        prefix = request.args.get('prefix', '')
+        sort = request.args.get('sort', 'name')
+        descending = request.args.get('order', 'asc') == 'desc'
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            limit = max(0, limit)
         
-        files = []
-        for filename in os.listdir(FILES_DIRECTORY):
-            filepath = os.path.join(FILES_DIRECTORY, filename)
-            if os.path.isfile(filepath):
-                size = os.path.getsize(filepath)
-                files.append({
-                    'name': filename,
-                    'size': size,
-                    'size_formatted': format_file_size(size)
-                })
+        total, entries = file_index.query(prefix, sort, descending, offset, limit)
         
-        files.sort(key=lambda x: x['name'])
+        files = [{
+            'name': entry['name'],
+            'size': entry['size'],
+            'size_formatted': format_file_size(entry['size']),
+            'mtime': entry['mtime'],
+            'content_type': entry['content_type'],
+            'crc32': entry['crc32'],
+            'sha256': entry['sha256']
+        } for entry in entries]
         
         return jsonify({
             'status': 'success',
             'files': files,
-            'count': len(files)
+            'count': total,
+            'offset': offset
+        })
+        
+    except FileNotFoundError:
+        return jsonify({
+            'status': 'error',
+            'message': 'Server files directory not found',
+            'files': []
         })
         
     except Exception as e:
@@ -64,7 +158,16 @@ def list_files():
 
 @app.route('/api/download', methods=['POST'])
 def download_file():
-    """Download a file from the server and send to browser"""
+    """
+    Prepare a file for the browser to download
+    
+    If WEB_STREAM_DOWNLOADS is on and the file server can serve ranges, the
+    answer holds a download_url the browser streams the file from. Otherwise
+    the file is staged by a background job and the answer (202 Accepted)
+    holds its job_id, status_url and events_url; the job's progress events
+    carry the download_url once the file is staged. Concurrent requests for
+    the same version of a file get the same job.
+    """
     try:
         data = request.get_json()
         filename = data.get('filename')
@@ -75,29 +178,49 @@ def download_file():
                 'message': 'Filename is required'
             })
         
-        # Create client and download file to temp location
-        import tempfile
-        temp_dir = tempfile.gettempdir()
-        temp_path = os.path.join(temp_dir, filename)
-        
-        client = FileClient(SERVER_HOST, SERVER_PORT)
-        result = client.download_file(filename, save_path=temp_path)
-        
-        # Store result
-        with download_lock:
-            download_results[filename] = result
+        if WEB_STREAM_DOWNLOADS:
+            try:
+                # Check the file exists, then let the browser stream it from /api/stream
+                header, response = probe_file(filename)
+            except protocol.LegacyPeerError:
+                # A legacy server cannot serve ranges; stage the file instead
+                header = None
+            
+            if header is not None and header.status == protocol.STATUS_OK:
+                return jsonify({
+                    'status': 'success',
+                    'message': 'File ready for download',
+                    'filename': filename,
+                    'download_url': url_for('stream_file', filename=filename),
+                    'size': response['size']
+                })
+            if header is not None:
+                return jsonify({
+                    'status': 'error',
+                    'message': response.get('message', f"Server returned status {header.status}"),
+                    'filename': filename
+                })
         
-        if result['status'] == 'success':
-            # Return the file path for browser download
+        # Stage the file in the background rather than holding this worker for the transfer
+        # (a legacy server, which is why streaming was not possible, cannot report versions)
+        try:
+            job = job_manager.submit(filename, None if WEB_STREAM_DOWNLOADS else file_version(filename))
+        except JobQueueFull as e:
             return jsonify({
-                'status': 'success',
-                'message': 'File ready for download',
-                'filename': filename,
-                'download_url': f'/api/get-file/{filename}',
-                'size': result['size']
-            })
-        else:
-            return jsonify(result)
+                'status': 'error',
+                'message': str(e),
+                'filename': filename
+            }), 503
+        
+        urls = job_urls(job.id)
+        return jsonify({
+            'status': 'accepted',
+            'message': 'Download queued',
+            'filename': filename,
+            'job_id': job.id,
+            'status_url': urls['status_url'],
+            'events_url': urls['events_url']
+        }), 202
         
     except Exception as e:
         return jsonify({
@@ -106,38 +229,446 @@ def download_file():
         })
 
 
+def job_urls(job_id):
+    """Return the status, events and file URLs of a download job"""
+    return {
+        'status_url': url_for('job_status', job_id=job_id),
+        'events_url': url_for('job_events', job_id=job_id),
+        'download_url': url_for('job_file', job_id=job_id)
+    }
+
+
+def job_payload(state, urls):
+    """
+    Add a job's URLs to its state dictionary (the download_url only once the file is staged)
+    
+    Args:
+        state: DownloadJob.to_dict() of the job
+        urls: job_urls() of the job
+    """
+    payload = {**state, 'status_url': urls['status_url'], 'events_url': urls['events_url']}
+    if state['state'] == 'done':
+        payload['download_url'] = urls['download_url']
+    return payload
+
+
+def job_not_found():
+    """Answer a request for an unknown or evicted job"""
+    return jsonify({
+        'status': 'error',
+        'message': 'Job not found'
+    }), 404
+
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """List the background download jobs that have not been evicted, oldest first"""
+    return jsonify({
+        'status': 'success',
+        'jobs': [job_payload(state, job_urls(state['job_id'])) for state in job_manager.list()]
+    })
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Report the state and progress of a background download job"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return job_not_found()
+    return jsonify({'status': 'success', **job_payload(job.to_dict(), job_urls(job_id))})
+
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """
+    Stream the progress of a background download job as server-sent events
+    
+    A 'progress' event is sent when the job changes, at most every
+    DOWNLOAD_JOB_EVENT_INTERVAL seconds, then one event named after the state
+    it ends in ('done', 'failed' or 'cancelled') and the stream closes. The
+    data of each event is the job's state as JSON, as from /api/jobs/<job_id>.
+    The thread serving the stream sleeps until the job changes; the transfer
+    itself runs on a job worker.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return job_not_found()
+    urls = job_urls(job_id)
+    
+    def events():
+        revision = -1
+        while True:
+            state, revision = job_manager.wait(job, revision, DOWNLOAD_JOB_KEEPALIVE)
+            if state is None:
+                # A comment line keeps proxies from closing an idle stream
+                yield ': keep-alive\n\n'
+                continue
+            
+            event = state['state'] if state['state'] in FINAL_STATES else 'progress'
+            yield f"event: {event}\ndata: {json.dumps(job_payload(state, urls))}\n\n"
+            if event != 'progress':
+                return
+            # Let the updates of the next chunks pile up into one event
+            time.sleep(DOWNLOAD_JOB_EVENT_INTERVAL)
+    
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/jobs/<job_id>/file', methods=['GET'])
+def job_file(job_id):
+    """Send the file a background download job staged (honours HTTP Range requests)"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return job_not_found()
+    if job.state != 'done':
+        return jsonify({
+            'status': 'error',
+            'message': f"Job is {job.state}",
+            'state': job.state
+        }), 409
+    
+    try:
+        return send_file(
+            job.path,
+            as_attachment=True,
+            download_name=os.path.basename(job.filename),
+            conditional=True,
+            etag=job.result.get('sha256') or content_store.hash_of(job.path)
+        )
+    except FileNotFoundError:
+        # Evicted between the lookup and now
+        return job_not_found()
+
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """
+    Cancel a queued or running download job, or discard a finished one and its staged file
+    
+    A job shared by several downloads is only cancelled or discarded once all of them have asked.
+    """
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return job_not_found()
+    if job_manager.get(job_id) is None:
+        message = 'Job discarded'
+    elif job.cancelled:
+        message = 'Job cancelled'
+    else:
+        message = 'Job is shared with other downloads and was kept for them'
+    return jsonify({
+        'status': 'success',
+        'message': message,
+        'job_id': job_id,
+        'state': job.state
+    })
+
+
 @app.route('/api/get-file/<filename>', methods=['GET'])
 def get_file(filename):
-    """Send the downloaded file to browser"""
-    try:
-        import tempfile
-        temp_dir = tempfile.gettempdir()
-        temp_path = os.path.join(temp_dir, filename)
-        
-        if os.path.exists(temp_path):
-            return send_file(
-                temp_path,
-                as_attachment=True,
-                download_name=filename
-            )
-        else:
-            return jsonify({
-                'status': 'error',
-                'message': 'File not found'
-            }), 404
-            
+    """
+    Send a file to the browser, like /api/stream/<filename> (kept for older download links)
+    
+    Files used to be staged under their own name in the shared temp directory,
+    where concurrent downloads of one file overwrote each other; staged
+    downloads now run as jobs, each in a directory of its own.
+    """
+    return stream_file(filename)
+
+
+@app.route('/api/stream/<filename>', methods=['GET'])
+def stream_file(filename):
+    """
+    Relay a file from the file server to the browser as it arrives
+    
+    With WEB_COALESCE_DOWNLOADS, plain whole-file requests (no Range or
+    If-None-Match) share one transfer per version of the file: see stream_shared().
+    """
+    try:
+        if WEB_COALESCE_DOWNLOADS and not request.range and not request.if_none_match:
+            return stream_shared(filename)
+        return stream_from_server(filename)
     except Exception as e:
         return jsonify({
             'status': 'error',
             'message': str(e)
-        }), 500
+        }), 502
+
+
+def stream_shared(filename):
+    """
+    Send a file to the browser from a download job that concurrent requests for it share
+    
+    The first request for a version of the file starts a job staging it;
+    requests arriving while it runs, or up to DOWNLOAD_JOB_SHARE_TTL seconds
+    after it completed, join it. Each response reads the staged bytes back as
+    they arrive, so the file server sends the file once however many browsers
+    fetch it. A job whose browsers all disconnect is cancelled.
+    
+    Args:
+        filename: Name of the file on the file server
+    
+    Returns:
+        Flask response streaming the file data
+    """
+    # The version (size, modification time and inode) keeps a changed file from
+    # being served from an older job; unlike a hash it costs the server nothing
+    header, response = probe_file(filename)
+    if header.status != protocol.STATUS_OK:
+        return jsonify({
+            'status': 'error',
+            'message': response.get('message', 'File not found')
+        }), 404 if header.status == protocol.STATUS_NOT_FOUND else 502
+    
+    try:
+        job = job_manager.submit(filename, response.get('version'))
+    except JobQueueFull:
+        # Too busy to stage another file; relay this one directly instead
+        return stream_from_server(filename)
+    
+    try:
+        # The job's own transfer, not the probe, says how much it will send
+        size = job_manager.size_of(job)
+    except JobFailed as e:
+        job_manager.leave(job)
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 502
+    
+    def relay():
+        try:
+            yield from job_manager.iter_file(job)
+        except JobFailed as e:
+            # Headers are out already; ending the body early makes the browser report a failed download
+            log.warning(f"Shared download of {filename} failed: {e}")
+    
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Length': str(size),
+        'Content-Disposition': f'attachment; filename="{filename}"'
+    }
+    if response.get('sha256') and size == response['size']:
+        headers['ETag'] = f'"{response["sha256"]}"'
+    shared = Response(relay(), headers=headers, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    # Closing the response, unlike the generator's own cleanup, also happens
+    # when the browser is gone before the first chunk was asked for
+    shared.call_on_close(lambda: job_manager.leave(job))
+    return shared
+
+
+def file_version(filename):
+    """
+    Return the version the file server reports for a file, or None if it cannot tell
+    
+    Args:
+        filename: Name of the file on the file server
+    """
+    try:
+        header, response = probe_file(filename)
+    except protocol.LegacyPeerError:
+        return None
+    return response.get('version') if header.status == protocol.STATUS_OK else None
+
+
+def probe_file(filename, if_none_match=None):
+    """
+    Ask the file server about a file without transferring any of it
+    
+    Args:
+        filename: Name of the file on the file server
+        if_none_match: Passed on with the request; '' makes the server report the file's
+            SHA-256, hashing the file first if it is not indexed yet
+    
+    Returns:
+        Tuple of (protocol.Header, response fields) of an empty range request
+    """
+    with connection_pool.session() as session:
+        session.request_file(filename, 0, 0, if_none_match=if_none_match)
+        header, response = session.read_response()
+        if header.status == protocol.STATUS_OK:
+            for _ in session.iter_body(0):
+                pass
+    return header, response
+
+
+def stream_from_server(filename):
+    """
+    Relay a file (or the byte range in the request's Range header) from the file server
+    
+    Args:
+        filename: Name of the file on the file server
+    
+    The body is a generator that reads from the server socket only as fast as
+    the browser accepts data, so a slow browser throttles the upstream transfer
+    through TCP flow control instead of buffering the file in memory.
+    Whole-file requests from browsers that accept gzip are relayed gzip
+    compressed exactly as the file server sent them, without re-encoding.
+    The browser's If-None-Match is passed on, so the file server answers an
+    unchanged file with a 304 Not Modified instead of the data.
+    
+    Returns:
+        Flask response streaming the file data
+    """
+    offset, length = 0, None
+    byte_range = request.range
+    if byte_range and byte_range.units == 'bytes' and len(byte_range.ranges) == 1:
+        start, stop = byte_range.ranges[0]
+        # Suffix ranges ("bytes=-500") arrive as a negative start, which the server understands
+        offset = start
+        length = stop - start if stop is not None and start >= 0 else None
+    else:
+        byte_range = None
+    
+    # Ranges always refer to the uncompressed file, so only whole files are sent compressed
+    accept_encoding = None
+    if CLIENT_COMPRESSION and not byte_range and 'gzip' in request.accept_encodings:
+        accept_encoding = ['gzip']
+    
+    # ETags are the file's SHA-256, with a suffix on the gzip encoded variant
+    if_none_match = next(iter(request.if_none_match.as_set()), None)
+    if if_none_match and if_none_match.endswith(GZIP_ETAG_SUFFIX):
+        if_none_match = if_none_match[:-len(GZIP_ETAG_SUFFIX)]
+    
+    def relay():
+        with connection_pool.session() as session:
+            # Only a browser revalidating needs the hash computed; otherwise the ETag
+            # is whatever hash the server already has indexed, if any
+            session.request_file(filename, offset, length, accept_encoding=accept_encoding,
+                                 if_none_match=if_none_match)
+            header, response = session.read_response()
+            yield header, response
+            if header.status == protocol.STATUS_OK:
+                yield from session.iter_body(response['length'], name=filename)
+    
+    chunks = relay()
+    header, response = next(chunks)
+    
+    # On errors, let the generator finish so the connection goes back to the pool
+    if header.status == protocol.STATUS_NOT_MODIFIED:
+        next(chunks, None)
+        return Response(status=304, headers={'ETag': f'"{response["sha256"]}"'})
+    
+    if header.status == protocol.STATUS_RANGE_NOT_SATISFIABLE or (
+            header.status == protocol.STATUS_OK and byte_range and not response['length']):
+        next(chunks, None)
+        return Response(status=416, headers={'Content-Range': f"bytes */{response['size']}"})
+    
+    if header.status != protocol.STATUS_OK:
+        next(chunks, None)
+        return jsonify({
+            'status': 'error',
+            'message': response.get('message', 'File not found')
+        }), 404 if header.status == protocol.STATUS_NOT_FOUND else 502
+    
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Length': str(response['length']),
+        'Content-Disposition': f'attachment; filename="{filename}"'
+    }
+    if byte_range:
+        first = response['offset']
+        headers['Content-Range'] = f"bytes {first}-{first + response['length'] - 1}/{response['size']}"
+    if response.get('sha256'):
+        headers['ETag'] = f'"{response["sha256"]}"'
+    if response.get('encoding') == 'gzip':
+        # The compressed size is only known at the end, so the body goes out chunked
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+        del headers['Content-Length'], headers['Accept-Ranges']
+        if 'ETag' in headers:
+            headers['ETag'] = f'"{response["sha256"]}{GZIP_ETAG_SUFFIX}"'
+    
+    return Response(chunks, status=206 if byte_range else 200, headers=headers,
+                    mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+
+
+@app.route('/api/archive', methods=['GET', 'POST'])
+def download_archive():
+    """
+    Stream several files as one tar or zip archive, built by the file server while it is sent
+    
+    Takes 'names' (a list of file names) or 'pattern' (a glob), 'format' ('tar'
+    or 'zip') and 'compress', as a JSON body or as query parameters (repeat
+    'names' for several files).
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+    else:
+        data = {
+            'names': request.args.getlist('names') or None,
+            'pattern': request.args.get('pattern'),
+            'format': request.args.get('format', 'tar'),
+            'compress': request.args.get('compress', '') in ('1', 'true', 'yes')
+        }
+    
+    try:
+        return stream_archive_from_server(data.get('names'), data.get('pattern'),
+                                          data.get('format', 'tar'), bool(data.get('compress')))
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 502
+
+
+def stream_archive_from_server(names, pattern, archive_format, compress):
+    """
+    Relay an archive from the file server to the browser as it is generated
+    
+    Args:
+        names: Names of the files to include
+        pattern: Glob selecting the files to include (instead of `names`)
+        archive_format: 'tar' or 'zip'
+        compress: gzip the tar archive / deflate the members of the zip archive
+    
+    Returns:
+        Flask response streaming the archive
+    """
+    def relay():
+        with connection_pool.session() as session:
+            session.request_archive(names, pattern, archive_format, compress)
+            header, response = session.read_response()
+            yield header, response
+            if header.status == protocol.STATUS_OK:
+                yield from session.iter_body(response['size'], name=archive_name(archive_format, compress))
+    
+    chunks = relay()
+    header, response = next(chunks)
+    
+    if header.status != protocol.STATUS_OK:
+        # Let the generator finish so the connection goes back to the pool
+        next(chunks, None)
+        status = {protocol.STATUS_NOT_FOUND: 404, protocol.STATUS_BAD_REQUEST: 400}.get(header.status, 502)
+        return jsonify({
+            'status': 'error',
+            'message': response.get('message', f"Server returned status {header.status}")
+        }), status
+    
+    filename = archive_name(archive_format, compress)
+    content_type, encoding = mimetypes.guess_type(filename)
+    return Response(chunks, headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+                    mimetype='application/gzip' if encoding == 'gzip' else content_type)
 
 
 @app.route('/api/server-status', methods=['GET'])
 def server_status():
     """Check if the file server is running"""
     try:
-        import socket
+        # Ping over a pooled connection - no new TCP handshake per poll
+        latency = connection_pool.ping()
+        return jsonify({
+            'status': 'online',
+            'host': SERVER_HOST,
+            'port': SERVER_PORT,
+            'latency_ms': round(latency * 1000, 2)
+        })
+    except (OSError, protocol.ProtocolError):
+        pass
+    
+    try:
+        # The server may only speak the legacy protocol; fall back to a connect probe
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(1)
         result = sock.connect_ex((SERVER_HOST, SERVER_PORT))
@@ -163,6 +694,29 @@ def server_status():
         })
 
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Metrics of the web interface (web_*) and of the file server (fileserver_*) in the
+    Prometheus text format; the file server's are fetched with OP_STATS on every scrape
+    """
+    lines = metrics.render_prometheus(metrics.registry.snapshot(), 'web')
+    try:
+        report = connection_pool.server_stats()
+    except (OSError, protocol.ProtocolError):
+        report = None
+    
+    lines += ['# HELP fileserver_up Whether the file server answered the stats request',
+              '# TYPE fileserver_up gauge',
+              f"fileserver_up {1 if report else 0}"]
+    if report:
+        lines += ['# HELP fileserver_processes Server processes the metrics are summed over',
+                  '# TYPE fileserver_processes gauge',
+                  f"fileserver_processes {report['processes']}"]
+        lines += metrics.render_prometheus(report['metrics'], 'fileserver')
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
     """Upload a file to the server directory"""
@@ -181,27 +735,203 @@ def upload_file():
                 'message': 'No file selected'
             })
         
-        # Save file to server directory
-        if not os.path.exists(FILES_DIRECTORY):
-            os.makedirs(FILES_DIRECTORY)
+        # Copy into a temporary file and rename it into place, so downloads never see a partial file
+        upload = AtomicUpload(file.filename)
+        try:
+            upload.write_from(file.stream, UPLOAD_CHUNK_SIZE)
+        except BaseException:
+            upload.abort()
+            raise
+        upload.commit()
+        file_index.update(upload.filename, upload.crc32, upload.sha256)
         
-        filepath = os.path.join(FILES_DIRECTORY, file.filename)
-        file.save(filepath)
+        return jsonify({
+            'status': 'success',
+            'message': 'File uploaded successfully',
+            'filename': upload.filename,
+            'size': upload.size,
+            'crc32': f"{upload.crc32:08x}",
+            'sha256': upload.sha256
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        })
+
+
+@app.route('/api/upload/<filename>', methods=['PUT'])
+def upload_file_stream(filename):
+    """
+    Upload a file sent as the raw request body, streaming it straight to disk
+    
+    An optional X-Checksum-CRC32 header (hex) is verified before the file is committed.
+    """
+    try:
+        expected_crc32 = parse_crc32(request.headers.get('X-Checksum-CRC32'))
         
-        file_size = os.path.getsize(filepath)
+        upload = AtomicUpload(filename)
+        try:
+            upload.write_from(request.stream, UPLOAD_CHUNK_SIZE)
+        except BaseException:
+            upload.abort()
+            raise
+        upload.commit(expected_crc32, request.content_length)
+        file_index.update(upload.filename, upload.crc32, upload.sha256)
         
         return jsonify({
             'status': 'success',
             'message': 'File uploaded successfully',
-            'filename': file.filename,
-            'size': file_size
+            'filename': upload.filename,
+            'size': upload.size,
+            'crc32': f"{upload.crc32:08x}",
+            'sha256': upload.sha256
         })
         
+    except (UploadError, ValueError) as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+        
     except Exception as e:
         return jsonify({
             'status': 'error',
             'message': str(e)
+        }), 500
+
+
+@app.route('/api/uploads', methods=['POST'])
+def start_upload():
+    """Start a resumable upload; the body is JSON with the target 'filename'"""
+    try:
+        data = request.get_json()
+        upload_id, upload = upload_registry.create(data.get('filename'))
+        
+        return jsonify({
+            'status': 'success',
+            'upload_id': upload_id,
+            'filename': upload.filename,
+            'offset': 0
+        })
+        
+    except UploadError as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """Report how many bytes of a resumable upload have been received"""
+    upload = upload_registry.get(upload_id)
+    if upload is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Upload not found'
+        }), 404
+    
+    return jsonify({
+        'status': 'success',
+        'upload_id': upload_id,
+        'filename': upload.filename,
+        'offset': upload.size
+    })
+
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """
+    Append the request body to a resumable upload
+    
+    The 'offset' query parameter must equal the bytes received so far; on a
+    mismatch the response is 409 with the offset to resume from.
+    """
+    upload = upload_registry.get(upload_id)
+    if upload is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Upload not found'
+        }), 404
+    
+    offset = request.args.get('offset', type=int)
+    with upload.lock:
+        if offset is not None and offset != upload.size:
+            return jsonify({
+                'status': 'error',
+                'message': f"Upload is at byte {upload.size}, not {offset}",
+                'offset': upload.size
+            }), 409
+        
+        try:
+            # A dropped connection keeps the bytes written so far; the client resumes from 'offset'
+            upload.write_from(request.stream, UPLOAD_CHUNK_SIZE)
+        except Exception as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e),
+                'offset': upload.size
+            }), 500
+    
+    return jsonify({
+        'status': 'success',
+        'upload_id': upload_id,
+        'offset': upload.size
+    })
+
+
+@app.route('/api/uploads/<upload_id>/commit', methods=['POST'])
+def commit_upload(upload_id):
+    """Finish a resumable upload, optionally checking JSON 'size' and 'crc32' (hex)"""
+    upload = upload_registry.pop(upload_id)
+    if upload is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Upload not found'
+        }), 404
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        with upload.lock:
+            upload.commit(parse_crc32(data.get('crc32')), data.get('size'))
+        file_index.update(upload.filename, upload.crc32, upload.sha256)
+        
+        return jsonify({
+            'status': 'success',
+            'message': 'File uploaded successfully',
+            'filename': upload.filename,
+            'size': upload.size,
+            'crc32': f"{upload.crc32:08x}",
+            'sha256': upload.sha256
         })
+        
+    except (UploadError, ValueError) as e:
+        upload.abort()
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    """Cancel a resumable upload and discard the data received so far"""
+    upload = upload_registry.pop(upload_id)
+    if upload is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Upload not found'
+        }), 404
+    
+    with upload.lock:
+        upload.abort()
+    return jsonify({
+        'status': 'success',
+        'message': 'Upload cancelled',
+        'filename': upload.filename
+    })
 
 
 @app.route('/api/delete/<filename>', methods=['DELETE'])
@@ -217,6 +947,8 @@ def delete_file(filename):
             })
         
         os.remove(filepath)
+        file_index.remove(filename)
+        content_store.remove(filepath)
         
         return jsonify({
             'status': 'success',
@@ -231,6 +963,15 @@ def delete_file(filename):
         })
 
 
+def parse_crc32(value):
+    """Parse an optional hex CRC32 from a header or JSON field"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, int):
+        return value
+    return int(value, 16)
+
+
 def format_file_size(size_bytes):
     """Format file size in human-readable format"""
     for unit in ['B', 'KB', 'MB', 'GB']:
@@ -245,6 +986,8 @@ def main():
     print(f"Starting Web Interface on http://{WEB_HOST}:{WEB_PORT}")
     print(f"Connected to File Server: {SERVER_HOST}:{SERVER_PORT}")
     print(f"Server Files Directory: {os.path.abspath(FILES_DIRECTORY)}")
+    if os.path.isdir(FILES_DIRECTORY):
+        file_index.start()
     app.run(host=WEB_HOST, port=WEB_PORT, debug=True, threaded=True)
 
 